@@ -0,0 +1,351 @@
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from io import BytesIO
+# scanner modules import their siblings by name, as when notifier.py runs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "scanner"))
+import chair_sqlite
+import classify
+from kijiji_scraper import KijijiAd
+from detector.train_detector.create_dataset import get_dataloaders
+from detector.train_detector.training import train_epoch
+from detector.train_detector.benchmark_training import synthetic_dataloader
+
+
+BASELINE = "benchmark_baseline.json"
+VAR_NAMES = "(:id, :date, :prob, :price, :filename)"
+
+
+class TinyNet(nn.Module):
+    """
+    Small randomly initialized CNN with the same interface as the detector:
+    images in, two logits out, and a final fully connected layer fc. It keeps
+    the benchmarks fast and offline while exercising the same code paths.
+    """
+    def __init__(self, num_classes=2):
+        super(TinyNet, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, 16, 3, stride=2, padding=1),
+            nn.BatchNorm2d(16),
+            nn.ReLU(),
+            nn.Conv2d(16, 32, 3, stride=2, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1),
+            nn.Flatten()
+            )
+        self.fc = nn.Linear(32, num_classes)
+
+    def forward(self, x):
+        return self.fc(self.features(x))
+
+
+def synthetic_image(seed: int, size=(640, 480)):
+    """
+    Returns a random RGB image of <size>, about the size of an ad photo.
+
+    :param seed: Random seed.
+    :param size: Width and height of the image.
+    :return: Image
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+def median_time(fn, repeat: int):
+    """
+    Returns the median duration, in seconds, of <repeat> calls of <fn>,
+    after one untimed call.
+
+    :param fn: Function without arguments.
+    :param repeat: Number of timed calls.
+    :return: float
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def best_rate(fn, count: int, runs=3):
+    """
+    Returns the highest rate, <count> per second, over <runs> calls of <fn>,
+    which is given the index of the run. The best run is the least disturbed
+    by other processes, so it is the most repeatable.
+
+    :param fn: Function of the run index doing <count> operations.
+    :param count: Number of operations per call.
+    :param runs: Number of calls.
+    :return: float
+    """
+    best = 0.0
+    for run in range(runs):
+        start = time.perf_counter()
+        fn(run)
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def bench_classify(repeat: int):
+    """
+    Returns the per-image latency of classify.process_image, of
+    classify.get_prob and of classify.bytes_prob on PNG bytes, in ms.
+
+    :param repeat: Number of timed calls of each function.
+    :return: dict
+    """
+    model = TinyNet().eval()
+    image = synthetic_image(0)
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    data = buffer.getvalue()
+    with torch.no_grad():
+        return {
+            "process_image_ms": (
+                1000 * median_time(lambda: classify.process_image(image),
+                                   repeat), False
+                ),
+            "get_prob_ms": (
+                1000 * median_time(lambda: classify.get_prob(model, image),
+                                   repeat), False
+                ),
+            "bytes_prob_ms": (
+                1000 * median_time(lambda: classify.bytes_prob(data, model),
+                                   repeat), False
+                )
+            }
+
+
+def bench_db(folder: str, rows: int):
+    """
+    Returns the rows/sec of chair_sqlite.insert and chair_sqlite.insert_many,
+    the ads/sec of KijijiAd.insert_into_db for ads of 5 images, and the
+    lookups/sec of chair_sqlite.is_in_db on the per-image and summary
+    tables, on new databases in <folder>. Each rate is the best of 3 runs.
+
+    :param folder: Folder for the temporary databases.
+    :param rows: Number of rows inserted by each benchmark.
+    :return: dict
+    """
+    def row(i):
+        return {"id": i, "date": "2021-06-01 12:00:00", "prob": 0.5,
+                "price": 100.0, "filename": "{}.png".format(i)}
+
+    def new_db(name):
+        path = os.path.join(folder, name)
+        chair_sqlite.init_db(db=path)
+        return chair_sqlite.open_conn(db_name=path)
+
+    def insert(run):
+        for i in range(run * rows, (run + 1) * rows):
+            chair_sqlite.insert(db_conn, row(i), VAR_NAMES)
+
+    def insert_many(run):
+        chair_sqlite.insert_many(
+            db_conn, [row(i) for i in range(run * rows, (run + 1) * rows)],
+            VAR_NAMES
+            )
+
+    def insert_ads(run):
+        for i in range(run * n_ads, (run + 1) * n_ads):
+            ad = KijijiAd(i, "2021-06-01 12:00:00", [0.5] * 5, 100.0,
+                          ["{}_{}.png".format(i, j) for j in range(5)])
+            ad.insert_into_db(db_conn)
+            chair_sqlite.update_summary(
+                db_conn, ad.id, max(ad.probs), len(ad.names), ad.price,
+                ad.time
+                )
+
+    def lookup(table):
+        def run(_):
+            for ad_id in ids:
+                chair_sqlite.is_in_db(db_conn, int(ad_id), "id", table=table)
+        return run
+
+    results = {}
+    db_conn = new_db("insert.db")
+    results["insert_rows_per_sec"] = (best_rate(insert, rows), True)
+    chair_sqlite.close_conn(db_conn)
+    db_conn = new_db("insert_many.db")
+    results["insert_many_rows_per_sec"] = (best_rate(insert_many, rows), True)
+    chair_sqlite.close_conn(db_conn)
+    db_conn = new_db("ads.db")
+    n_ads = rows // 5
+    results["insert_ads_per_sec"] = (best_rate(insert_ads, n_ads), True)
+    # half of the looked up ids are stored
+    ids = np.random.default_rng(0).integers(0, 6 * n_ads, rows)
+    for table in ("chairs", "ads"):
+        results["is_in_db_{}_per_sec".format(table)] = (
+            best_rate(lookup(table), rows), True
+            )
+    chair_sqlite.close_conn(db_conn)
+    return results
+
+
+def bench_training(folder: str, images: int, batch_size: int,
+                   num_workers: int):
+    """
+    Returns the images/sec of one epoch of create_dataset.get_dataloaders
+    over <images> synthetic images saved to <folder>, the best of 3 epochs,
+    and of training.train_epoch of a TinyNet on random tensors.
+
+    :param folder: Folder for the synthetic image dataset.
+    :param images: Number of images.
+    :param batch_size: The DataLoader batch size.
+    :param num_workers: The number of DataLoader workers.
+    :return: dict
+    """
+    for i in range(images):
+        label = "HM" if i % 2 else "NHM"
+        os.makedirs(os.path.join(folder, label), exist_ok=True)
+        synthetic_image(i, size=(320, 240)).save(
+            os.path.join(folder, label, "{}.png".format(i))
+            )
+    train_dataloader, val_dataloader = next(get_dataloaders(
+        folder, 224, batch_size, 5, num_workers
+        ))
+
+    def load(_):
+        for dataloader in (train_dataloader, val_dataloader):
+            for _ in dataloader:
+                pass
+
+    loading = best_rate(load, images)
+    model = TinyNet()
+    dataloader = synthetic_dataloader(images, 224, batch_size)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loss_criterion = nn.CrossEntropyLoss()
+    device = torch.device('cpu')
+    epoch = median_time(
+        lambda: train_epoch(model, loss_criterion, optimizer, dataloader,
+                            device),
+        3
+        )
+    return {
+        "get_dataloaders_images_per_sec": (loading, True),
+        "train_epoch_images_per_sec": (images / epoch, True)
+        }
+
+
+def run(repeat=50, rows=2000, images=64, batch_size=16, num_workers=0):
+    """
+    Runs every benchmark offline and returns the results: a dictionary
+    mapping each metric name to its value and whether higher is better,
+    along with the versions and CPU count of the machine under "machine".
+
+    :param repeat: Number of timed calls of each classify function.
+    :param rows: Number of rows of each database benchmark.
+    :param images: Number of images of the training benchmarks.
+    :param batch_size: The DataLoader batch size.
+    :param num_workers: The number of DataLoader workers.
+    :return: dict
+    """
+    torch.manual_seed(0)
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics.update(bench_classify(repeat))
+        metrics.update(bench_db(tmp, rows))
+        metrics.update(bench_training(
+            os.path.join(tmp, "images"), images, batch_size, num_workers
+            ))
+    return {
+        "machine": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads()
+            },
+        "metrics": {
+            name: {"value": value, "higher_is_better": higher}
+            for name, (value, higher) in metrics.items()
+            }
+        }
+
+
+def compare(results: dict, baseline: dict, tolerance=0.2):
+    """
+    Prints every metric of <results> next to its <baseline> value and
+    returns the names of the metrics that are worse than the baseline by
+    more than the fraction <tolerance>.
+
+    :param results: Results returned by run.
+    :param baseline: Results of an earlier run.
+    :param tolerance: Allowed relative change in the worse direction.
+    :return: List[str]
+    """
+    regressions = []
+    print("{:<32} {:>12} {:>12} {:>8}".format(
+        "metric", "baseline", "current", "change"
+        ))
+    for name, metric in results["metrics"].items():
+        old = baseline["metrics"].get(name)
+        if old is None:
+            print("{:<32} {:>12} {:>12.2f}".format(name, "-", metric["value"]))
+            continue
+        change = metric["value"] / old["value"] - 1
+        worse = -change if metric["higher_is_better"] else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print("{:<32} {:>12.2f} {:>12.2f} {:>+7.1%}{}".format(
+            name, old["value"], metric["value"], change, flag
+            ))
+    if baseline.get("machine") != results["machine"]:
+        print("Baseline was recorded on a different machine: {}".format(
+            baseline.get("machine")
+            ))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks of the scanner, database and "
+                    "training hot paths."
+        )
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-workers", type=int, default=0)
+    cli_args = parser.parse_args()
+    results = run(
+        cli_args.repeat, cli_args.rows, cli_args.images, cli_args.batch_size,
+        cli_args.num_workers
+        )
+    with open(cli_args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if cli_args.save_baseline:
+        with open(cli_args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to {}".format(cli_args.baseline))
+    elif os.path.exists(cli_args.baseline):
+        with open(cli_args.baseline) as f:
+            regressions = compare(results, json.load(f), cli_args.tolerance)
+        if regressions:
+            sys.exit("Regressions: {}".format(", ".join(regressions)))
+    else:
+        for name, metric in results["metrics"].items():
+            print("{:<32} {:>12.2f}".format(name, metric["value"]))
+        print("No baseline at {}, run with --save-baseline to store one"
+              .format(cli_args.baseline))
@@ -1,13 +1,90 @@
 from scanner import classify
 import os
+import csv
+import hashlib
+import random
+import time
+import torch
+from torch.nn.functional import softmax
+from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 from typing import List
 
 
-def sort_raw_data(old_dir: str, new_dir: str, model_path: str, delta=0.2):
+LABELS = ("HM", "NHM", "uncertain")
+MANIFEST_FIELDS = ("path", "label", "split")
+
+
+class RawImages(Dataset):
+    """
+    Dataset of the raw images <files> in the folder <folder>. Each item is
+    the processed image tensor and its index in <files>; images that cannot
+    be decoded are returned as None so that a DataLoader worker never crashes
+    on a corrupt download.
+
+    folder - str: Path to directory containing raw data.
+    files - list[str]: Names of the images in folder.
+    """
+    def __init__(self, folder: str, files: List[str]):
+        self.folder = folder
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index: int):
+        try:
+            with open(os.path.join(self.folder, self.files[index]), 'rb') as f:
+                image = Image.open(f).convert('RGB')
+                return classify.process_image(image)[0], index
+        except (OSError, SyntaxError, ValueError):
+            return None, index
+
+
+def collate_raw_images(batch: list):
+    """
+    Collates a batch of RawImages items into a tensor of the decoded images
+    and the indices of the decoded and undecodable images.
+
+    :param batch: List of (tensor or None, index) tuples.
+    :return: torch.Tensor or None, List[int], List[int]
+    """
+    images = [image for image, _ in batch if image is not None]
+    decoded = [index for image, index in batch if image is not None]
+    failed = [index for image, index in batch if image is None]
+    return (torch.stack(images) if images else None), decoded, failed
+
+
+def read_manifest(manifest: str):
+    """
+    Returns the dictionary of image name to label recorded in the sorting
+    manifest <manifest>, a file of "name,label" lines. A missing manifest is
+    empty. A line cut short by a crash is ignored.
+
+    :param manifest: Path to manifest file.
+    :return: dict[str, str]
+    """
+    labels = {}
+    if not os.path.exists(manifest):
+        return labels
+    with open(manifest) as f:
+        for line in f:
+            name, sep, label = line.rstrip("\n").rpartition(",")
+            if sep and label in LABELS:
+                labels[name] = label
+    return labels
+
+
+def sort_raw_data(old_dir: str, new_dir: str, model_path: str, delta=0.2,
+                  batch_size=64, num_workers=4, manifest=None):
     """
     Moves image data from old directory to a new directory and sorts the data
-    based off of the image classification of a neural network model.
+    based off of the image classification of a neural network model. Images
+    are decoded by <num_workers> DataLoader workers and classified in batches
+    of <batch_size>. Every classified batch is appended to the <manifest>
+    checkpoint, so an interrupted run resumes with the images it had not yet
+    classified. Files are only moved once every image has been classified;
+    images that cannot be decoded are labelled "uncertain".
 
     :param old_dir: Path to directory containing raw data.
     :param new_dir: Path to directory containing sorted data.
@@ -15,23 +92,76 @@ def sort_raw_data(old_dir: str, new_dir: str, model_path: str, delta=0.2):
     :param delta: Float in (0,0.5). Any model output probability that falls
             within (0.5 - delta, 0.5 + delta) is deemed to uncertain to
             classify when sorting raw data.
+    :param batch_size: Number of images classified at once.
+    :param num_workers: Number of processes decoding images.
+    :param manifest: Path to manifest file, by default
+            <new_dir>/sort_manifest.csv.
+    :return: None
+    """
+    if manifest is None:
+        manifest = os.path.join(new_dir, "sort_manifest.csv")
+    os.makedirs(new_dir, exist_ok=True)
+    labels = read_manifest(manifest)
+    files = sorted(f for f in os.listdir(old_dir) if f not in labels)
+    if files:
+        classify_files(
+            old_dir, files, model_path, manifest, delta, batch_size,
+            num_workers
+            )
+        labels = read_manifest(manifest)
+    for key in LABELS:
+        os.makedirs(os.path.join(new_dir, key), exist_ok=True)
+    for name, label in labels.items():
+        source = os.path.join(old_dir, name)
+        if os.path.exists(source):
+            os.replace(source, os.path.join(new_dir, label, name))
+
+
+def classify_files(old_dir: str, files: List[str], model_path: str,
+                   manifest: str, delta: float, batch_size: int,
+                   num_workers: int):
+    """
+    Classifies the images <files> in <old_dir> in batches and appends a
+    "name,label" line per image to <manifest>, flushed to disk after every
+    batch. Prints the throughput in images per second.
+
+    :param old_dir: Path to directory containing raw data.
+    :param files: Names of the images to classify.
+    :param model_path: Path to neural network.
+    :param manifest: Path to manifest file.
+    :param delta: Width of the uncertain band around 0.5.
+    :param batch_size: Number of images classified at once.
+    :param num_workers: Number of processes decoding images.
     :return: None
     """
-    data = {"HM": [], "NHM": [], "uncertain": []}
     model = classify.init_model(model_path)
-    for image in os.listdir(old_dir):
-        image_path = old_dir + "/" + image
-        with open(image_path, 'rb') as img:
-            mod_input = Image.open(img).convert('RGB')
-            prob = classify.get_prob(model, mod_input)
-            if prob >= 0.5 + delta:
-                data["hm"].append(image)
-            elif prob <= 0.5 - delta:
-                data["nhm"].append(image)
-            else:
-                data["uncertain"].append(image)
-    for key, val in data.items():
-        move_files(val, old_dir, new_dir + "/" + key)
+    loader = DataLoader(
+        RawImages(old_dir, files),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate_raw_images
+        )
+    start, done = time.time(), 0
+    with open(manifest, "a") as out, torch.inference_mode():
+        for images, decoded, failed in loader:
+            lines = ["{},uncertain\n".format(files[i]) for i in failed]
+            if images is not None:
+                probs = softmax(model(images), dim=1)[:, 0].tolist()
+                for i, prob in zip(decoded, probs):
+                    if prob >= 0.5 + delta:
+                        label = "HM"
+                    elif prob <= 0.5 - delta:
+                        label = "NHM"
+                    else:
+                        label = "uncertain"
+                    lines.append("{},{}\n".format(files[i], label))
+            out.writelines(lines)
+            out.flush()
+            os.fsync(out.fileno())
+            done += len(lines)
+            print("{}/{} images, {:0.1f} images/sec".format(
+                done, len(files), done / (time.time() - start)
+                ))
 
 
 def move_files(files: List[str], old_dir: str, new_dir: str):
@@ -49,17 +179,180 @@ def move_files(files: List[str], old_dir: str, new_dir: str):
 
 def move_data(old_dir: str, new_dir: str):
     """
-    Moves files from old directory to a new directory.
+    Moves the files in each category folder of <old_dir> into the category
+    folder of the same name in <new_dir>. "uncertain" folders are skipped.
 
     :param old_dir: Path to directory that files are currently located in.
     :param new_dir: Path to directory that files are to be moved to.
     :return: None
     """
-    data = {"HM": [], "NHM": [], "uncertain": []}
-    for (dir_path, dir_names, filenames) in os.walk(old_dir):
-        for dir_name in dir_names:
-            if dir_name == "uncertain":
-                continue
-            for image in os.listdir(dir_path):
-                data[dir_name].append(dir_path + "/" + image)
-            move_files(data[dir_name], dir_path, new_dir + "/" + "dir_name")
+    for dir_name in os.listdir(old_dir):
+        dir_path = os.path.join(old_dir, dir_name)
+        if dir_name == "uncertain" or not os.path.isdir(dir_path):
+            continue
+        os.makedirs(os.path.join(new_dir, dir_name), exist_ok=True)
+        move_files(
+            os.listdir(dir_path), dir_path, os.path.join(new_dir, dir_name)
+            )
+
+
+def read_dataset_manifest(manifest: str):
+    """
+    Returns the rows of the dataset manifest <manifest>, a CSV file with
+    columns path, label and split. Relative paths are relative to the folder
+    of the manifest.
+
+    :param manifest: Path to manifest file.
+    :return: List[dict]
+    """
+    with open(manifest, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def write_dataset_manifest(manifest: str, rows: List[dict]):
+    """
+    Writes <rows> to the dataset manifest <manifest>, replacing it
+    atomically.
+
+    :param manifest: Path to manifest file.
+    :param rows: List of dictionaries with keys path, label and split.
+    :return: None
+    """
+    tmp = manifest + ".tmp"
+    with open(tmp, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(
+            {key: row[key] for key in MANIFEST_FIELDS} for row in rows
+            )
+    os.replace(tmp, manifest)
+
+
+def build_manifest(folder: str, manifest: str, skip=("uncertain",)):
+    """
+    Writes a dataset manifest <manifest> for the images in the category
+    folders of <folder>, i.e. the ImageFolder layout, labelling each image
+    with the name of its folder. Folders in <skip> are left out and every
+    image starts without a split. Returns the number of images.
+
+    :param folder: Path to data in the ImageFolder layout.
+    :param manifest: Path to manifest file.
+    :param skip: Names of category folders to leave out.
+    :return: int
+    """
+    root = os.path.dirname(os.path.abspath(manifest))
+    rows = []
+    for label in sorted(os.listdir(folder)):
+        dir_path = os.path.join(folder, label)
+        if label in skip or not os.path.isdir(dir_path):
+            continue
+        for image in sorted(os.listdir(dir_path)):
+            path = os.path.relpath(os.path.join(dir_path, image), root)
+            rows.append({"path": path, "label": label, "split": ""})
+    write_dataset_manifest(manifest, rows)
+    return len(rows)
+
+
+def relabel(manifest: str, labels: dict):
+    """
+    Changes the label of every image in the dataset manifest <manifest>
+    whose path is a key of <labels> to the corresponding value. No image
+    files are touched. Returns the number of images relabelled.
+
+    :param manifest: Path to manifest file.
+    :param labels: Dictionary of manifest path to new label.
+    :return: int
+    """
+    rows = read_dataset_manifest(manifest)
+    changed = 0
+    for row in rows:
+        label = labels.get(row["path"])
+        if label is not None and label != row["label"]:
+            row["label"] = label
+            changed += 1
+    write_dataset_manifest(manifest, rows)
+    return changed
+
+
+def assign_splits(manifest: str, fractions: dict, seed=6802):
+    """
+    Randomly assigns every image in the dataset manifest <manifest> to one of
+    the splits in <fractions>, e.g. {"train": 0.8, "val": 0.2}, stratified by
+    label so every split has the same label balance.
+
+    :param manifest: Path to manifest file.
+    :param fractions: Dictionary of split name to fraction of images.
+    :param seed: Seed of the random assignment.
+    :return: None
+    """
+    assert abs(sum(fractions.values()) - 1) < 1e-9, "fractions must sum to 1"
+    rows = read_dataset_manifest(manifest)
+    rng = random.Random(seed)
+    by_label = {}
+    for row in rows:
+        by_label.setdefault(row["label"], []).append(row)
+    for group in by_label.values():
+        rng.shuffle(group)
+        start = 0
+        for i, (split, fraction) in enumerate(fractions.items()):
+            end = len(group) if i == len(fractions) - 1 \
+                else start + round(fraction * len(group))
+            for row in group[start:end]:
+                row["split"] = split
+            start = end
+    write_dataset_manifest(manifest, rows)
+
+
+def materialize(manifest: str, out_dir: str, split=None, link="hardlink"):
+    """
+    Builds the ImageFolder layout <out_dir>/<label>/<image> for the images in
+    the dataset manifest <manifest> (only those in <split> if it is not None)
+    out of hard or symbolic links, so no image data is copied or moved. Each
+    link is named after its source with a hash of its manifest path
+    appended, so sources with the same name in different folders never
+    overwrite each other, without reading any image.
+
+    :param manifest: Path to manifest file.
+    :param out_dir: Path of the folder to build.
+    :param split: Name of the split to include, or None for all images.
+    :param link: "hardlink" or "symlink".
+    :return: None
+    """
+    assert link in ("hardlink", "symlink"), "link must be hardlink or symlink"
+    root = os.path.dirname(os.path.abspath(manifest))
+    for row in read_dataset_manifest(manifest):
+        if split is not None and row["split"] != split:
+            continue
+        source = os.path.join(root, row["path"])
+        label_dir = os.path.join(out_dir, row["label"])
+        os.makedirs(label_dir, exist_ok=True)
+        stem, ext = os.path.splitext(os.path.basename(source))
+        path_hash = hashlib.sha256(row["path"].encode("utf-8")).hexdigest()
+        target = os.path.join(
+            label_dir, "{}_{}{}".format(stem, path_hash[:16], ext)
+            )
+        if os.path.lexists(target):
+            os.remove(target)
+        if link == "hardlink":
+            os.link(source, target)
+        else:
+            os.symlink(os.path.abspath(source), target)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Sort raw images into HM/NHM/uncertain folders."
+        )
+    parser.add_argument("old_dir")
+    parser.add_argument("new_dir")
+    parser.add_argument("--model", default="detector/model.pt")
+    parser.add_argument("--delta", type=float, default=0.2)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--manifest")
+    cli_args = parser.parse_args()
+    sort_raw_data(
+        cli_args.old_dir, cli_args.new_dir, cli_args.model, cli_args.delta,
+        cli_args.batch_size, cli_args.num_workers, cli_args.manifest
+        )
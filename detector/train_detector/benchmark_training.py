@@ -0,0 +1,117 @@
+import itertools
+import time
+import torch
+import torch.nn as nn
+from torchvision import models
+from torch.utils.data import DataLoader, TensorDataset
+from detector.train_detector.training import train_epoch
+
+
+def synthetic_dataloader(n: int, dimensions: int, batch_size: int):
+    """
+    Returns a DataLoader of <n> random images of size <dimensions> with
+    random binary labels, so that only the model is measured.
+
+    :param n: Number of images.
+    :param dimensions: Height/width of the images.
+    :param batch_size: The DataLoader batch size.
+    :return: DataLoader
+    """
+    images = torch.randn(n, 3, dimensions, dimensions)
+    labels = torch.randint(0, 2, (n,))
+    return DataLoader(TensorDataset(images, labels), batch_size=batch_size)
+
+
+def images_per_sec(model_link: str, dataloader: DataLoader,
+                   channels_last=False, bf16=False, compile=False,
+                   accumulation=1, warmup=1):
+    """
+    Returns the training throughput, in images per second, of a randomly
+    initialized <model_link> for one epoch over <dataloader> using
+    training.train_epoch with the given performance options, after <warmup>
+    untimed epochs.
+
+    :param model_link: Name of a torchvision model.
+    :param dataloader: Training DataLoader.
+    :param channels_last: Whether to use the channels_last memory format.
+    :param bf16: Whether to use bfloat16 autocast.
+    :param compile: Whether to torch.compile the model.
+    :param accumulation: Number of batches per optimizer step.
+    :param warmup: Number of untimed epochs run first.
+    :return: float
+    """
+    device = torch.device('cpu')
+    model = getattr(models, model_link)(num_classes=2)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    run_model = torch.compile(model) if compile else model
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loss_criterion = nn.CrossEntropyLoss()
+    options = {
+        "channels_last": channels_last, "bf16": bf16,
+        "accumulation": accumulation
+        }
+    for _ in range(warmup):
+        train_epoch(
+            run_model, loss_criterion, optimizer, dataloader, device, **options
+            )
+    start = time.time()
+    train_epoch(
+        run_model, loss_criterion, optimizer, dataloader, device, **options
+        )
+    return len(dataloader.dataset) / (time.time() - start)
+
+
+def benchmark(model_link="resnext50_32x4d", n=64, dimensions=224,
+              batch_size=16, threads=(None,), accumulation=1):
+    """
+    Prints the training images/sec of <model_link> on the CPU for every
+    combination of channels_last, bfloat16 autocast, torch.compile and
+    intra-op thread count in <threads>.
+
+    :param model_link: Name of a torchvision model.
+    :param n: Number of synthetic images per epoch.
+    :param dimensions: Height/width of the images.
+    :param batch_size: The DataLoader batch size.
+    :param threads: Thread counts to try, None for the torch default.
+    :param accumulation: Number of batches per optimizer step.
+    :return: List[tuple]
+    """
+    dataloader = synthetic_dataloader(n, dimensions, batch_size)
+    default_threads = torch.get_num_threads()
+    results = []
+    print("{:>7} {:>13} {:>5} {:>7} {:>10}".format(
+        "threads", "channels_last", "bf16", "compile", "images/s"
+        ))
+    for num_threads, channels_last, bf16, compile in itertools.product(
+            threads, (False, True), (False, True), (False, True)):
+        torch.set_num_threads(num_threads or default_threads)
+        speed = images_per_sec(
+            model_link, dataloader, channels_last, bf16, compile,
+            accumulation
+            )
+        results.append((num_threads, channels_last, bf16, compile, speed))
+        print("{:>7} {:>13} {:>5} {:>7} {:>10.1f}".format(
+            str(num_threads or default_threads), str(channels_last),
+            str(bf16), str(compile), speed
+            ))
+    torch.set_num_threads(default_threads)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Training images/sec for each CPU performance option."
+        )
+    parser.add_argument("--model", default="resnext50_32x4d")
+    parser.add_argument("--n", type=int, default=64)
+    parser.add_argument("--dimensions", type=int, default=224)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, nargs="*", default=[None])
+    parser.add_argument("--accumulation", type=int, default=1)
+    cli_args = parser.parse_args()
+    benchmark(
+        cli_args.model, cli_args.n, cli_args.dimensions, cli_args.batch_size,
+        cli_args.threads, cli_args.accumulation
+        )
@@ -0,0 +1,90 @@
+import json
+import os
+import random
+import numpy as np
+import torch
+
+
+def save_checkpoint(path: str, state: dict):
+    """
+    Saves <state> to <path> with torch.save. The file is written under a
+    temporary name and renamed into place, so a crash while saving leaves the
+    previous checkpoint intact.
+
+    :param path: Path of checkpoint file.
+    :param state: Objects to save.
+    :return: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path: str):
+    """
+    Returns the objects saved to <path> by save_checkpoint, on the CPU.
+
+    :param path: Path of checkpoint file.
+    :return: dict
+    """
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def save_json(path: str, state: dict):
+    """
+    Writes <state> to the JSON file <path>, replacing it atomically.
+
+    :param path: Path of JSON file.
+    :param state: JSON serializable dictionary.
+    :return: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_json(path: str, default: dict):
+    """
+    Returns the dictionary in the JSON file <path>, or <default> if there is
+    no such file.
+
+    :param path: Path of JSON file.
+    :param default: Dictionary returned if the file does not exist.
+    :return: dict
+    """
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_rng_state():
+    """
+    Returns the state of every random number generator used in training:
+    Python, NumPy, torch and, when available, CUDA.
+
+    :return: dict
+    """
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state()
+        }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    """
+    Restores the random number generator states returned by get_rng_state.
+
+    :param state: Random number generator states.
+    :return: None
+    """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
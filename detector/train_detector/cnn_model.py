@@ -1,22 +1,56 @@
 import torch
 import torch.nn as nn
+from detector.train_detector.model_registry import pretrained
+
+
+def final_layer(model: nn.Module):
+    """
+    Returns the final fully connected layer of <model>: fc for ResNets and
+    the last classifier layer for MobileNets.
+
+    :param model: Neural net used for image classification.
+    :return: torch.Module
+    """
+    if hasattr(model, "fc"):
+        return model.fc
+    return model.classifier[-1]
+
+
+def set_final_layer(model: nn.Module, layer: nn.Module):
+    """
+    Replaces the final fully connected layer of <model> (see final_layer)
+    with <layer>.
+
+    :param model: Neural net used for image classification.
+    :param layer: New final layer.
+    :return: None
+    """
+    if hasattr(model, "fc"):
+        model.fc = layer
+    else:
+        model.classifier[-1] = layer
 
 
 def get_model(args: dict, device: torch.device, save=False):
     """
     Returns a PyTorch Neural Net with specifications found in <args> and
     attached to the <device>. If <save> is True, saves the model locally with
-    filename <args.save_as>.
+    filename <args.save_as>. The pretrained backbone <args.model_link> is
+    resolved through model_registry, from the weight files cached in
+    <args.weights_dir>, and is only read from disk once per process. If
+    <args.offline> is True the weights are never downloaded. The backbone's
+    final layer, fc for ResNets and the last classifier layer for
+    MobileNets, is replaced by a new one with <args.num_classes> outputs.
 
     :param args: Dictionary of training specifications detailed in main.py.
     :param device: GPU or CPU to load model onto.
     :param save: Whether to save model or not.
     :return: torch.Module
     """
-    model = torch.hub.load(
-        'pytorch/vision:v0.9.0', args.model_link, pretrained=True
+    model = pretrained(args.model_link, args.weights_dir, args.offline)
+    set_final_layer(
+        model, nn.Linear(final_layer(model).in_features, args.num_classes)
         )
-    model.fc = nn.Linear(2048, args.num_classes)
     if save:
         torch.save(model, args.save_as)
     return model.to(device)
@@ -1,16 +1,74 @@
 import numpy as np
+import csv
+import os
 from torchvision import transforms, datasets
-from torch.utils.data import Subset, DataLoader
+from torchvision.datasets.folder import default_loader
+from torch.utils.data import Dataset, Subset, DataLoader
+from detector.train_detector.packed_dataset import (
+    is_packed, PackedDataset, packed_transform
+    )
 
 
-def get_data(folder: str, dimensions: int):
+class ManifestDataset(Dataset):
+    """
+    Dataset of the images listed in a manifest CSV file with columns path,
+    label and split, as written by data_pipeline.build_manifest. Like
+    datasets.ImageFolder, classes are the sorted label names and each item is
+    an (image, class index) tuple.
+
+    samples - list[tuple(str, int)]: Image path and class index of each image.
+    classes - list[str]: Sorted label names.
+    class_to_idx - dict[str, int]: Class index of each label name.
+    targets - list[int]: Class index of each image.
+    transform - callable: Transform applied to each image.
+    """
+    def __init__(self, manifest: str, transform=None, split=None):
+        """
+        :param manifest: Path to manifest file. Relative image paths are
+                relative to the folder of the manifest.
+        :param transform: Transform applied to each image.
+        :param split: Name of the split to include, or None for all images.
+                All images are included while none is assigned a split, i.e.
+                before data_pipeline.assign_splits is run.
+        """
+        root = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, newline="") as f:
+            rows = list(csv.DictReader(f))
+        if split is not None and any(row["split"] for row in rows):
+            rows = [row for row in rows if row["split"] == split]
+        self.classes = sorted({row["label"] for row in rows})
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = [
+            (os.path.join(root, row["path"]), self.class_to_idx[row["label"]])
+            for row in rows
+            ]
+        self.targets = [target for _, target in self.samples]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index: int):
+        path, target = self.samples[index]
+        image = default_loader(path)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, target
+
+
+def get_data(folder: str, dimensions: int, split="train"):
     """
     Given the local path to the data <folder> of images, retrieve the images
     and return an ImageFolder dataset using the transforms outlined on the
     model webpage: https://pytorch.org/hub/pytorch_vision_resnext/
+    If <folder> is a manifest CSV file instead, a ManifestDataset of the
+    images it lists in <split> is returned, so images held out by
+    data_pipeline.assign_splits stay out of cross validation, and if it
+    holds a dataset written by packed_dataset.pack_dataset, a PackedDataset
+    is returned.
 
-    :param folder: Local path to data. Assuming the data has two categories,
-            the data should be stored as follows:
+    :param folder: Local path to data or to a manifest file. Assuming the
+            data has two categories, the data should be stored as follows:
 
             data
                 category A
@@ -21,8 +79,12 @@ def get_data(folder: str, dimensions: int):
             likewise category B only contains images of objects classified as
             B.
     :param dimensions: Dimensions to crop the height/width of images to.
-    :return: datasets.ImageFolder
+    :param split: Name of the manifest split to include, or None for all
+            images. Ignored for folders.
+    :return: datasets.ImageFolder, ManifestDataset or PackedDataset
     """
+    if is_packed(folder):
+        return PackedDataset(folder, transform=packed_transform(dimensions))
     preprocess = transforms.Compose(
         [
             transforms.Resize(256),
@@ -33,6 +95,8 @@ def get_data(folder: str, dimensions: int):
                 )
             ]
         )
+    if os.path.isfile(folder):
+        return ManifestDataset(folder, transform=preprocess, split=split)
     return datasets.ImageFolder(folder, transform=preprocess)
 
 
@@ -58,7 +122,7 @@ def cv_index_partitions(n: int, s: int):
 
 
 def get_dataloaders(folder: str, dimensions: int, batch_size: int, s: int,
-                    num_workers: int):
+                    num_workers: int, split="train"):
     """
     Retrieves image data from <folder>, processes them using
     torchvision.transforms and returns generator of <s> (train, validation)
@@ -79,9 +143,11 @@ def get_dataloaders(folder: str, dimensions: int, batch_size: int, s: int,
     :param batch_size: The DataLoader batch size.
     :param s: S-fold validation with s (training, validation) pairs.
     :param num_workers: The number of workers when training.
+    :param split: Name of the manifest split to cross validate on, or None
+            for all images.
     :return: generator of (DataLoader, DataLoader)
     """
-    image_data = get_data(folder, dimensions)
+    image_data = get_data(folder, dimensions, split=split)
     for train_inds, val_inds in cv_index_partitions(len(image_data), s):
         train_dataloader = DataLoader(
             Subset(image_data, train_inds),
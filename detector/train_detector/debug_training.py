@@ -1,9 +1,72 @@
 from detector.train_detector.main import ArgsDict
+import csv
 import matplotlib.pyplot as plt
-from torch.utils.data import DataLoader
 import torch
 from torchvision import transforms, datasets
 from detector.train_detector.create_dataset import get_data
+from detector.train_detector.embedding_cache import cache_logits
+
+
+def prediction_table(args: dict):
+    """
+    Returns one row per image of the dataset located at <args.folder> with
+    its path (or index), true label, predicted label, confidence (softmax
+    probability of the prediction) and margin (confidence minus the next
+    highest probability), computed from the cached logits (see
+    cache_logits).
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: List[dict]
+    """
+    image_data = get_data(args.folder, args.dimensions)
+    logits = torch.from_numpy(
+        cache_logits(args, args.saved_model, image_data)
+        )
+    probs = torch.softmax(logits, dim=1)
+    top2 = probs.topk(min(2, probs.shape[1]), dim=1).values
+    confidence = top2[:, 0]
+    margin = top2[:, 0] - top2[:, -1] if probs.shape[1] > 1 else confidence
+    predicted = probs.argmax(dim=1)
+    if hasattr(image_data, "samples"):
+        paths = [path for path, _ in image_data.samples]
+    else:
+        paths = [str(i) for i in range(len(image_data))]
+    return [
+        {
+            "index": i,
+            "path": paths[i],
+            "label": image_data.classes[image_data.targets[i]],
+            "predicted": image_data.classes[predicted[i]],
+            "confidence": confidence[i].item(),
+            "margin": margin[i].item()
+            }
+        for i in range(len(image_data))
+        ]
+
+
+def error_report(args: dict):
+    """
+    Writes the misclassified images of the dataset located at <args.folder>
+    and the correctly classified ones whose margin is below <args.margin>
+    to the CSV file <args.report>, misclassified images first, each group
+    sorted from the most to the least confident. Returns the report rows.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: List[dict]
+    """
+    table = prediction_table(args)
+    report = sorted(
+        (
+            row for row in table
+            if row["label"] != row["predicted"] or row["margin"] < args.margin
+            ),
+        key=lambda row: (row["label"] == row["predicted"], -row["confidence"])
+        )
+    with open(args.report, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(table[0]))
+        writer.writeheader()
+        writer.writerows(report)
+    return report
 
 
 def wrong_predictions(args: dict):
@@ -14,18 +77,10 @@ def wrong_predictions(args: dict):
     :param args: Dictionary of training specifications detailed in main.py.
     :return: list
     """
-    model = torch.load(args.saved_model, map_location=torch.device('cpu'))
-    model.eval()
-    image_data = get_data(args.folder, args.dimensions)
-    dl = DataLoader(image_data)
-    incorrect = []
-    for i, (image, label) in enumerate(dl):
-        outputs = model(image)
-        _, predicted = torch.max(outputs.data, 1, keepdim=True)
-        if predicted != label:
-            print(i)
-            incorrect.append(i)
-    return incorrect
+    return [
+        row["index"] for row in prediction_table(args)
+        if row["label"] != row["predicted"]
+        ]
 
 
 def process_data(folder: str, dimensions: int):
@@ -60,23 +115,25 @@ def process_data(folder: str, dimensions: int):
 
 def plot_prediction(args: dict, index: int):
     """
-    Plots image located at <index> in dataset found in <args.folder> and prints
-    the true and predicted labels.
+    Plots image located at <index> in dataset found in <args.folder>, an
+    image folder, manifest or packed dataset (see get_data), and prints the
+    true and predicted labels. The prediction is read from the cached logits
+    (see cache_logits), so the model is only run if the image is not cached
+    yet. The normalization of get_data is undone so the image is plotted
+    undistorted.
 
     :param args: Dictionary of training specifications detailed in main.py.
     :param index: Index of image data to plot.
     :return: None
     """
-    model = torch.load(args.saved_model, map_location=torch.device('cpu'))
-    model.eval()
     image_data = get_data(args.folder, args.dimensions)
+    logits = cache_logits(args, args.saved_model, image_data)
     image, label = image_data[index]
-    output = model(image.unsqueeze(0))
-    _, predicted = torch.max(output.data, 1, keepdim=True)
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
     print("label: ", label)
-    print("predicted: ", predicted.item())
-    image = process_data(args.folder, args.dimensions)[index][0]
-    plt.imshow(image.permute(1, 2, 0))
+    print("predicted: ", logits[index].argmax())
+    plt.imshow((image * std + mean).clamp(0, 1).permute(1, 2, 0))
 
 
 if __name__ == "__main__":
@@ -92,7 +149,11 @@ if __name__ == "__main__":
         "learning_rates": [0.004, 0.1, 0.02, 0.0008, 0.0001],
         "seed": 6802,
         "num_classes": 2,
-        "saved_model": "model.pt"
+        "saved_model": "model.pt",
+        "num_workers": 4,
+        "cache_dir": "detector/embeddings/",  # logits are cached here
+        "margin": 0.2,  # report correct predictions with a lower margin
+        "report": "error_report.csv"
         }
     args.update(args_dict)
-    print(len(wrong_predictions(args)))
+    print(len(error_report(args)))
@@ -0,0 +1,184 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset, Subset
+from detector.train_detector.create_dataset import get_dataloaders
+from detector.train_detector.cnn_model import get_model
+from detector.train_detector.embedding_cache import cache_logits
+from detector.train_detector.training import (
+    train, val_epoch, get_con_stats, fold_checkpoint_path
+    )
+
+
+class DistillationLoss(nn.Module):
+    """
+    Knowledge distillation loss. For targets made of a label followed by the
+    teacher's logits (see SoftTargets) it is <alpha> times the KL divergence
+    between the teacher's and the student's probabilities softened by
+    <temperature>, scaled by the squared temperature so its gradients keep
+    their size, plus 1 - <alpha> times the cross entropy with the labels. For
+    plain labels, as in validation, it is just the cross entropy.
+
+    temperature - float: Softmax temperature of the soft targets.
+    alpha - float: Weight of the soft targets in [0, 1].
+    weight - torch.Tensor: Class weights of the cross entropy, or None.
+    """
+    def __init__(self, temperature: float, alpha: float, weight=None):
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.weight = weight
+
+    def forward(self, outputs: torch.Tensor, targets: torch.Tensor):
+        if targets.dim() == 1:
+            return F.cross_entropy(outputs, targets, weight=self.weight)
+        labels, teacher = targets[:, 0].long(), targets[:, 1:]
+        soft = F.kl_div(
+            F.log_softmax(outputs / self.temperature, dim=1),
+            F.softmax(teacher / self.temperature, dim=1),
+            reduction="batchmean"
+            ) * self.temperature ** 2
+        hard = F.cross_entropy(outputs, labels, weight=self.weight)
+        return self.alpha * soft + (1 - self.alpha) * hard
+
+
+class SoftTargets(Dataset):
+    """
+    Dataset whose items are the images of <image_data> with, as target, the
+    label followed by the teacher's logits for that image.
+
+    image_data - Dataset: Dataset of (image, label) items.
+    logits - torch.Tensor: Teacher logits of every image, in dataset order.
+    """
+    def __init__(self, image_data: Dataset, logits: torch.Tensor):
+        self.image_data = image_data
+        self.logits = logits
+
+    def __len__(self):
+        return len(self.image_data)
+
+    def __getitem__(self, index: int):
+        image, label = self.image_data[index]
+        target = torch.cat([torch.tensor([float(label)]), self.logits[index]])
+        return image, target
+
+
+def with_soft_targets(dataloader: DataLoader, logits: torch.Tensor):
+    """
+    Returns a copy of the training DataLoader <dataloader>, over a Subset of
+    a dataset, whose targets also hold the teacher <logits>.
+
+    :param dataloader: Training DataLoader returned by get_dataloaders.
+    :param logits: Teacher logits of every image of the dataset.
+    :return: DataLoader
+    """
+    subset = dataloader.dataset
+    return DataLoader(
+        Subset(SoftTargets(subset.dataset, logits), subset.indices),
+        batch_size=dataloader.batch_size,
+        shuffle=True,
+        num_workers=dataloader.num_workers
+        )
+
+
+def latency(model: nn.Module, dimensions: int, runs=20):
+    """
+    Returns the median CPU latency, in milliseconds, of <model> classifying
+    one image of size <dimensions>, the way the scanner runs it.
+
+    :param model: Neural network.
+    :param dimensions: Height/width of the image.
+    :param runs: Number of timed runs, after one untimed run.
+    :return: float
+    """
+    model = model.cpu().eval()
+    image = torch.randn(1, 3, dimensions, dimensions)
+    times = []
+    with torch.inference_mode():
+        model(image)
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(image)
+            times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def distill_cv_training(args: dict):
+    """
+    Trains the student <args.student> on the soft probabilities of the
+    teacher saved at <args.teacher>, using the same S-fold cross validation
+    over <args.learning_rates> as training.best_cv_training. The teacher's
+    logits are computed once and cached (see embedding_cache.cache_logits),
+    so the teacher is not run during training. The loss is a
+    DistillationLoss with <args.temperature> and <args.distill_alpha>.
+    Prints the accuracy and latency of the teacher and of the best student
+    on the validation images of the student's best fold, and returns the
+    best student with its validation metric.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: torch.Module, float
+    """
+    assert len(args.learning_rates) == args.s, (
+        "learning_rates should be of size s"
+        )
+    np.random.seed(args.seed)
+    device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    student_args = type(args)(args, model_link=args.student)
+    if args.checkpoint_dir:
+        student_args.checkpoint_dir = os.path.join(
+            args.checkpoint_dir, "distill"
+            )
+    if args.label_weights is None:
+        label_weights = None
+    else:
+        label_weights = args.label_weights.to(device)
+    loss_criterion = DistillationLoss(
+        args.temperature, args.distill_alpha, weight=label_weights
+        )
+    logits = None
+    best_metric, best_state, best_pair = -1, None, None
+    for i, (train_dataloader, val_dataloader) in enumerate(get_dataloaders(
+            args.folder, args.dimensions, args.batch_size, args.s,
+            args.num_workers)):
+        if logits is None:
+            logits = torch.from_numpy(cache_logits(
+                args, args.teacher, train_dataloader.dataset.dataset
+                ))
+        student, _, _, metric = train(
+            student_args, i,
+            (with_soft_targets(train_dataloader, logits), val_dataloader),
+            loss_criterion=loss_criterion
+            )
+        if metric > best_metric:
+            best_metric, best_pair = metric, (i, val_dataloader)
+            best_state = {k: v.cpu() for k, v in student.state_dict().items()}
+        del student
+        if args.checkpoint_dir:
+            path = fold_checkpoint_path(student_args, i)
+            if os.path.exists(path):
+                os.remove(path)
+    student = get_model(student_args, device)
+    student.load_state_dict(best_state)
+    index, val_dataloader = best_pair
+    val_inds = val_dataloader.dataset.indices
+    teacher_acc, _, _ = get_con_stats({
+        "true": torch.as_tensor(val_dataloader.dataset.dataset.targets)[
+            val_inds
+            ],
+        "pred": logits[val_inds].argmax(dim=1)
+        })
+    _, stats = val_epoch(student, loss_criterion, val_dataloader, device)
+    student_acc, _, _ = get_con_stats(stats)
+    teacher = torch.load(args.teacher, map_location="cpu", weights_only=False)
+    print("Validation images of fold {}".format(index))
+    print("{:>20} {:>9} {:>13}".format("model", "accuracy", "latency (ms)"))
+    for name, acc, model in (
+            ("teacher", teacher_acc, teacher),
+            (args.student, student_acc, student)):
+        print("{:>20} {:>9.3f} {:>13.1f}".format(
+            name, acc, latency(model, args.dimensions)
+            ))
+    return student.to(device), best_metric
@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset, Subset
+from detector.train_detector.create_dataset import (
+    get_data, cv_index_partitions
+    )
+from detector.train_detector.cnn_model import (
+    get_model, final_layer, set_final_layer
+    )
+from detector.train_detector.model_registry import sha256
+from detector.train_detector.training import get_con_stats, train
+
+
+def load_index(cache_dir: str):
+    """
+    Returns the list of image hashes of the rows of the embedding cache in
+    <cache_dir>, empty if there is no cache.
+
+    :param cache_dir: Folder of the embedding cache.
+    :return: List[str]
+    """
+    path = os.path.join(cache_dir, "keys.txt")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return f.read().split()
+
+
+def preprocessing_key(args: dict, image_data: Dataset):
+    """
+    Returns an identifier of how the images of <image_data> are turned into
+    model inputs: a hash of <args.dimensions>, the dataset's transform and,
+    for a PackedDataset, the size the images were packed at. Cached outputs
+    are kept per key, so changing the resize or crop never serves outputs
+    computed from differently processed images.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param image_data: Dataset of images.
+    :return: str
+    """
+    key = json.dumps({
+        "dimensions": args.dimensions,
+        "transform": repr(image_data.transform),
+        "size": getattr(image_data, "size", None)
+        }, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def backbone(args: dict, device: torch.device):
+    """
+    Returns the pretrained model <args.model_link> with its final fully
+    connected layer (see cnn_model.final_layer) removed, so it outputs the
+    penultimate layer features, and the number of those features.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param device: GPU or CPU to load model onto.
+    :return: torch.Module, int
+    """
+    model = get_model(args, device)
+    num_features = final_layer(model).in_features
+    set_final_layer(model, nn.Identity())
+    return model.eval(), num_features
+
+
+def cache_embeddings(args: dict, device: torch.device):
+    """
+    Runs the pretrained backbone once over the dataset in <args.folder> and
+    stores its penultimate layer features (2048-d for ResNeXt) in the
+    memory-mapped array <args.cache_dir>/<args.model_link>/<preprocessing
+    key>/features.npy, one row per image keyed in keys.txt by the image's
+    key (see image_keys), so backbones with different feature sizes and
+    images processed differently (see preprocessing_key) never share a
+    cache. Images
+    already in the cache are not run again. Returns the memory-mapped
+    features of the dataset images, in dataset order, and their labels.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param device: GPU or CPU to run the backbone on.
+    :return: np.ndarray, np.ndarray
+    """
+    image_data = get_data(args.folder, args.dimensions)
+    cache_dir = os.path.join(
+        args.cache_dir, args.model_link, preprocessing_key(args, image_data)
+        )
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes = image_keys(image_data)
+    labels = np.array(image_data.targets)
+    keys = load_index(cache_dir)
+    rows = {key: i for i, key in enumerate(keys)}
+    missing = [i for i, h in enumerate(hashes) if h not in rows]
+    features_path = os.path.join(cache_dir, "features.npy")
+    if missing:
+        new_missing = list(dict.fromkeys(hashes[i] for i in missing))
+        model, num_features = backbone(args, device)
+        features = np.lib.format.open_memmap(
+            features_path + ".tmp", mode="w+", dtype=np.float32,
+            shape=(len(keys) + len(new_missing), num_features)
+            )
+        if keys:
+            features[:len(keys)] = np.load(features_path, mmap_mode="r")
+        for h in new_missing:
+            rows[h] = len(keys)
+            keys.append(h)
+        loader = DataLoader(
+            Subset(image_data, missing),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers
+            )
+        done = 0
+        with torch.no_grad():
+            for images, _ in loader:
+                out = model(images.to(device)).cpu().numpy()
+                batch = missing[done:done + len(out)]
+                features[[rows[hashes[i]] for i in batch]] = out
+                done += len(out)
+        features.flush()
+        del features, model
+        os.replace(features_path + ".tmp", features_path)
+        with open(os.path.join(cache_dir, "keys.txt"), "w") as f:
+            f.write("\n".join(keys))
+    features = np.load(features_path, mmap_mode="r")
+    return features[[rows[h] for h in hashes]], labels
+
+
+def image_keys(image_data: Dataset):
+    """
+    Returns a key for every image of <image_data>: the hash of its file. A
+    PackedDataset has no files, so the hashes recorded by
+    packed_dataset.pack_dataset are used, and the same image gets the same
+    key whether it is packed or not, or packed again. Raises ValueError for
+    a dataset packed before hashes were recorded, which must be packed
+    again, as keying by position would return cached values of other images
+    once the data changes.
+
+    :param image_data: Dataset of images.
+    :return: List[str]
+    """
+    if hasattr(image_data, "samples"):
+        return [sha256(path) for path, _ in image_data.samples]
+    if getattr(image_data, "hashes", None) is None:
+        raise ValueError(
+            "Images of {} have no hashes to key the cache by, pack the "
+            "dataset again".format(type(image_data).__name__)
+            )
+    return list(image_data.hashes)
+
+
+def cache_logits(args: dict, model_path: str, image_data: Dataset):
+    """
+    Returns the logits of the model saved at <model_path> for every image of
+    <image_data>, in dataset order. Logits are cached per image in
+    <args.cache_dir>/logits/<model hash>/<preprocessing key>/, so only
+    images the model has not seen are run, in one batched pass without
+    gradients, and a retrained model or a change of the image preprocessing
+    (see preprocessing_key) gets a cache of its own.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param model_path: Path of a model saved with torch.save.
+    :param image_data: Dataset of images.
+    :return: np.ndarray
+    """
+    cache_dir = os.path.join(
+        args.cache_dir, "logits", sha256(model_path),
+        preprocessing_key(args, image_data)
+        )
+    os.makedirs(cache_dir, exist_ok=True)
+    logits_path = os.path.join(cache_dir, "logits.npy")
+    keys = load_index(cache_dir)
+    logits = np.load(logits_path) if keys else None
+    rows = {key: i for i, key in enumerate(keys)}
+    hashes = image_keys(image_data)
+    missing = [i for i, h in enumerate(hashes) if h not in rows]
+    if missing:
+        device = torch.device('cuda') if args.gpu else torch.device('cpu')
+        model = torch.load(
+            model_path, map_location=device, weights_only=False
+            )
+        model.eval()
+        loader = DataLoader(
+            Subset(image_data, missing),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers
+            )
+        with torch.inference_mode():
+            new = np.concatenate([
+                model(images.to(device)).float().cpu().numpy()
+                for images, _ in loader
+                ])
+        for i in missing:
+            if hashes[i] not in rows:
+                rows[hashes[i]] = len(keys)
+                keys.append(hashes[i])
+        grown = np.zeros((len(keys), new.shape[1]), dtype=np.float32)
+        if logits is not None:
+            grown[:len(logits)] = logits
+        grown[[rows[hashes[i]] for i in missing]] = new
+        logits = grown
+        np.save(logits_path + ".tmp.npy", logits)
+        os.replace(logits_path + ".tmp.npy", logits_path)
+        with open(os.path.join(cache_dir, "keys.txt"), "w") as f:
+            f.write("\n".join(keys))
+    return logits[[rows[h] for h in hashes]]
+
+
+def train_head(args: dict, lr: float, features: torch.Tensor,
+               labels: torch.Tensor, train_inds: np.ndarray,
+               val_inds: np.ndarray):
+    """
+    Trains a new fully connected head on the cached <features> of the
+    training indices <train_inds> at the learning rate <lr> and returns it
+    with its validation accuracy on <val_inds>.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param lr: Learning rate.
+    :param features: Cached backbone features of every image.
+    :param labels: Labels of every image.
+    :param train_inds: Indices of the training images.
+    :param val_inds: Indices of the validation images.
+    :return: torch.nn.Linear, float
+    """
+    head = nn.Linear(features.shape[1], args.num_classes)
+    loss_criterion = nn.CrossEntropyLoss(weight=args.label_weights)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr)
+    x, y = features[train_inds], labels[train_inds]
+    for _ in range(args.head_epochs):
+        permutation = torch.randperm(len(x))
+        for start in range(0, len(x), args.batch_size):
+            batch = permutation[start:start + args.batch_size]
+            optimizer.zero_grad()
+            loss = loss_criterion(head(x[batch]), y[batch])
+            loss.backward()
+            optimizer.step()
+    with torch.no_grad():
+        predicted = head(features[val_inds]).argmax(dim=1)
+    acc, _, _ = get_con_stats({
+        "true": labels[val_inds], "pred": predicted
+        })
+    return head, acc
+
+
+def best_cv_head_training(args: dict):
+    """
+    Head-only alternative to training.best_cv_training. The backbone features
+    are computed once (see cache_embeddings), then for each of the <args.s>
+    folds a new head is trained on them at the fold's learning rate. Returns
+    the pretrained backbone with the best head attached, and its validation
+    accuracy. If <args.finetune> is True, the whole network is then fine-tuned
+    at the best learning rate by training.train.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: torch.Module, float
+    """
+    assert len(args.learning_rates) == args.s, (
+        "learning_rates should be of size s"
+        )
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    features, labels = cache_embeddings(args, device)
+    features = torch.from_numpy(np.ascontiguousarray(features))
+    labels = torch.from_numpy(labels)
+    partitions = list(cv_index_partitions(len(labels), args.s))
+    best_acc, best_head, best_index = -1, None, 0
+    for i, (train_inds, val_inds) in enumerate(partitions):
+        head, acc = train_head(
+            args, args.learning_rates[i], features, labels, train_inds,
+            val_inds
+            )
+        print("Learning Rate Index: {} Validation Accuracy: {:0.2f}".format(
+            i, acc
+            ))
+        if acc > best_acc:
+            best_acc, best_head, best_index = acc, head, i
+    if args.finetune:
+        image_data = get_data(args.folder, args.dimensions)
+        train_inds, val_inds = partitions[best_index]
+        dataloaders = (
+            DataLoader(
+                Subset(image_data, train_inds), batch_size=args.batch_size,
+                shuffle=True, num_workers=args.num_workers
+                ),
+            DataLoader(
+                Subset(image_data, val_inds), batch_size=args.batch_size,
+                num_workers=args.num_workers
+                )
+            )
+        model, _, _, best_acc = train(
+            args, best_index, dataloaders, fc=best_head
+            )
+        return model, best_acc
+    model, _ = backbone(args, device)
+    set_final_layer(model, best_head.to(device))
+    return model, best_acc
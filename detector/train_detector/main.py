@@ -1,5 +1,9 @@
 import warnings
 from detector.train_detector.training import best_cv_training
+from detector.train_detector.embedding_cache import best_cv_head_training
+from detector.train_detector.parallel_cv import parallel_cv_training
+from detector.train_detector.search import successive_halving
+from detector.train_detector.distill import distill_cv_training
 import torch
 
 
@@ -13,7 +17,17 @@ class ArgsDict(dict):
 
 
 def train(args: dict, save=False):
-    model, acc = best_cv_training(args)
+    if args.search:
+        model, acc, config = successive_halving(args)
+        print('Best Configuration:', config)
+    elif args.distill:
+        model, acc = distill_cv_training(args)
+    elif args.head_only:
+        model, acc = best_cv_head_training(args)
+    elif args.fold_processes > 1:
+        model, acc = parallel_cv_training(args)
+    else:
+        model, acc = best_cv_training(args)
     if save:
         torch.save(model, args.save_as)
     print('Best Accuracy:', acc)
@@ -35,6 +49,38 @@ if __name__ == "__main__":
         "label_weights": None,
         "seed": 6802,
         "num_classes": 2,
-        "save_as": "og_model.pt"
+        "save_as": "og_model.pt",
+        "head_only": False,  # train only a new fc head on cached features
+        "cache_dir": "detector/embeddings/",
+        "head_epochs": 200,
+        "finetune": False,  # fine-tune fully at the best head's learning rate
+        "fold_processes": 1,  # folds trained at once, each in its own process
+        "fold_threads": None,  # threads per fold process, None to split evenly
+        "weights_dir": "detector/weights/",  # cached pretrained weights
+        "offline": False,  # never download weights, e.g. on air-gapped boxes
+        "channels_last": False,  # channels_last memory format
+        "bf16": False,  # bfloat16 autocast, fast on recent CPUs
+        "compile": False,  # torch.compile the model
+        "accumulation": 1,  # batches per optimizer step
+        "num_threads": None,  # torch intra-op threads, None for default
+        "patience": 5,  # epochs without val loss improvement, None to disable
+        "checkpoint_dir": "detector/checkpoints/",  # None to disable
+        "resume": False,  # continue the sweep saved in checkpoint_dir
+        "search": False,  # successive halving instead of one lr per fold
+        # at the defaults the search costs at most 210 fold-epochs, 150 of
+        # them training the winner for <epochs> on every fold, against 150
+        # for the lr sweep, see search.search_epochs
+        "search_configs": 9,  # random configurations to start from
+        "search_eta": 3,  # keep the best 1/eta, give them eta times the epochs
+        "search_min_epochs": 1,  # epochs of the first rung
+        "lr_range": [1e-6, 1e-3],
+        "wd_range": [1e-4, 1e-1],
+        "batch_sizes": [16, 32],
+        "log_dir": "detector/logs/",  # JSON-lines run logs, None to disable
+        "distill": False,  # train <student> on the soft labels of <teacher>
+        "teacher": "og_model.pt",  # model saved by a previous run
+        "student": "mobilenet_v3_large",  # or resnet18, mobilenet_v3_small
+        "temperature": 4.0,  # softmax temperature of the soft labels
+        "distill_alpha": 0.9  # weight of the soft labels in the loss
         }
     args.update(args_dict)
@@ -0,0 +1,104 @@
+import copy
+import hashlib
+import os
+import torch
+from torchvision import models
+
+
+# torchvision ImageNet weights; the hash is the prefix of the file's SHA-256
+# that torchvision embeds in the file name
+REGISTRY = {
+    "resnext101_32x8d": (
+        "https://download.pytorch.org/models/resnext101_32x8d-8ba56ff5.pth",
+        "8ba56ff5"
+        ),
+    "resnext50_32x4d": (
+        "https://download.pytorch.org/models/resnext50_32x4d-7cdf4587.pth",
+        "7cdf4587"
+        ),
+    "resnet50": (
+        "https://download.pytorch.org/models/resnet50-0676ba61.pth",
+        "0676ba61"
+        ),
+    "resnet18": (
+        "https://download.pytorch.org/models/resnet18-f37072fd.pth",
+        "f37072fd"
+        ),
+    "mobilenet_v3_large": (
+        "https://download.pytorch.org/models/mobilenet_v3_large-8738ca79.pth",
+        "8738ca79"
+        ),
+    "mobilenet_v3_small": (
+        "https://download.pytorch.org/models/mobilenet_v3_small-047dcff4.pth",
+        "047dcff4"
+        )
+    }
+
+_loaded = {}  # backbone name -> pretrained model, loaded once per process
+
+
+def sha256(path: str):
+    """
+    Returns the SHA-256 hex digest of the file at <path>.
+
+    :param path: Path of file.
+    :return: str
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def weights_path(name: str, weights_dir: str, offline=False):
+    """
+    Returns the path of the pretrained weights of the backbone <name> in
+    <weights_dir>, downloading them first if they are missing, unless
+    <offline> is True. Raises ValueError if the checksum of the file does not
+    match the registry, and FileNotFoundError if the weights are missing in
+    offline mode.
+
+    :param name: Backbone name, a key of REGISTRY.
+    :param weights_dir: Folder of cached weight files.
+    :param offline: Whether the network may not be used.
+    :return: str
+    """
+    if name not in REGISTRY:
+        raise ValueError("Unknown backbone {}. Available: {}".format(
+            name, ", ".join(REGISTRY)
+            ))
+    url, hash_prefix = REGISTRY[name]
+    path = os.path.join(weights_dir, os.path.basename(url))
+    if not os.path.exists(path):
+        if offline:
+            raise FileNotFoundError(
+                "Weights for {} not found at {} and offline mode is on. Copy "
+                "{} there first.".format(name, path, url)
+                )
+        os.makedirs(weights_dir, exist_ok=True)
+        torch.hub.download_url_to_file(url, path, hash_prefix=hash_prefix)
+    elif not sha256(path).startswith(hash_prefix):
+        raise ValueError("Checksum mismatch for {}".format(path))
+    return path
+
+
+def pretrained(name: str, weights_dir: str, offline=False):
+    """
+    Returns a copy of the ImageNet pretrained backbone <name>. The weights
+    are read from disk the first time a backbone is requested in a process,
+    and later calls deep-copy the model already in memory.
+
+    :param name: Backbone name, a key of REGISTRY.
+    :param weights_dir: Folder of cached weight files.
+    :param offline: Whether the network may not be used.
+    :return: torch.Module
+    """
+    if name not in _loaded:
+        model = getattr(models, name)()
+        state = torch.load(
+            weights_path(name, weights_dir, offline), map_location="cpu"
+            )
+        model.load_state_dict(state)
+        _loaded[name] = model
+    return copy.deepcopy(_loaded[name])
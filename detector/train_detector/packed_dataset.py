@@ -0,0 +1,176 @@
+import json
+import os
+import numpy as np
+import torch
+from torchvision import transforms
+from torch.utils.data import Dataset, DataLoader
+from detector.train_detector.model_registry import sha256
+
+
+INDEX_NAME = "packed_index.json"
+
+
+def pack_dataset(image_data: Dataset, out_dir: str, size=256,
+                 shard_size=4096, num_workers=4):
+    """
+    Decodes every image of <image_data> once, resizes and center crops it to
+    <size> x <size>, and writes the uint8 pixels into memory-mapped shards
+    <out_dir>/shard_<i>.npy of at most <shard_size> images each. The labels,
+    classes, shard sizes and the hash of every image file are written to
+    <out_dir>/packed_index.json.
+    Decoding runs in <num_workers> DataLoader workers.
+
+    :param image_data: datasets.ImageFolder or ManifestDataset to pack. Its
+            transform is replaced.
+    :param out_dir: Folder the packed dataset is written to.
+    :param size: Height/width of the stored images.
+    :param shard_size: Maximum number of images per shard.
+    :param num_workers: Number of processes decoding images.
+    :return: None
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    hashes = [sha256(path) for path, _ in image_data.samples]
+    image_data.transform = transforms.Compose([
+        transforms.Resize(size),
+        transforms.CenterCrop(size),
+        transforms.PILToTensor()
+        ])
+    n = len(image_data)
+    shards = [min(shard_size, n - start) for start in range(0, n, shard_size)]
+    loader = DataLoader(
+        image_data, batch_size=64, num_workers=num_workers
+        )
+    shard, shard_index, offset = None, -1, 0
+    for images, _ in loader:
+        for image in images.numpy():
+            if shard is None or offset == len(shard):
+                if shard is not None:
+                    shard.flush()
+                shard_index += 1
+                shard = np.lib.format.open_memmap(
+                    os.path.join(out_dir, "shard_{}.npy".format(shard_index)),
+                    mode="w+", dtype=np.uint8,
+                    shape=(shards[shard_index], 3, size, size)
+                    )
+                offset = 0
+            shard[offset] = image
+            offset += 1
+    if shard is not None:
+        shard.flush()
+    index = {
+        "size": size,
+        "classes": image_data.classes,
+        "targets": [int(t) for t in image_data.targets],
+        "shards": shards,
+        "hashes": hashes
+        }
+    with open(os.path.join(out_dir, INDEX_NAME), "w") as f:
+        json.dump(index, f)
+
+
+def is_packed(folder: str):
+    """
+    Returns True if <folder> holds a dataset written by pack_dataset.
+
+    :param folder: Local path to data.
+    :return: bool
+    """
+    return os.path.isfile(os.path.join(folder, INDEX_NAME))
+
+
+class PackedDataset(Dataset):
+    """
+    Dataset of the images written by pack_dataset. Shards are memory-mapped,
+    so an image is read straight from the page cache without decoding, and
+    only <transform> (crop, normalize, augment) runs per item. Like
+    datasets.ImageFolder each item is an (image, class index) tuple.
+
+    folder - str: Folder of the packed dataset.
+    classes - list[str]: Sorted label names.
+    targets - list[int]: Class index of each image.
+    hashes - list[str]: SHA-256 hex digest of the file each image was packed
+            from, or None for datasets packed before hashes were recorded.
+    size - int: Height/width the images were resized and cropped to.
+    transform - callable: Transform applied to each uint8 image tensor.
+    """
+    def __init__(self, folder: str, transform=None):
+        """
+        :param folder: Folder of the packed dataset.
+        :param transform: Transform applied to each uint8 (3, size, size)
+                image tensor.
+        """
+        with open(os.path.join(folder, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.folder = folder
+        self.classes = index["classes"]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.targets = index["targets"]
+        self.hashes = index.get("hashes")
+        self.size = index["size"]
+        self.transform = transform
+        self._starts = np.cumsum([0] + index["shards"])
+        self._shards = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getstate__(self):
+        # memory maps are reopened in each DataLoader worker, not pickled
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def __getitem__(self, index: int):
+        if self._shards is None:
+            self._shards = [
+                np.load(
+                    os.path.join(self.folder, "shard_{}.npy".format(i)),
+                    mmap_mode="r"
+                    )
+                for i in range(len(self._starts) - 1)
+                ]
+        shard = int(np.searchsorted(self._starts, index, side="right")) - 1
+        image = torch.from_numpy(
+            np.array(self._shards[shard][index - self._starts[shard]])
+            )
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+
+def packed_transform(dimensions: int):
+    """
+    Returns the transforms of create_dataset.get_data for images already
+    resized by pack_dataset: center crop to <dimensions> and normalize.
+
+    :param dimensions: Dimensions to crop the height/width of images to.
+    :return: transforms.Compose
+    """
+    return transforms.Compose([
+        transforms.CenterCrop(dimensions),
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize(
+            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+            )
+        ])
+
+
+if __name__ == "__main__":
+    import argparse
+    from detector.train_detector.create_dataset import get_data
+    parser = argparse.ArgumentParser(
+        description="Pack an image folder or manifest into uint8 shards."
+        )
+    parser.add_argument("folder")
+    parser.add_argument("out_dir")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--split", default="train",
+                        help="manifest split to pack")
+    cli_args = parser.parse_args()
+    pack_dataset(
+        get_data(cli_args.folder, cli_args.size, split=cli_args.split),
+        cli_args.out_dir,
+        cli_args.size, cli_args.shard_size, cli_args.num_workers
+        )
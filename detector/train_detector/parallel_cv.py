@@ -0,0 +1,164 @@
+import os
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from torch.utils.data import Dataset, DataLoader, Subset
+from torchvision import transforms
+from detector.train_detector.create_dataset import (
+    get_data, cv_index_partitions
+    )
+from detector.train_detector.cnn_model import get_model
+from detector.train_detector.packed_dataset import (
+    is_packed, packed_transform, PackedDataset
+    )
+from detector.train_detector.training import train, fold_checkpoint_path
+
+
+class SharedImages(Dataset):
+    """
+    Dataset of images decoded once into a single uint8 tensor in shared
+    memory. Passing it to another process shares the tensor rather than
+    copying it, so every fold process reads the same decoded pixels.
+
+    images - torch.Tensor: uint8 tensor of shape (n, 3, size, size) in
+            shared memory.
+    targets - list[int]: Class index of each image.
+    classes - list[str]: Sorted label names.
+    transform - callable: Transform applied to each uint8 image tensor.
+    """
+    def __init__(self, images: torch.Tensor, targets: list, classes: list,
+                 transform=None):
+        self.images = images
+        self.targets = targets
+        self.classes = classes
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index: int):
+        image = self.images[index]
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+
+def decode_shared(args: dict, size=256):
+    """
+    Decodes the dataset in <args.folder> once, resized and center cropped to
+    <size> x <size>, into a SharedImages dataset. A folder written by
+    packed_dataset.pack_dataset is returned as a PackedDataset instead, since
+    its memory-mapped shards are already shared through the page cache.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param size: Height/width of the decoded images.
+    :return: SharedImages or PackedDataset
+    """
+    if is_packed(args.folder):
+        return PackedDataset(
+            args.folder, transform=packed_transform(args.dimensions)
+            )
+    image_data = get_data(args.folder, args.dimensions)
+    image_data.transform = transforms.Compose([
+        transforms.Resize(size),
+        transforms.CenterCrop(size),
+        transforms.PILToTensor()
+        ])
+    images = torch.empty((len(image_data), 3, size, size), dtype=torch.uint8)
+    loader = DataLoader(
+        image_data, batch_size=64, num_workers=args.num_workers
+        )
+    start = 0
+    for batch, _ in loader:
+        images[start:start + len(batch)] = batch
+        start += len(batch)
+    return SharedImages(
+        images.share_memory_(), list(image_data.targets), image_data.classes,
+        transform=packed_transform(args.dimensions)
+        )
+
+
+def run_fold(args: dict, index: int, image_data: Dataset,
+             train_inds: np.ndarray, val_inds: np.ndarray, threads: int):
+    """
+    Trains fold <index> with at most <threads> intra-op threads and returns
+    the index, its validation metric and the trained weights on the CPU. Runs
+    in a fold process. train is given a copy of <args> whose num_threads is
+    <threads>, so it keeps to the process's share of the CPU.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param index: Index of the fold and of its learning rate.
+    :param image_data: Dataset shared by all folds.
+    :param train_inds: Indices of the training images.
+    :param val_inds: Indices of the validation images.
+    :param threads: Number of threads torch may use in this process.
+    :return: int, float, dict
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(args.seed + index)
+    dataloaders = (
+        DataLoader(
+            Subset(image_data, train_inds),
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=args.num_workers
+            ),
+        DataLoader(
+            Subset(image_data, val_inds),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers
+            )
+        )
+    fold_args = type(args)(args, num_threads=threads)
+    model, _, _, metric = train(fold_args, index, dataloaders)
+    state = {k: v.cpu() for k, v in model.state_dict().items()}
+    if args.checkpoint_dir:
+        path = fold_checkpoint_path(args, index)
+        if os.path.exists(path):
+            os.remove(path)
+    return index, metric, state
+
+
+def parallel_cv_training(args: dict):
+    """
+    Runs the same S-fold cross validation as training.best_cv_training, but
+    trains up to <args.fold_processes> folds at once, each in its own
+    process limited to <args.fold_threads> threads (by default the CPU
+    count divided evenly between the processes). The dataset is decoded
+    once and shared by all folds. Results are reported as folds finish, and
+    the model with the highest validation metric is returned with that
+    metric.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: torch.Module, float
+    """
+    assert len(args.learning_rates) == args.s, (
+        "learning_rates should be of size s"
+        )
+    np.random.seed(args.seed)
+    image_data = decode_shared(args)
+    partitions = list(cv_index_partitions(len(image_data), args.s))
+    processes = min(args.fold_processes, args.s)
+    threads = args.fold_threads or max(1, (os.cpu_count() or 1) // processes)
+    best_metric, best_state = -1, None
+    with ProcessPoolExecutor(
+            max_workers=processes, mp_context=mp.get_context("spawn")
+            ) as pool:
+        futures = [
+            pool.submit(
+                run_fold, args, i, image_data, train_inds, val_inds, threads
+                )
+            for i, (train_inds, val_inds) in enumerate(partitions)
+            ]
+        for future in as_completed(futures):
+            index, metric, state = future.result()
+            print("Fold {} finished, Validation Metric: {:0.2f}".format(
+                index, metric
+                ))
+            if metric > best_metric:
+                best_metric, best_state = metric, state
+    device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    model = get_model(args, device)
+    model.load_state_dict(best_state)
+    return model, best_metric
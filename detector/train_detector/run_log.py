@@ -0,0 +1,223 @@
+import json
+import os
+import resource
+import sys
+import time
+import torch
+
+
+PHASES = ("data_wait", "to_device", "forward", "backward", "step")
+
+
+class StepTimer:
+    """
+    Accumulates the time training steps spend in each phase of PHASES over
+    an epoch. On a GPU the device is synchronized at every phase boundary so
+    that the time of each phase is attributed to it rather than to the next
+    synchronizing call, which slows training down a little. A disabled timer
+    does nothing, so train_epoch can always call it.
+
+    device - torch.device: Device the model is trained on.
+    enabled - bool: Whether timings are recorded.
+    totals - dict: Seconds spent in each phase.
+    steps - int: Number of completed steps.
+    images - int: Number of images trained on.
+    starved_steps - int: Steps, after the first, that waited longer for
+            their batch than they spent computing on it.
+    """
+    def __init__(self, device: torch.device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.totals = dict.fromkeys(PHASES, 0.0)
+        self.steps = 0
+        self.images = 0
+        self.starved_steps = 0
+        self._last = None
+        self._wait = 0.0
+        self._computing = None
+        self._start = None
+
+    def start(self):
+        """
+        Starts timing, before the first batch is requested.
+
+        :return: None
+        """
+        if self.enabled:
+            self._start = self._last = time.perf_counter()
+
+    def lap(self, phase: str):
+        """
+        Adds the time since the previous lap to <phase>.
+
+        :param phase: One of PHASES.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.totals[phase] += now - self._last
+        if phase == "data_wait":
+            self._wait, self._computing = now - self._last, now
+        self._last = now
+
+    def end_step(self, batch_size: int):
+        """
+        Ends a step of <batch_size> images.
+
+        :param batch_size: Number of images in the step's batch.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        if self.steps > 0 and self._wait > self._last - self._computing:
+            self.starved_steps += 1
+        self.steps += 1
+        self.images += batch_size
+
+    def summary(self):
+        """
+        Returns the epoch's phase timings, images/sec and starvation as a
+        JSON serializable dictionary.
+
+        :return: dict
+        """
+        total = time.perf_counter() - self._start
+        return {
+            "seconds": total,
+            "steps": self.steps,
+            "images": self.images,
+            "images_per_sec": self.images / total if total else 0.0,
+            "phases": dict(self.totals),
+            "data_wait_fraction": self.totals["data_wait"] / total
+            if total else 0.0,
+            "starved_steps": self.starved_steps
+            }
+
+
+def peak_memory(device: torch.device):
+    """
+    Returns the peak resident set size of this process and, when training on
+    a GPU, the peak CUDA memory allocated since the last reset, in MB.
+
+    :param device: Device the model is trained on.
+    :return: dict
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    rss /= 1024 ** 2 if sys.platform == "darwin" else 1024
+    memory = {"peak_rss_mb": rss}
+    if device.type == "cuda":
+        memory["peak_cuda_mb"] = (
+            torch.cuda.max_memory_allocated(device) / 1024 ** 2
+            )
+    return memory
+
+
+class RunLog:
+    """
+    JSON-lines log of one training run. Every record is a JSON object on its
+    own line with the time it was written and an event name, so runs can be
+    compared with any JSON tool.
+
+    path - str: Path of the log file, or None to log nothing.
+    epochs - list[dict]: Epoch records written so far.
+    """
+    def __init__(self, log_dir: str, name: str):
+        self.path = None
+        self.epochs = []
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self.path = os.path.join(log_dir, "{}_{}.jsonl".format(
+                time.strftime("%Y%m%d-%H%M%S"), name
+                ))
+
+    def write(self, event: str, **fields):
+        """
+        Appends a record of <event> with <fields> to the log.
+
+        :param event: Name of the event, e.g. "epoch".
+        :param fields: JSON serializable values of the record.
+        :return: None
+        """
+        if event == "epoch":
+            self.epochs.append(fields)
+        if self.path is None:
+            return
+        record = {"time": time.time(), "event": event}
+        record.update(fields)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        """
+        Returns the totals of the epochs logged so far: images/sec, the
+        share of training time spent in each phase, starved steps, peak
+        memory and the likely bottleneck. The bottleneck is "data loading"
+        when at least a fifth of the time is spent waiting for batches (try
+        more num_workers), "host to device copies" when those take longer
+        than the forward pass (try pinned memory or larger batches), and
+        "model" otherwise.
+
+        :return: dict
+        """
+        seconds = sum(e["train"]["seconds"] for e in self.epochs)
+        phases = {
+            p: sum(e["train"]["phases"][p] for e in self.epochs)
+            for p in PHASES
+            }
+        images = sum(e["train"]["images"] for e in self.epochs)
+        if seconds and phases["data_wait"] / seconds >= 0.2:
+            bottleneck = "data loading"
+        elif phases["to_device"] > phases["forward"]:
+            bottleneck = "host to device copies"
+        else:
+            bottleneck = "model"
+        summary = {
+            "epochs": len(self.epochs),
+            "images_per_sec": images / seconds if seconds else 0.0,
+            "phase_fractions": {
+                p: t / seconds if seconds else 0.0 for p, t in phases.items()
+                },
+            "starved_steps": sum(
+                e["train"]["starved_steps"] for e in self.epochs
+                ),
+            "steps": sum(e["train"]["steps"] for e in self.epochs),
+            "bottleneck": bottleneck
+            }
+        for key in ("peak_rss_mb", "peak_cuda_mb"):
+            values = [e["memory"][key] for e in self.epochs
+                      if key in e["memory"]]
+            if values:
+                summary[key] = max(values)
+        return summary
+
+
+def print_run_summary(summary: dict):
+    """
+    Prints the summary returned by RunLog.summary.
+
+    :param summary: Run summary.
+    :return: None
+    """
+    update = (
+        "Epochs: {}\n"
+        "Images/sec: {:0.1f}\n"
+        "Time Share: {}\n"
+        "Starved Steps: {}/{}\n"
+        "Peak RSS: {:0.0f} MB\n"
+        ).format(
+            summary["epochs"], summary["images_per_sec"],
+            ", ".join("{} {:0.0%}".format(p, f)
+                      for p, f in summary["phase_fractions"].items()),
+            summary["starved_steps"], summary["steps"],
+            summary.get("peak_rss_mb", 0)
+            )
+    if "peak_cuda_mb" in summary:
+        update += "Peak CUDA Memory: {:0.0f} MB\n".format(
+            summary["peak_cuda_mb"]
+            )
+    update += "Bottleneck: {}\n".format(summary["bottleneck"])
+    print(update)
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset, Subset
+from detector.train_detector.create_dataset import (
+    get_data, cv_index_partitions
+    )
+from detector.train_detector.cnn_model import get_model
+from detector.train_detector.checkpoint import save_checkpoint, load_checkpoint
+from detector.train_detector.training import (
+    train_epoch, val_epoch, get_con_stats
+    )
+
+
+def sample_configs(args: dict, rng: np.random.Generator):
+    """
+    Returns <args.search_configs> random hyperparameter configurations, each
+    a dictionary with a learning rate and weight decay drawn log-uniformly
+    from <args.lr_range> and <args.wd_range>, and a batch size drawn from
+    <args.batch_sizes>.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param rng: Random number generator.
+    :return: List[dict]
+    """
+    def log_uniform(low, high):
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    return [
+        {
+            "lr": log_uniform(*args.lr_range),
+            "weight_decay": log_uniform(*args.wd_range),
+            "batch_size": int(rng.choice(args.batch_sizes))
+            }
+        for _ in range(args.search_configs)
+        ]
+
+
+def run_id(args: dict, configs: list):
+    """
+    Returns an identifier of the search over <configs>: a hash of the
+    configurations and of the settings that determine what is trained, so
+    that the state of one search is never resumed by a different one.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param configs: Hyperparameter configurations returned by
+            sample_configs.
+    :return: str
+    """
+    key = json.dumps({
+        "configs": configs, "seed": args.seed, "model": args.model_link,
+        "folder": args.folder, "dimensions": args.dimensions, "s": args.s
+        }, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def search_epochs(args: dict):
+    """
+    Returns the number of fold-epochs, epochs trained on one fold, the
+    successive halving schedule of <args> costs at most. The learning rate
+    sweep of training.best_cv_training costs at most <args.s> *
+    <args.epochs>.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: int
+    """
+    alive, trained, total = args.search_configs, 0, 0
+    budget = min(args.search_min_epochs, args.epochs)
+    while True:
+        total += alive * args.s * (budget - trained)
+        if budget >= args.epochs:
+            return total
+        alive = max(1, alive // args.search_eta)
+        trained, budget = budget, next_budget(args, budget, alive)
+
+
+def next_budget(args: dict, budget: int, alive: int):
+    """
+    Returns the epoch budget of the rung after one of <budget> epochs, once
+    <alive> configurations are left: <args.search_eta> times <budget>,
+    capped at <args.epochs>, or <args.epochs> for the last configuration
+    left, so that the winner is always trained as long as a fold of
+    training.best_cv_training.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param budget: Epoch budget of the current rung.
+    :param alive: Number of configurations left for the next rung.
+    :return: int
+    """
+    if alive == 1:
+        return args.epochs
+    return min(args.epochs, budget * args.search_eta)
+
+
+def state_path(args: dict, run: str, config_index: int, fold: int):
+    """
+    Returns the path where the training state of configuration
+    <config_index> on fold <fold> of the search <run> is kept between rungs.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param run: Identifier of the search returned by run_id.
+    :param config_index: Index of the configuration.
+    :param fold: Index of the fold.
+    :return: str
+    """
+    return os.path.join(
+        args.checkpoint_dir, "search", run, "config{}_fold{}.pt".format(
+            config_index, fold
+            )
+        )
+
+
+def advance(args: dict, run: str, config_index: int, config: dict,
+            fold: int, indices: tuple, image_data: Dataset, epochs: int,
+            device: torch.device):
+    """
+    Trains configuration <config_index> on fold <fold> until it has been
+    trained for <epochs> epochs in total, continuing from the state saved at
+    its previous rung of the search <run>, and returns its validation
+    accuracy. The new state is saved to disk, with its number of epochs, so
+    that only one model is in memory at a time and an interrupted search
+    resumes without training any epoch twice.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param run: Identifier of the search returned by run_id.
+    :param config_index: Index of the configuration.
+    :param config: Hyperparameter configuration.
+    :param fold: Index of the fold.
+    :param indices: Training and validation indices of the fold.
+    :param image_data: Dataset shared by all folds.
+    :param epochs: Total number of epochs to have trained for.
+    :param device: GPU or CPU for training.
+    :return: float
+    """
+    train_inds, val_inds = indices
+    model = get_model(args, device)
+    optimizer = torch.optim.AdamW(
+        model.parameters(), lr=config["lr"],
+        weight_decay=config["weight_decay"]
+        )
+    path = state_path(args, run, config_index, fold)
+    trained = 0
+    if os.path.exists(path):
+        state = load_checkpoint(path)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        trained = state["epochs"]
+    if args.label_weights is None:
+        label_weights = None
+    else:
+        label_weights = args.label_weights.to(device)
+    loss_criterion = nn.CrossEntropyLoss(weight=label_weights)
+    train_dataloader = DataLoader(
+        Subset(image_data, train_inds),
+        batch_size=config["batch_size"],
+        shuffle=True,
+        num_workers=args.num_workers
+        )
+    val_dataloader = DataLoader(
+        Subset(image_data, val_inds),
+        batch_size=config["batch_size"],
+        num_workers=args.num_workers
+        )
+    for _ in range(epochs - trained):
+        train_epoch(
+            model, loss_criterion, optimizer, train_dataloader, device
+            )
+    _, stats = val_epoch(model, loss_criterion, val_dataloader, device)
+    save_checkpoint(path, {
+        "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+        "epochs": max(epochs, trained)
+        })
+    acc, _, _ = get_con_stats(stats)
+    return acc
+
+
+def successive_halving(args: dict):
+    """
+    Searches <args.search_configs> random configurations of learning rate,
+    weight decay and batch size by successive halving, replacing the one
+    learning rate per fold of training.best_cv_training. Every live
+    configuration is trained on all <args.s> folds for the rung's epoch
+    budget and scored by its mean validation accuracy over the folds. Only
+    the best 1/<args.search_eta> of them continue, with <args.search_eta>
+    times the budget, starting at <args.search_min_epochs> epochs and capped
+    at <args.epochs>; the last configuration left is trained to
+    <args.epochs>, see next_budget. Training resumes from the previous rung
+    rather than restarting. The states are kept under a directory of
+    <args.checkpoint_dir> named by run_id, so with <args.resume> a search
+    interrupted by a crash continues where it stopped, while otherwise any
+    state left by an earlier run of the same search is cleared. Returns the
+    best fold model of the winning configuration, its mean accuracy and the
+    configuration.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :return: torch.Module, float, dict
+    """
+    assert args.checkpoint_dir, "successive halving requires checkpoint_dir"
+    np.random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    image_data = get_data(args.folder, args.dimensions)
+    partitions = list(cv_index_partitions(len(image_data), args.s))
+    configs = sample_configs(args, rng)
+    run = run_id(args, configs)
+    run_dir = os.path.dirname(state_path(args, run, 0, 0))
+    if not args.resume and os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    print("Search {} costs at most {} fold-epochs, the learning rate sweep "
+          "{}".format(run, search_epochs(args), args.s * args.epochs))
+    # fold accuracies of every rung scored so far, to resume without
+    # retraining the configurations pruned before the search was interrupted
+    rungs_path = os.path.join(run_dir, "rungs.json")
+    rungs = {}
+    if os.path.exists(rungs_path):
+        with open(rungs_path) as f:
+            rungs = json.load(f)
+    alive = list(range(len(configs)))
+    fold_accs = {}
+    budget = min(args.search_min_epochs, args.epochs)
+    while True:
+        rung = rungs.setdefault(str(budget), {})
+        for c in alive:
+            if str(c) not in rung:
+                rung[str(c)] = [
+                    advance(
+                        args, run, c, configs[c], fold, indices, image_data,
+                        budget, device
+                        )
+                    for fold, indices in enumerate(partitions)
+                    ]
+                with open(rungs_path, "w") as f:
+                    json.dump(rungs, f)
+            fold_accs[c] = rung[str(c)]
+            print("Config {} {} Epochs: {} Mean Accuracy: {:0.3f}".format(
+                c, configs[c], budget, np.mean(fold_accs[c])
+                ))
+        alive.sort(key=lambda c: np.mean(fold_accs[c]), reverse=True)
+        if budget >= args.epochs:
+            break
+        keep = max(1, len(alive) // args.search_eta)
+        for c in alive[keep:]:
+            for fold in range(args.s):
+                path = state_path(args, run, c, fold)
+                if os.path.exists(path):
+                    os.remove(path)
+        alive = alive[:keep]
+        budget = next_budget(args, budget, len(alive))
+    best = alive[0]
+    best_fold = int(np.argmax(fold_accs[best]))
+    model = get_model(args, device)
+    model.load_state_dict(
+        load_checkpoint(state_path(args, run, best, best_fold))["model"]
+        )
+    shutil.rmtree(run_dir)
+    return model, float(np.mean(fold_accs[best])), configs[best]
@@ -1,9 +1,16 @@
 import torch
 import torch.nn as nn
 from detector.train_detector.create_dataset import get_dataloaders
-from detector.train_detector.cnn_model import get_model
-from sklearn.metrics import confusion_matrix
+from detector.train_detector.cnn_model import get_model, final_layer
+from detector.train_detector.checkpoint import (
+    save_checkpoint, load_checkpoint, save_json, load_json, get_rng_state,
+    set_rng_state
+    )
+from detector.train_detector.run_log import (
+    StepTimer, RunLog, peak_memory, print_run_summary
+    )
 import numpy as np
+import os
 import time
 from torch.utils.data import DataLoader
 from typing import Tuple
@@ -15,6 +22,12 @@ def best_cv_training(args: dict):
     rates and returns the trained model that achieves the highest validation
     accuracy.
 
+    If <args.checkpoint_dir> is set, the weights of the best fold so far are
+    kept in <args.checkpoint_dir>/best.pt rather than in memory, and every
+    completed fold is recorded in cv_state.json. With <args.resume> the
+    sweep then skips the completed folds and continues the interrupted one
+    from its last epoch checkpoint (see train).
+
     :param args: Dictionary of training specifications detailed in main.py.
     :return: torch.Module, float
     """
@@ -25,35 +38,83 @@ def best_cv_training(args: dict):
     dataloader_pairs = get_dataloaders(
         args.folder, args.dimensions, args.batch_size, args.s, args.num_workers
         )
-    train_losses, val_losses, metrics = [], [], []
-    best_metric = -1
-    final_model = None
+    cv_state = {"metrics": {}, "best_metric": -1}
+    if args.checkpoint_dir:
+        state_path = os.path.join(args.checkpoint_dir, "cv_state.json")
+        best_path = os.path.join(args.checkpoint_dir, "best.pt")
+        if args.resume:
+            cv_state = load_json(state_path, cv_state)
+    best_state = None
     for i, pair in enumerate(dataloader_pairs):
+        if str(i) in cv_state["metrics"]:
+            continue  # completed before the sweep was resumed
         mod, train_loss, val_loss, metric = train(args, i, pair)
-        train_losses.append(train_loss)
-        val_losses.append(val_loss)
-        metrics.append(metric)
-        if metric > best_metric:
-            best_metric = metric
-            final_model = mod
-        else:
-            del mod  # remove from GPU resources
-    return final_model, best_metric
+        if metric > cv_state["best_metric"]:
+            cv_state["best_metric"] = metric
+            if args.checkpoint_dir:
+                save_checkpoint(best_path, mod.state_dict())
+            else:
+                best_state = {k: v.cpu() for k, v in mod.state_dict().items()}
+        del mod  # remove from GPU resources
+        cv_state["metrics"][str(i)] = metric
+        if args.checkpoint_dir:
+            save_json(state_path, cv_state)
+            if os.path.exists(fold_checkpoint_path(args, i)):
+                os.remove(fold_checkpoint_path(args, i))
+    if args.checkpoint_dir:
+        best_state = load_checkpoint(best_path)
+    device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    final_model = get_model(args, device)
+    final_model.load_state_dict(best_state)
+    return final_model, cv_state["best_metric"]
+
+
+def fold_checkpoint_path(args: dict, lr_index: int):
+    """
+    Returns the path of the epoch checkpoint of the fold trained at the
+    learning rate index <lr_index>.
+
+    :param args: Dictionary of training specifications detailed in main.py.
+    :param lr_index: Index of learning rate in hyperparameter space.
+    :return: str
+    """
+    return os.path.join(args.checkpoint_dir, "fold_{}.pt".format(lr_index))
+
+
+def confusion_matrix(true: torch.Tensor, pred: torch.Tensor,
+                     num_classes=2):
+    """
+    Returns the <num_classes> x <num_classes> confusion matrix whose entry
+    [i][j] counts the labels <true> equal to i predicted as j, computed with
+    a single bincount.
+
+    :param true: Tensor of true labels.
+    :param pred: Tensor of predicted labels.
+    :param num_classes: Number of categories.
+    :return: torch.Tensor
+    """
+    true, pred = torch.as_tensor(true), torch.as_tensor(pred)
+    counts = torch.bincount(
+        true.long() * num_classes + pred.long(),
+        minlength=num_classes * num_classes
+        )
+    return counts.reshape(num_classes, num_classes)
 
 
 def get_con_stats(true_pred: dict):
     """
     Returns confusion matrix statistics: accuracy, sensitivity, specificity.
+    A statistic of a category absent from the labels is 0.
 
     :param true_pred: Dictionary of true labels and predicted labels with keys
-            "true" and "pred", whose values are lists populated with 0 or 1
-            (category labels).
+            "true" and "pred", whose values are tensors (or lists) populated
+            with 0 or 1 (category labels).
     :return: float, float, float
     """
-    con_mat = confusion_matrix(true_pred["true"], true_pred["pred"])
-    acc = (con_mat[0][0] + con_mat[1][1]) / con_mat.sum()
-    sens = con_mat[0][0]/con_mat[0].sum()
-    spec = con_mat[1][1]/con_mat[1].sum()
+    con_mat = confusion_matrix(true_pred["true"], true_pred["pred"]).double()
+    acc = ((con_mat[0][0] + con_mat[1][1]) / con_mat.sum().clamp(min=1)).item()
+    sens = (con_mat[0][0] / con_mat[0].sum().clamp(min=1)).item()
+    spec = (con_mat[1][1] / con_mat[1].sum().clamp(min=1)).item()
     return acc, sens, spec
 
 
@@ -68,7 +129,7 @@ def print_training_update(epoch: int, duration: float, lr_index: int,
     :param lr_index: Index of current learning rate in hyperparameter space.
     :param losses: Tuple of training loss and validation loss.
     :param true_pred: Dictionary of true labels and predicted labels with keys
-            "true" and "pred", whose values are lists populated with 0 or 1
+            "true" and "pred", whose values are tensors populated with 0 or 1
             (category labels).
     :param period: Epochs corresponding to a multiple of <period>, an int, will
             be printed.
@@ -77,7 +138,7 @@ def print_training_update(epoch: int, duration: float, lr_index: int,
     if period == 0 or epoch % period == 0:
         train_loss, val_loss = losses
         acc, sens, spec = get_con_stats(true_pred)
-        balance = 100*sum(true_pred["true"])/len(true_pred["true"])
+        balance = 100*true_pred["true"].float().mean().item()
         if epoch == 0:
             update = ("======================================================\n"
                 "Validation Category Balance: {:0.2f}%\n").format(balance)
@@ -96,7 +157,8 @@ def print_training_update(epoch: int, duration: float, lr_index: int,
                 lr_index, epoch, duration, train_loss, val_loss, acc, sens, spec
                 )
         print(update)
-        print(confusion_matrix(true_pred["true"], true_pred["pred"]), "\n")
+        con_mat = confusion_matrix(true_pred["true"], true_pred["pred"])
+        print(con_mat.numpy(), "\n")
 
 
 def training_metric(true_pred: dict, last_percentile=0.9, metric="acc"):
@@ -104,7 +166,7 @@ def training_metric(true_pred: dict, last_percentile=0.9, metric="acc"):
     Returns the calculated metric of interest during training.
 
     :param true_pred: Dictionary of true labels and predicted labels with keys
-            "true" and "pred", whose values are lists populated with 0 or 1
+            "true" and "pred", whose values are tensors populated with 0 or 1
             (category labels).
     :param last_percentile: If <last_percentile> is 0.9 then the last 10% of
             epochs are used to calculate the training metric.
@@ -131,104 +193,262 @@ def training_metric(true_pred: dict, last_percentile=0.9, metric="acc"):
             )
 
 
-def train(args: dict, lr_index: int, dataloaders: Tuple[DataLoader]):
+def train(args: dict, lr_index: int, dataloaders: Tuple[DataLoader],
+          fc=None, loss_criterion=None):
     """
     Trains a neural network using the training specifications in <args> which
     are detailed in main.py. The neural net is trained at the learning rate
     index <lr_index> and uses training, validation dataloaders <dataloaders>.
 
+    Training stops early once the validation loss has not improved for
+    <args.patience> epochs, if <args.patience> is set, and the model returned
+    then has the weights of the epoch with the lowest validation loss, whose
+    losses and metric are the ones returned. If
+    <args.checkpoint_dir> is set, the model, optimizer, random number
+    generator states and history are saved after every epoch, and with
+    <args.resume> training continues from that checkpoint.
+
+    If <args.log_dir> is set, every epoch's step timings, images/sec, peak
+    memory and metrics are appended to a JSON-lines log of the run in that
+    folder (see run_log), and a summary is printed once training ends.
+
     :param args: Dictionary of training specifications detailed in main.py.
     :param lr_index: Index of current learning rate in hyperparameter space.
     :param dataloaders: Tuple of training, validation DataLoaders.
+    :param fc: Trained fully connected layer to start from, e.g. a head
+            trained by embedding_cache, or None to start from a new one.
+    :param loss_criterion: Loss function, e.g. a distill.DistillationLoss,
+            or None for cross entropy weighted by <args.label_weights>.
     :return: torch.Module, float, float, float
     """
     train_dataloader, val_dataloader = dataloaders
     device = torch.device('cuda') if args.gpu else torch.device('cpu')
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
     model = get_model(args, device)
-    if args.label_weights is None:
-        label_weights = None
-    else:
-        label_weights = args.label_weights.to(device)
-    loss_criterion = nn.CrossEntropyLoss(weight=label_weights)
+    if fc is not None:
+        final_layer(model).load_state_dict(fc.state_dict())
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    # the compiled module shares its parameters with <model>
+    run_model = torch.compile(model) if args.compile else model
+    options = {"channels_last": args.channels_last, "bf16": args.bf16}
+    if loss_criterion is None:
+        if args.label_weights is None:
+            label_weights = None
+        else:
+            label_weights = args.label_weights.to(device)
+        loss_criterion = nn.CrossEntropyLoss(weight=label_weights)
     optimizer = torch.optim.AdamW(
         model.parameters(), lr=args.learning_rates[lr_index]
         )
-    train_losses = []
-    val_losses = []
-    stats = {"true": [], "pred": []}
-    for epoch in range(args.epochs):
+    history = {
+        "epoch": -1,
+        "train_losses": [],
+        "val_losses": [],
+        "true": [],  # per epoch tensors
+        "pred": [],
+        "best_val_loss": float("inf"),
+        "best_epoch": -1,
+        "bad_epochs": 0
+        }
+    best_state = None
+    if args.checkpoint_dir:
+        path = fold_checkpoint_path(args, lr_index)
+        if args.resume and os.path.exists(path):
+            checkpoint = load_checkpoint(path)
+            model.load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            set_rng_state(checkpoint["rng"])
+            history = checkpoint["history"]
+            best_state = checkpoint.get("best_model")
+    run_log = RunLog(args.log_dir, "fold{}".format(lr_index))
+    run_log.write(
+        "start", lr_index=lr_index, model=args.model_link,
+        batch_size=train_dataloader.batch_size,
+        num_workers=train_dataloader.num_workers, device=device.type,
+        threads=torch.get_num_threads(), options=options,
+        accumulation=args.accumulation
+        )
+    epoch = history["epoch"] + 1
+    while epoch < args.epochs and not (
+            args.patience and history["bad_epochs"] >= args.patience):
         start = time.time()
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        timer = StepTimer(device, enabled=run_log.path is not None)
         train_loss = train_epoch(
-                model, loss_criterion, optimizer, train_dataloader, device
+                run_model, loss_criterion, optimizer, train_dataloader, device,
+                accumulation=args.accumulation, timer=timer, **options
                 )
+        val_start = time.time()
         val_loss, epoch_stats = val_epoch(
-            model, loss_criterion, val_dataloader, device
+            run_model, loss_criterion, val_dataloader, device, **options
             )
-        train_losses.append(train_loss)
-        val_losses.append(val_loss)
-        stats["true"] += epoch_stats["true"]
-        stats["pred"] += epoch_stats["pred"]
+        if timer.enabled:
+            acc, sens, spec = get_con_stats(epoch_stats)
+            run_log.write(
+                "epoch", epoch=epoch, train_loss=float(train_loss),
+                val_loss=val_loss, acc=acc, sens=sens, spec=spec,
+                train=timer.summary(), val_seconds=time.time() - val_start,
+                memory=peak_memory(device)
+                )
+        history["train_losses"].append(train_loss)
+        history["val_losses"].append(val_loss)
+        history["true"].append(epoch_stats["true"])
+        history["pred"].append(epoch_stats["pred"])
+        if val_loss < history["best_val_loss"]:
+            history["best_val_loss"], history["bad_epochs"] = val_loss, 0
+            history["best_epoch"] = len(history["val_losses"]) - 1
+            if args.patience:
+                best_state = {
+                    k: v.detach().to("cpu", copy=True)
+                    for k, v in model.state_dict().items()
+                    }
+        else:
+            history["bad_epochs"] += 1
+        history["epoch"] = epoch
+        if args.checkpoint_dir:
+            save_checkpoint(path, {
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "rng": get_rng_state(),
+                "history": history,
+                "best_model": best_state
+                })
         duration = (time.time() - start) / 60  # epoch duration in minutes
         print_training_update(
             epoch, duration, lr_index, (train_loss, val_loss), epoch_stats
             )
-    recent_10_percent = int(0.9*args.epochs)
+        epoch += 1
+    if run_log.epochs:
+        summary = run_log.summary()
+        run_log.write("summary", **summary)
+        print_run_summary(summary)
+    if best_state is not None:
+        # score the kept weights by their own epoch
+        model.load_state_dict(best_state)
+        best = history["best_epoch"]
+        return (
+            model,
+            history["train_losses"][best],
+            history["val_losses"][best],
+            training_metric({
+                "true": history["true"][best],
+                "pred": history["pred"][best]
+                })
+            )
+    recent_10_percent = int(0.9*len(history["train_losses"]))
     return (
         model,
-        np.mean(train_losses[recent_10_percent:]),
-        np.mean(val_losses[recent_10_percent:]),
-        training_metric(stats)
+        np.mean(history["train_losses"][recent_10_percent:]),
+        np.mean(history["val_losses"][recent_10_percent:]),
+        training_metric({
+            "true": torch.cat(history["true"]),
+            "pred": torch.cat(history["pred"])
+            })
         )
 
 
+def to_device(images: torch.Tensor, labels: torch.Tensor,
+              device: torch.device, channels_last=False):
+    """
+    Moves a batch of <images> and <labels> to <device>, converting the
+    images to the channels_last memory format if <channels_last> is True.
+
+    :param images: Batch of images.
+    :param labels: Batch of labels.
+    :param device: GPU or CPU.
+    :param channels_last: Whether to use the channels_last memory format.
+    :return: torch.Tensor, torch.Tensor
+    """
+    if channels_last:
+        images = images.to(device, memory_format=torch.channels_last)
+    else:
+        images = images.to(device)
+    return images, labels.to(device)
+
+
 def train_epoch(model, loss_criterion: nn.CrossEntropyLoss,
                 optimizer: torch.optim.AdamW, train_dataloader: DataLoader,
-                device: torch.device):
+                device: torch.device, channels_last=False, bf16=False,
+                accumulation=1, timer=None):
     """
-    Trains a neural network over an epoch.
+    Trains a neural network over an epoch. Gradients are accumulated over
+    <accumulation> batches before each optimizer step, so the effective batch
+    size is <accumulation> times the DataLoader batch size. If a
+    run_log.StepTimer <timer> is given, the time of every phase of each step
+    is added to it.
 
     :param model: The neural network to be trained.
     :param loss_criterion: Loss function.
     :param optimizer: Training optimizer.
     :param train_dataloader: Training DataLoader.
     :param device: GPU or CPU for training.
+    :param channels_last: Whether to feed images in channels_last format.
+    :param bf16: Whether to run the forward pass under bfloat16 autocast.
+    :param accumulation: Number of batches per optimizer step.
+    :param timer: StepTimer recording step timings, or None.
     :return: float
     """
+    if timer is None:
+        timer = StepTimer(device, enabled=False)
     model.train()
     losses = []
-    for images, labels in train_dataloader:
-        images, labels = images.to(device), labels.to(device)
-        optimizer.zero_grad()
-        outputs = model(images)
-        loss = loss_criterion(outputs, labels)
+    optimizer.zero_grad()
+    timer.start()
+    for i, (images, labels) in enumerate(train_dataloader):
+        timer.lap("data_wait")
+        images, labels = to_device(images, labels, device, channels_last)
+        timer.lap("to_device")
+        with torch.autocast(device.type, torch.bfloat16, enabled=bf16):
+            outputs = model(images)
+            loss = loss_criterion(outputs, labels)
         losses.append(loss.data.item())
-        loss.backward()
-        optimizer.step()
+        timer.lap("forward")
+        (loss / accumulation).backward()
+        timer.lap("backward")
+        if (i + 1) % accumulation == 0 or i + 1 == len(train_dataloader):
+            optimizer.step()
+            optimizer.zero_grad()
+        timer.lap("step")
+        timer.end_step(labels.size(0))
     return np.mean(losses)
 
 
 def val_epoch(model, loss_criterion: nn.CrossEntropyLoss,
-              val_dataloader: DataLoader, device: torch.device):
+              val_dataloader: DataLoader, device: torch.device,
+              channels_last=False, bf16=False):
     """
     Returns validation loss of neural network <model> as well as
-    dictionary of true labels and predicted labels.
+    dictionary of true labels and predicted labels. Runs in inference mode
+    and fills preallocated tensors on <device>, so the only synchronizations
+    with the device are at the end of the epoch.
 
     :param model: The neural network to be trained.
     :param loss_criterion: Loss function.
     :param val_dataloader: Validation DataLoader.
     :param device: GPU or CPU for validation.
+    :param channels_last: Whether to feed images in channels_last format.
+    :param bf16: Whether to run the forward pass under bfloat16 autocast.
     :return: float, dict
     """
     model.eval()
-    losses = []
-    stats = {"true": [], "pred": []}
-    for images, labels in val_dataloader:
-        images, labels = images.to(device), labels.to(device)
-        outputs = model(images)
-        loss = loss_criterion(outputs, labels)
-        losses.append(loss.data.item())
-        _, predicted = torch.max(outputs.data, 1, keepdim=True)
-        for i in range(labels.size(0)):
-            stats["true"].append(labels[i].item())
-            stats["pred"].append(predicted[i].item())
-    return np.mean(losses), stats
+    n = len(val_dataloader.dataset)
+    losses = torch.empty(len(val_dataloader), device=device)
+    true = torch.empty(n, dtype=torch.long, device=device)
+    pred = torch.empty(n, dtype=torch.long, device=device)
+    start = 0
+    with torch.inference_mode():
+        for i, (images, labels) in enumerate(val_dataloader):
+            images, labels = to_device(images, labels, device, channels_last)
+            with torch.autocast(device.type, torch.bfloat16, enabled=bf16):
+                outputs = model(images)
+                loss = loss_criterion(outputs, labels)
+            losses[i] = loss
+            end = start + labels.size(0)
+            true[start:end] = labels
+            pred[start:end] = outputs.argmax(dim=1)
+            start = end
+    stats = {"true": true[:start].cpu(), "pred": pred[:start].cpu()}
+    return losses.mean().item(), stats
@@ -1,12 +1,16 @@
 from selenium import webdriver
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import StaleElementReferenceException
 from selenium.common.exceptions import ElementNotInteractableException
 from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as ec
+from tracing import Tracer
+from urllib.parse import urljoin
 import time
 
 
@@ -36,9 +40,16 @@ class BrowserConnection:
             WebElement containing the ad gallery.
     images_loc - str: pattern used by find_element_by_css_selector to search
             for the WebElements containing the ad images.
+    ad_link_loc - str: css selector of the title link of an ad, within the
+            WebElement of the ad on the main results page.
+    ad_url_attr - str: attribute of the WebElement of an ad holding its
+            url, used when the ad has no title link.
+    tracer - Tracer: Times waits for page elements and counts their
+            timeouts, including those handled inside BrowserConnection.
     """
 
-    def __init__(self, driver_loc: str, timeout: int, headless=True):
+    def __init__(self, driver_loc: str, timeout: int, headless=True,
+                 tracer=None):
         """
         Initializes BrowserConnection object.
 
@@ -46,13 +57,15 @@ class BrowserConnection:
         :param timeout: Maximum allotted time for Selenium methods before
                     raising TimeoutException.
         :param headless: Whether the browser should be headless or not.
+        :param tracer: Tracer of the scan, or None.
         """
+        options = Options()
         if headless:
-            options = Options()
-            options.headless = True
-        else:
-            options = None
-        self.driver = webdriver.Chrome(driver_loc, options=options)
+            options.add_argument("--headless=new")
+        self.driver = webdriver.Chrome(
+            service=Service(driver_loc), options=options
+            )
+        self.tracer = Tracer() if tracer is None else tracer
         self.ignored_exceptions = (StaleElementReferenceException,)
         self.timeout = timeout
         self.wait = 1
@@ -63,6 +76,8 @@ class BrowserConnection:
             "css selector": By.CSS_SELECTOR
             }
         self.ads_loc = "clearfix"  # class name
+        self.ad_link_loc = "a.title"  # css selector, within an ad
+        self.ad_url_attr = "data-vip-url"  # ad attribute, relative url
         self.id_loc = '//*[@id="ViewItemPage"]/div[3]/div/ul/li[7]/a'
         self.price_loc = ('//*[@id="ViewItemPage"]/div[5]/div[1]/div[1]/div/'
                           'div/span/span[1]'
@@ -108,6 +123,25 @@ class BrowserConnection:
         self.driver.delete_all_cookies()
         self.driver.quit()
 
+    def wait_for_ads(self, num_ads: int):
+        """
+        Waits for the webdriver to find at least <num_ads> ads and returns
+        all the ads found. Raises TimeoutException if fewer ads are found
+        after self.timeout seconds.
+
+        :param num_ads: Number of ads to scrape.
+        :return: List[WebElement]
+        """
+        total = 0
+        ads = self.driver.find_elements(By.CLASS_NAME, self.ads_loc)
+        while len(ads) < num_ads:
+            time.sleep(self.wait)
+            total += self.wait
+            if total > self.timeout:
+                raise TimeoutException
+            ads = self.driver.find_elements(By.CLASS_NAME, self.ads_loc)
+        return ads
+
     def get_ith_ad(self, num_ads: int, ind: int):
         """
         Waits for the webdriver to find at least <num_ads> ads and then
@@ -120,15 +154,51 @@ class BrowserConnection:
         :param ind: Index of a particular ad to scrape.
         :return: WebElement
         """
-        total = 0
-        ads = self.driver.find_elements_by_class_name(self.ads_loc)
-        while len(ads) < num_ads:
-            time.sleep(self.wait)
-            total += self.wait
-            if total > self.timeout:
-                raise TimeoutException
-            ads = self.driver.find_elements_by_class_name(self.ads_loc)
-        return ads[ind]
+        return self.wait_for_ads(num_ads)[ind]
+
+    def get_ad_urls(self, num_ads: int):
+        """
+        Waits for the webdriver to find at least <num_ads> ads and returns the
+        url of each of the first <num_ads>, so the ads can be visited directly
+        instead of by clicking through the page of ads. The url is the href
+        of the ad's title link, self.ad_link_loc, or else its
+        self.ad_url_attr attribute, and None for an element with neither.
+        Raises NoSuchElementException if no ad has a url, as the page layout
+        must have changed and the scan would otherwise do nothing.
+
+        :param num_ads: Number of ads to scrape.
+        :return: List[Optional[str]]
+        """
+        urls = []
+        for ad in self.wait_for_ads(num_ads)[:num_ads]:
+            links = ad.find_elements(By.CSS_SELECTOR, self.ad_link_loc)
+            url = links[0].get_attribute("href") if links else None
+            if not url:
+                url = ad.get_attribute(self.ad_url_attr)
+            urls.append(
+                urljoin(self.driver.current_url, url) if url else None
+                )
+        if not any(urls):
+            raise NoSuchElementException(
+                "No ad links found with {!r} or {!r}".format(
+                    self.ad_link_loc, self.ad_url_attr
+                    )
+                )
+        return urls
+
+    def is_alive(self):
+        """
+        Returns True if the browser still responds, and False if it crashed
+        or was closed.
+
+        :return: bool
+        """
+        try:
+            self.driver.current_url
+            return True
+        except Exception:
+            # a dead chromedriver raises connection errors, not Selenium ones
+            return False
 
     def get_price(self):
         """
@@ -174,8 +244,9 @@ class BrowserConnection:
 
         :return: None
         """
-        gallery = self.wait_for_page(self.gallery_loc, "xpath")
-        gallery.click()
+        with self.tracer.span("browser.click_gallery"):
+            gallery = self.wait_for_page(self.gallery_loc, "xpath")
+            gallery.click()
 
     def wait_for_page(self, loc: str, by: str, singular=True):
         """
@@ -196,11 +267,12 @@ class BrowserConnection:
             locator = ec.presence_of_element_located
         else:
             locator = ec.presence_of_all_elements_located
-        return WebDriverWait(
-            self.driver,
-            self.timeout,
-            ignored_exceptions=self.ignored_exceptions
-            ).until(locator((self.by[by], loc)))
+        with self.tracer.span("browser.wait_for_page"):
+            return WebDriverWait(
+                self.driver,
+                self.timeout,
+                ignored_exceptions=self.ignored_exceptions
+                ).until(locator((self.by[by], loc)))
 
     def get_id(self):
         """
@@ -1,6 +1,7 @@
 import sqlite3 as sql
-from pandas import DataFrame
-from typing import List, Tuple
+import csv
+from pandas import DataFrame, concat
+from typing import List, Tuple, Optional
 
 
 def sqlfstr(s: str):
@@ -26,6 +27,22 @@ def open_conn(db_name="scanner/chairs.db"):
     return c, conn
 
 
+def open_read_conn(db_name="scanner/chairs.db"):
+    """
+    Opens a read-only connection to the database <db_name>. Read-only
+    connections never take the write lock, so any number of them can be used
+    alongside the single DBWriter that owns the write connection.
+
+    :param db_name: Name of database.
+    :return: Tuple[sqlite3.Cursor, sqlite3.Connection]
+    """
+    conn = sql.connect(
+        "file:{}?mode=ro".format(db_name), uri=True, check_same_thread=False
+        )
+    c = conn.cursor()
+    return c, conn
+
+
 def close_conn(db_conn: Tuple[sql.Cursor, sql.Connection]):
     """
     Closes the connection to the database with cursor and connection objects
@@ -56,9 +73,220 @@ def init_db(db="scanner/chairs.db", table_name="chairs"):
         filename text
         )""".format(table=sqlfstr(table_name)))
     conn.commit()
+    init_summary((c, conn))
+    init_alerts((c, conn))
+    init_metrics((c, conn))
     conn.close()
 
 
+def init_summary(db_conn: Tuple[sql.Cursor, sql.Connection],
+                 table="ads", source="chairs"):
+    """
+    Creates, if it does not already exist, the per-ad summary table <table>
+    along with its price and probability indexes, and backfills it from the
+    per-image table <source>. The summary holds one row per ad:
+    the highest image probability, the number of images, the latest price and
+    the first and last dates the ad was stored.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param table: Name of the summary table.
+    :param source: Name of the per-image table.
+    :return: None
+    """
+    c, conn = db_conn
+    c.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+        (table,)
+        )
+    if c.fetchone() is not None:
+        return None
+    with conn:
+        c.execute("""CREATE TABLE {table}(
+            id integer PRIMARY KEY,
+            max_prob real,
+            image_count integer,
+            price real,
+            first_seen text,
+            last_seen text
+            )""".format(table=sqlfstr(table)))
+        c.execute(
+            "CREATE INDEX {0}_price ON {0}(price)".format(sqlfstr(table))
+            )
+        c.execute(
+            "CREATE INDEX {0}_max_prob ON {0}(max_prob)".format(sqlfstr(table))
+            )
+        c.execute(
+            """INSERT INTO {table}
+            SELECT id, MAX(prob), COUNT(*), price, MIN(date), MAX(date)
+            FROM {source} GROUP BY id""".format(
+                table=sqlfstr(table), source=sqlfstr(source)
+                )
+            )
+
+
+def update_summary(db_conn: Tuple[sql.Cursor, sql.Connection], ad_id: int,
+                   max_prob: float, image_count: int, price: float, date: str,
+                   table="ads"):
+    """
+    Folds a newly stored ad into the summary table <table>: a new ad gets its
+    own row, and an existing row has its probability, image count, price and
+    last seen date updated.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param ad_id: Unique numeric identifier of an ad.
+    :param max_prob: Highest probability among the ad's stored images.
+    :param image_count: Number of images stored for the ad.
+    :param price: Price of the ad.
+    :param date: Date the images were stored.
+    :param table: Name of the summary table.
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.execute(
+            """INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                max_prob = MAX(max_prob, excluded.max_prob),
+                image_count = image_count + excluded.image_count,
+                price = excluded.price,
+                last_seen = excluded.last_seen""".format(table=sqlfstr(table)),
+            (ad_id, max_prob, image_count, price, date, date)
+            )
+
+
+def get_summary(db_conn: Tuple[sql.Cursor, sql.Connection], ad_id: int,
+                table="ads"):
+    """
+    Returns the summary row (id, max_prob, image_count, price, first_seen,
+    last_seen) of the ad <ad_id>, or None if the ad is not stored.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param ad_id: Unique numeric identifier of an ad.
+    :param table: Name of the summary table.
+    :return: None or tuple
+    """
+    c, _ = db_conn
+    c.execute(
+        "SELECT * FROM {} WHERE id=?".format(sqlfstr(table)), (ad_id,)
+        )
+    return c.fetchone()
+
+
+def init_alerts(db_conn: Tuple[sql.Cursor, sql.Connection], table="alerts"):
+    """
+    Creates, if it does not already exist, the table <table> recording the
+    last notification sent for each ad: when it was sent and the price the ad
+    was listed at.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param table: Name of the alerts table.
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.execute("""CREATE TABLE IF NOT EXISTS {table}(
+            id integer PRIMARY KEY,
+            notified_at text,
+            price real
+            )""".format(table=sqlfstr(table)))
+
+
+def should_alert(db_conn: Tuple[sql.Cursor, sql.Connection], ad_id: int,
+                 price: float, table="alerts"):
+    """
+    Returns True if no notification has been sent for the ad <ad_id>, or if
+    <price> is lower than the price at its last notification. Returns False
+    otherwise.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param ad_id: Unique numeric identifier of an ad.
+    :param price: Current price of the ad.
+    :param table: Name of the alerts table.
+    :return: bool
+    """
+    c, _ = db_conn
+    c.execute(
+        "SELECT price FROM {} WHERE id=?".format(sqlfstr(table)), (ad_id,)
+        )
+    result = c.fetchone()
+    return result is None or price < result[0]
+
+
+def record_alert(db_conn: Tuple[sql.Cursor, sql.Connection], ad_id: int,
+                 price: float, date: str, table="alerts"):
+    """
+    Records that a notification for the ad <ad_id> listed at <price> was sent
+    at <date>, replacing any earlier record for the ad.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param ad_id: Unique numeric identifier of an ad.
+    :param price: Price of the ad when notified.
+    :param date: Date the notification was sent.
+    :param table: Name of the alerts table.
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.execute(
+            "INSERT OR REPLACE INTO {} VALUES (?, ?, ?)".format(
+                sqlfstr(table)
+                ),
+            (ad_id, date, price)
+            )
+
+
+def init_metrics(db_conn: Tuple[sql.Cursor, sql.Connection],
+                 table="metrics"):
+    """
+    Creates, if it does not already exist, the table <table> of scan
+    metrics. Each row is a timing or counter of a run, or of an ad when
+    ad_id is set: its name, the seconds spent and a count.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param table: Name of the metrics table.
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.execute("""CREATE TABLE IF NOT EXISTS {table}(
+            run text,
+            ad_id integer,
+            name text,
+            seconds real,
+            count integer
+            )""".format(table=sqlfstr(table)))
+        c.execute("CREATE INDEX IF NOT EXISTS {0}_run ON {0}(run)".format(
+            sqlfstr(table)
+            ))
+
+
+def record_metrics(db_conn: Tuple[sql.Cursor, sql.Connection],
+                   rows: List[tuple], table="metrics"):
+    """
+    Inserts the (run, ad_id, name, seconds, count) <rows> into the metrics
+    table <table> in a single transaction.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param rows: Rows of the metrics table.
+    :param table: Name of the metrics table.
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.executemany(
+            "INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(sqlfstr(table)),
+            rows
+            )
+
+
 def insert(db_conn: Tuple[sql.Cursor, sql.Connection], item_dict: dict,
            item_names: str, table="chairs"):
     """
@@ -81,6 +309,28 @@ def insert(db_conn: Tuple[sql.Cursor, sql.Connection], item_dict: dict,
             )
 
 
+def insert_many(db_conn: Tuple[sql.Cursor, sql.Connection],
+                item_dicts: List[dict], item_names: str, table="chairs"):
+    """
+    Inserts every dictionary in <item_dicts> into the <table> corresponding to
+    the <db_conn> database in a single transaction.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param item_dicts: List of dictionaries whose keys match <item_names>.
+    :param item_names: String in format "(:item1, :item2, ..., item:n)"
+    :param table: Name of table in database
+    :return: None
+    """
+    c, conn = db_conn
+    with conn:
+        c.executemany(
+            "INSERT INTO {table} VALUES {item_names}"\
+            .format(table=sqlfstr(table), item_names=sqlfstr(item_names)),
+            item_dicts
+            )
+
+
 def is_in_db(db_conn: Tuple[sql.Cursor, sql.Connection], item: any, var: str,
              table="chairs"):
     """
@@ -106,17 +356,190 @@ def is_in_db(db_conn: Tuple[sql.Cursor, sql.Connection], item: any, var: str,
     return result is not None
 
 
-def table_to_df(col_names: List[str], table="chairs"):
+def table_columns(db_conn: Tuple[sql.Cursor, sql.Connection], table="chairs"):
+    """
+    Returns the column names of <table> in the order they are stored.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param table: Name of database table.
+    :return: List[str]
+    """
+    c, _ = db_conn
+    c.execute("PRAGMA table_info({})".format(sqlfstr(table)))
+    return [row[1] for row in c.fetchall()]
+
+
+def select_query(db_conn: Tuple[sql.Cursor, sql.Connection],
+                 columns: Optional[List[str]] = None, min_price=None,
+                 max_price=None, min_prob=None, start_date=None,
+                 end_date=None, table="chairs"):
+    """
+    Returns an SQL query and its parameters selecting <columns> from <table>
+    for the rows that satisfy every filter that is not None. Dates are
+    compared as strings in the "%Y-%m-%d %H:%M:%S" format used by the scraper,
+    so a bare "%Y-%m-%d" date is also accepted.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param columns: Columns to select, all columns if None.
+    :param min_price: Smallest price included.
+    :param max_price: Largest price included.
+    :param min_prob: Smallest probability included.
+    :param start_date: Earliest date included.
+    :param end_date: Rows dated before <end_date> are included.
+    :param table: Name of database table.
+    :return: Tuple[str, List[str], tuple]
+    """
+    all_columns = table_columns(db_conn, table=table)
+    if columns is None:
+        columns = all_columns
+    unknown = set(columns) - set(all_columns)
+    if unknown:
+        raise ValueError("Unknown columns: {}".format(sorted(unknown)))
+    filters = [
+        ("price >= ?", min_price),
+        ("price <= ?", max_price),
+        ("prob >= ?", min_prob),
+        ("date >= ?", start_date),
+        ("date < ?", end_date)
+        ]
+    where = [cond for cond, value in filters if value is not None]
+    params = tuple(value for _, value in filters if value is not None)
+    query = "SELECT {} FROM {}".format(
+        ", ".join('"{}"'.format(sqlfstr(col)) for col in columns),
+        sqlfstr(table)
+        )
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    return query, list(columns), params
+
+
+def iter_rows(db_conn: Tuple[sql.Cursor, sql.Connection], chunk_size=10000,
+              **filters):
+    """
+    Returns a generator of lists of at most <chunk_size> row tuples from the
+    database, selected by the keyword arguments of select_query. Only one
+    chunk is held in memory at a time.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param chunk_size: Maximum number of rows per chunk.
+    :param filters: Keyword arguments passed to select_query.
+    :return: generator of List[tuple]
+    """
+    query, _, params = select_query(db_conn, **filters)
+    # a dedicated cursor keeps the iteration independent of <db_conn>'s own
+    _, conn = db_conn
+    c = conn.cursor()
+    c.execute(query, params)
+    try:
+        rows = c.fetchmany(chunk_size)
+        while rows:
+            yield rows
+            rows = c.fetchmany(chunk_size)
+    finally:
+        c.close()
+
+
+def iter_df(db_conn: Tuple[sql.Cursor, sql.Connection], chunk_size=10000,
+            **filters):
+    """
+    Returns a generator of pandas DataFrames of at most <chunk_size> rows,
+    selected by the keyword arguments of select_query.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param chunk_size: Maximum number of rows per DataFrame.
+    :param filters: Keyword arguments passed to select_query.
+    :return: generator of DataFrame
+    """
+    _, columns, _ = select_query(db_conn, **filters)
+    for rows in iter_rows(db_conn, chunk_size=chunk_size, **filters):
+        yield DataFrame(rows, columns=columns)
+
+
+def export_csv(db_conn: Tuple[sql.Cursor, sql.Connection], path: str,
+               chunk_size=10000, **filters):
+    """
+    Streams the rows selected by the keyword arguments of select_query into
+    the CSV file <path>, with a header row. Returns the number of rows
+    written.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param path: Path of the CSV file to write.
+    :param chunk_size: Number of rows fetched from the database at a time.
+    :param filters: Keyword arguments passed to select_query.
+    :return: int
+    """
+    _, columns, _ = select_query(db_conn, **filters)
+    total = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for rows in iter_rows(db_conn, chunk_size=chunk_size, **filters):
+            writer.writerows(rows)
+            total += len(rows)
+    return total
+
+
+def export_parquet(db_conn: Tuple[sql.Cursor, sql.Connection], path: str,
+                   chunk_size=10000, **filters):
+    """
+    Streams the rows selected by the keyword arguments of select_query into
+    the Parquet file <path>, one row group per chunk. Requires pyarrow.
+    Returns the number of rows written.
+
+    :param db_conn: Cursor and connection to
+            database.
+    :param path: Path of the Parquet file to write.
+    :param chunk_size: Number of rows per row group.
+    :param filters: Keyword arguments passed to select_query.
+    :return: int
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("export_parquet requires pyarrow to be installed")
+    _, columns, _ = select_query(db_conn, **filters)
+    types = {"id": pa.int64(), "date": pa.string(), "prob": pa.float64(),
+             "price": pa.float64(), "filename": pa.string()}
+    schema = pa.schema([(col, types.get(col, pa.string())) for col in columns])
+    total = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in iter_rows(db_conn, chunk_size=chunk_size, **filters):
+            arrays = [
+                pa.array([row[j] for row in rows], type=schema.field(j).type)
+                for j in range(len(columns))
+                ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total += len(rows)
+    return total
+
+
+def table_to_df(col_names: List[str], table="chairs",
+                db_name="scanner/chairs.db", **filters):
     """
     Given the column names <col_names> associated to the database table
-    <table>, returns a pandas DataFrame of the table.
+    <table>, returns a pandas DataFrame of the table. Any keyword arguments of
+    select_query may be given to project columns or filter rows; the rows are
+    then read in chunks rather than materialized as Python tuples all at once.
 
-    :param col_names: Names of columns in <table>
+    :param col_names: Names of the selected columns in <table>
     :param table: Name of database table.
+    :param db_name: Name of database.
+    :param filters: Keyword arguments passed to select_query.
     :return: DataFrame
     """
-    c, conn = open_conn()
-    with conn:
-        data = c.execute(" SELECT * FROM {table}".format(table=sqlfstr(table)))
-        data = DataFrame(data.fetchall(), columns=col_names)
+    db_conn = open_conn(db_name=db_name)
+    try:
+        chunks = list(iter_df(db_conn, table=table, **filters))
+    finally:
+        close_conn(db_conn)
+    if not chunks:
+        return DataFrame(columns=col_names)
+    data = chunks[0] if len(chunks) == 1 else concat(chunks, ignore_index=True)
+    data.columns = col_names
     return data
@@ -2,6 +2,7 @@ import torch
 from torchvision import transforms
 from torch.nn.functional import softmax
 from PIL import Image
+from io import BytesIO
 from urllib.request import urlopen
 from torch.nn import Module
 from selenium.webdriver.remote.webelement import WebElement
@@ -75,3 +76,63 @@ def hm_prob(image: WebElement, image_name: str, model: Module):
         mod_input = Image.open(img).convert('RGB')
         prob = get_prob(model, mod_input)
     return prob
+
+
+def download_image(image: WebElement):
+    """
+    Downloads the image <image> and returns its bytes.
+
+    :param image: Image to be downloaded.
+    :return: bytes
+    """
+    src = image.get_attribute('src')
+    with urlopen(src) as conn:
+        return conn.read()
+
+
+def bytes_prob(data: bytes, model: Module):
+    """
+    Returns the probability of the image with bytes <data> being a particular
+    item, as calculated by the neural net <model>.
+
+    :param data: Image bytes.
+    :param model: Neural network used for image classification.
+    :return: float
+    """
+    mod_input = Image.open(BytesIO(data)).convert('RGB')
+    return get_prob(model, mod_input)
+
+
+def final_layer(model: Module):
+    """
+    Returns the final fully connected layer of <model>: fc for ResNets and
+    the last classifier layer for MobileNets.
+
+    :param model: Neural net used for image classification.
+    :return: Module
+    """
+    if hasattr(model, "fc"):
+        return model.fc
+    return model.classifier[-1]
+
+
+def bytes_embedding_prob(data: bytes, model: Module):
+    """
+    Returns the penultimate layer embedding and the probability
+    of the image with bytes <data> being a particular item, from a single
+    pass of the neural net <model>.
+
+    :param data: Image bytes.
+    :param model: Neural network used for image classification.
+    :return: tuple(np.ndarray, float)
+    """
+    features = []
+    handle = final_layer(model).register_forward_hook(
+        lambda module, inputs, output: features.append(inputs[0])
+        )
+    try:
+        with torch.no_grad():
+            prob = bytes_prob(data, model)
+    finally:
+        handle.remove()
+    return features[0][0].numpy(), prob
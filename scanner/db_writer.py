@@ -0,0 +1,282 @@
+import queue
+import sqlite3
+import threading
+import time
+import chair_sqlite
+from typing import Tuple
+
+
+class DBWriter:
+    """
+    Owns the only write connection to a database and serializes all writes
+    through it. Producers on any thread call insert and update_summary,
+    which only enqueue the write; a dedicated writer thread drains the queue
+    and commits writes in batches. Writes are always queued, even while an
+    earlier batch is failing; errors are only reported by flush and close.
+    A write that fails with sqlite3.OperationalError, such as "database is
+    locked", is kept and retried, so a transient error loses nothing. A
+    write that fails any other way, e.g. with sqlite3.IntegrityError, is
+    given up on after MAX_TRIES tries and moved to unwritten. Readers should
+    use open_reader, which returns a separate read-only connection.
+
+    db_name - str: Local path of the database written to.
+    batch_size - int (>0): Maximum number of rows committed in one
+            transaction.
+    flush_interval - float (>0): Maximum time (in seconds) a queued row waits
+            before it is committed.
+    rows_written - int: Number of rows committed so far.
+    unwritten - list[tuple]: Writes given up on, and those still not
+            committed when the writer was closed, after every retry failed.
+            Empty unless flush or close raised.
+    """
+    _STOP = object()
+    STOP_RETRIES = 3
+    MAX_TRIES = 3
+
+    def __init__(self, db_name: str, batch_size=64, flush_interval=1.0):
+        """
+        Initializes DBWriter object and starts its writer thread.
+
+        :param db_name: Local path of the database written to.
+        :param batch_size: Maximum number of rows committed in one
+                transaction.
+        :param flush_interval: Maximum time (in seconds) a queued row waits
+                before it is committed.
+        """
+        assert batch_size > 0, "batch_size must be positive"
+        assert flush_interval > 0, "flush_interval must be positive"
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.unwritten = []
+        self._queue = queue.Queue()
+        self._error = None
+        self._failed, self._tries = None, 0
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="DBWriter", daemon=True
+            )
+        self._thread.start()
+        self._ready.wait()
+        self._raise_error()
+
+    def insert(self, item_dict: dict, item_names: str, table="chairs"):
+        """
+        Queues <item_dict> for insertion into <table>. <item_names> are the
+        column names of <table>, as in chair_sqlite.insert. Returns
+        immediately; the row is committed by the writer thread.
+
+        :param item_dict: Dictionary whose keys match <item_names>.
+        :param item_names: String in format "(:item1, :item2, ..., item:n)"
+        :param table: Name of table in database.
+        :return: None
+        """
+        self._queue.put(("insert", table, item_names, item_dict))
+
+    def update_summary(self, ad_id: int, max_prob: float, image_count: int,
+                       price: float, date: str, table="ads"):
+        """
+        Queues the update of the ad <ad_id> in the per-ad summary table
+        <table>, as in chair_sqlite.update_summary. It is committed after the
+        rows queued with it, so the summary never lists an ad whose rows are
+        missing. Returns immediately.
+
+        :param ad_id: Unique numeric identifier of an ad.
+        :param max_prob: Highest probability among the ad's stored images.
+        :param image_count: Number of images stored for the ad.
+        :param price: Price of the ad.
+        :param date: Date the images were stored.
+        :param table: Name of the summary table.
+        :return: None
+        """
+        self._queue.put(
+            ("summary", table, (ad_id, max_prob, image_count, price, date))
+            )
+
+    def flush(self):
+        """
+        Blocks until every row queued before this call has been committed,
+        or has failed to, and raises the last error of the writer thread
+        since it was last reported.
+
+        :return: None
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._raise_error()
+
+    def close(self):
+        """
+        Commits all queued rows, stops the writer thread and closes the write
+        connection. Raises the last error of the writer thread since it was
+        last reported, in which case the writes not committed are left in
+        self.unwritten.
+
+        :return: None
+        """
+        if self._thread.is_alive():
+            self._queue.put(DBWriter._STOP)
+            self._thread.join()
+        self._raise_error()
+
+    def open_reader(self):
+        """
+        Returns a new read-only (cursor, connection) to the database. Each
+        reader thread should open its own.
+
+        :return: Tuple[sqlite3.Cursor, sqlite3.Connection]
+        """
+        return chair_sqlite.open_read_conn(db_name=self.db_name)
+
+    def _raise_error(self):
+        """
+        Re-raises on the calling thread the last exception raised by the
+        writer thread, once.
+
+        :return: None
+        """
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _open(self):
+        """
+        Opens the write connection in write-ahead-log mode so that readers
+        are not blocked while a batch is committed.
+
+        :return: Tuple[sqlite3.Cursor, sqlite3.Connection]
+        """
+        c, conn = chair_sqlite.open_conn(db_name=self.db_name)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        return c, conn
+
+    @staticmethod
+    def _operations(batch: list):
+        """
+        Returns the writes of <batch> as operations: one per table and
+        column names, holding all the rows inserted into it, followed by the
+        summary updates in the order they were queued.
+
+        :param batch: Queued writes.
+        :return: list
+        """
+        groups, summaries = {}, []
+        for item in batch:
+            if item[0] == "summary":
+                summaries.append(item)
+            else:
+                _, table, item_names, item_dict = item
+                groups.setdefault((table, item_names), []).append(item_dict)
+        inserts = [
+            ("insert", table, item_names, item_dicts)
+            for (table, item_names), item_dicts in groups.items()
+            ]
+        return inserts + summaries
+
+    def _commit(self, db_conn: Tuple[sqlite3.Cursor, sqlite3.Connection],
+                operations: list):
+        """
+        Commits <operations>, each in its own transaction, removing each one
+        from the list once committed. If one fails, it and the operations
+        after it are left in <operations> to be retried, and the error is
+        raised.
+
+        :param db_conn: Cursor and connection to database.
+        :param operations: Operations returned by _operations.
+        :return: None
+        """
+        while operations:
+            kind, table, *args = operations[0]
+            if kind == "summary":
+                chair_sqlite.update_summary(db_conn, *args[0], table=table)
+            else:
+                item_names, item_dicts = args
+                chair_sqlite.insert_many(
+                    db_conn, item_dicts, item_names, table=table
+                    )
+                self.rows_written += len(item_dicts)
+            operations.pop(0)
+
+    def _try_commit(self, db_conn: Tuple[sqlite3.Cursor, sqlite3.Connection],
+                    operations: list):
+        """
+        Commits <operations> with _commit and returns True if all of them
+        were committed. If one fails, with any Exception, the error is stored
+        to be raised by flush or close, and unless it is a
+        sqlite3.OperationalError, the operation is moved to self.unwritten
+        once it has failed self.MAX_TRIES times in a row.
+
+        :param db_conn: Cursor and connection to database.
+        :param operations: Operations returned by _operations.
+        :return: bool
+        """
+        try:
+            self._commit(db_conn, operations)
+            return True
+        except Exception as e:
+            self._error = e
+        if operations[0] is not self._failed:
+            self._failed, self._tries = operations[0], 0
+        self._tries += 1
+        if not isinstance(self._error, sqlite3.OperationalError) \
+                and self._tries >= self.MAX_TRIES:
+            self.unwritten.append(operations.pop(0))
+            self._failed = None
+        return False
+
+    def _run(self):
+        """
+        Writer thread loop. Collects writes until either <self.batch_size>
+        writes are pending or the oldest pending write has waited
+        <self.flush_interval> seconds, then commits them. Writes that fail to
+        commit are retried every <self.flush_interval> seconds, as described
+        in _try_commit, and when stopping self.STOP_RETRIES more times,
+        before being left in self.unwritten.
+
+        :return: None
+        """
+        try:
+            db_conn = self._open()
+        except sqlite3.Error as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        batch, operations, waiters, deadline = [], [], [], None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None \
+                else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is DBWriter._STOP:
+                stop = True
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            full = len(batch) >= self.batch_size
+            expired = deadline is not None and time.monotonic() >= deadline
+            if (batch or operations) and (stop or waiters or full or expired):
+                operations += DBWriter._operations(batch)
+                batch, deadline = [], None
+                if not self._try_commit(db_conn, operations):
+                    deadline = time.monotonic() + self.flush_interval
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+        for _ in range(DBWriter.STOP_RETRIES):
+            if not operations:
+                break
+            time.sleep(self.flush_interval)
+            self._try_commit(db_conn, operations)
+        self.unwritten += operations
+        chair_sqlite.close_conn(db_conn)
+
@@ -0,0 +1,266 @@
+import json
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from urllib.request import Request, urlopen
+from typing import List, Tuple
+
+
+AD_URL = "https://www.kijiji.ca/v-view-details.html?adId={}"
+
+
+class Backend:
+    """
+    A channel notifications are delivered through. Subclasses implement send.
+
+    name - str: Name used when reporting delivery failures.
+    """
+    name = "backend"
+
+    def send(self, title: str, body: str):
+        """
+        Delivers a notification with <title> and <body>. Raises an exception
+        if delivery fails.
+
+        :param title: Notification title.
+        :param body: Notification text.
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class DesktopBackend(Backend):
+    """
+    Sends desktop notifications with pynotifier.
+
+    app_name - str: Application name shown on the notification.
+    duration - int: Time (in seconds) the notification is shown for.
+    """
+    name = "desktop"
+
+    def __init__(self, app_name="Herman Miller Detector", duration=300):
+        self.app_name = app_name
+        self.duration = duration
+
+    def send(self, title: str, body: str):
+        from pynotifier import Notification
+        Notification(
+            title=title,
+            description=body,
+            duration=self.duration,
+            app_name=self.app_name
+        ).send()
+
+
+class WebhookBackend(Backend):
+    """
+    POSTs notifications as JSON {"title": ..., "text": ...} to a webhook.
+
+    url - str: Webhook url.
+    timeout - float: Time (in seconds) to wait for the webhook to respond.
+    """
+    name = "webhook"
+
+    def __init__(self, url: str, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, title: str, body: str):
+        data = json.dumps({"title": title, "text": body}).encode("utf-8")
+        request = Request(
+            self.url, data=data, headers={"Content-Type": "application/json"}
+            )
+        with urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class SMTPBackend(Backend):
+    """
+    Emails notifications through an SMTP server.
+
+    host - str: SMTP server host.
+    port - int: SMTP server port.
+    sender - str: Address the emails are sent from.
+    recipients - list[str]: Addresses the emails are sent to.
+    username - str: Login user name, or None if no login is needed.
+    password - str: Login password.
+    starttls - bool: Whether to upgrade the connection with STARTTLS.
+    timeout - float: Time (in seconds) to wait for the server.
+    """
+    name = "smtp"
+
+    def __init__(self, host: str, port: int, sender: str,
+                 recipients: List[str], username=None, password=None,
+                 starttls=False, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, title: str, body: str):
+        message = EmailMessage()
+        message["Subject"] = title
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(body)
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        with server:
+            if self.starttls:
+                server.starttls()
+            if self.username is not None:
+                server.login(self.username, self.password)
+            server.send_message(message)
+
+
+class Dispatcher:
+    """
+    Delivers ad notifications on a background thread so that scanning never
+    waits on them. Hits submitted within <window> seconds of each other are
+    combined into a single digest, which is sent through every backend.
+    Failed deliveries are retried with exponential backoff. Once a digest is
+    delivered by at least one backend, its hits are passed to <on_delivered>,
+    e.g. to record them as notified.
+
+    backends - list[Backend]: Channels every notification is sent through.
+    window - float: Time (in seconds) to wait for further hits before a
+            digest is sent.
+    retries - int: Number of times a failed delivery is retried.
+    backoff - float: Delay (in seconds) before the first retry, doubled on
+            every further retry.
+    sent - int: Number of digests delivered by at least one backend.
+    failures - list[tuple(str, Exception)]: Backend name and last exception of
+            every delivery that failed after all retries.
+    on_delivered - callable: Called on the dispatcher thread with the list of
+            (ad id, ad price) hits of every delivered digest, or None.
+    """
+    _STOP = object()
+
+    def __init__(self, backends: List[Backend], window=5.0, retries=3,
+                 backoff=1.0, on_delivered=None):
+        self.backends = backends
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.sent = 0
+        self.failures = []
+        self.on_delivered = on_delivered
+        self._seen = set()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="Dispatcher", daemon=True
+            )
+        self._thread.start()
+
+    def submit(self, ad_id: int, price: float):
+        """
+        Queues a notification for the ad <ad_id> listed at <price> and
+        returns immediately. Ads already submitted are ignored.
+
+        :param ad_id: Unique numeric identifier of an ad.
+        :param price: Price of the ad.
+        :return: None
+        """
+        if ad_id in self._seen:
+            return None
+        self._seen.add(ad_id)
+        self._queue.put((ad_id, price))
+
+    def close(self, timeout=None):
+        """
+        Sends any queued notifications and stops the dispatcher, waiting at
+        most <timeout> seconds (forever if None).
+
+        :param timeout: Maximum time (in seconds) to wait.
+        :return: None
+        """
+        self._queue.put(Dispatcher._STOP)
+        self._thread.join(timeout)
+
+    @staticmethod
+    def digest(hits: List[Tuple[int, float]]):
+        """
+        Returns the title and body of a single notification for all <hits>.
+
+        :param hits: List of (ad id, ad price) tuples.
+        :return: tuple[str, str]
+        """
+        if len(hits) == 1:
+            ad_id, price = hits[0]
+            body = "${:0.2f}\n{}".format(price, AD_URL.format(ad_id))
+            return str(ad_id), body
+        title = "{} Herman Miller ads found".format(len(hits))
+        body = "\n".join(
+            "${:0.2f} {}".format(price, AD_URL.format(ad_id))
+            for ad_id, price in sorted(hits, key=lambda hit: hit[1])
+            )
+        return title, body
+
+    def _deliver(self, backend: Backend, title: str, body: str):
+        """
+        Sends a notification through <backend>, retrying on failure. Returns
+        True if it was delivered.
+
+        :param backend: Channel to send through.
+        :param title: Notification title.
+        :param body: Notification text.
+        :return: bool
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                backend.send(title, body)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    self.failures.append((backend.name, e))
+                    print("Notification via {} failed: {}".format(
+                        backend.name, e
+                        ))
+                    return False
+                time.sleep(delay)
+                delay *= 2
+
+    def _run(self):
+        """
+        Dispatcher thread loop. Waits for a hit, collects further hits for
+        self.window seconds, then sends them as one digest.
+
+        :return: None
+        """
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is Dispatcher._STOP:
+                break
+            hits = [item]
+            deadline = time.monotonic() + self.window
+            while True:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                        )
+                except queue.Empty:
+                    break
+                if item is Dispatcher._STOP:
+                    stop = True
+                    break
+                hits.append(item)
+            title, body = Dispatcher.digest(hits)
+            delivered = [
+                self._deliver(backend, title, body)
+                for backend in self.backends
+                ]
+            if any(delivered):
+                self.sent += 1
+                if self.on_delivered is not None:
+                    try:
+                        self.on_delivered(hits)
+                    except Exception as e:
+                        print("Recording delivered notifications failed: "
+                              "{}".format(e))
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from typing import List
+
+
+class EmbeddingIndex:
+    """
+    Nearest neighbour index of the penultimate layer embeddings of every
+    stored ad image, used to recognize reposted ads. Embeddings are kept
+    L2-normalized as float16, so a dot product is their cosine similarity,
+    and are saved to a single .npz file.
+
+    path - str: Path of the .npz file the index is saved to.
+    vectors - np.ndarray: float16 array of shape (n, d), one embedding per
+            image.
+    ad_ids - np.ndarray: int64 array of the ad id of each image.
+    probs - np.ndarray: float32 array of the probability of each image.
+    keys - list[str]: Image store key of each image.
+    rows - dict[str, int]: Row of each image key.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: Path of the .npz file the index is saved to. The index
+                is loaded from it if it exists.
+        """
+        self.path = path
+        self.vectors = np.empty((0, 0), dtype=np.float16)
+        self.ad_ids = np.empty(0, dtype=np.int64)
+        self.probs = np.empty(0, dtype=np.float32)
+        self.keys = []
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                self.vectors = saved["vectors"]
+                self.ad_ids = saved["ad_ids"]
+                self.probs = saved["probs"]
+                self.keys = saved["keys"].tolist()
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def normalize(vectors: np.ndarray):
+        """
+        Returns <vectors> scaled to unit length, as float32.
+
+        :param vectors: Array of shape (n, d).
+        :return: np.ndarray
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def lookup(self, key: str):
+        """
+        Returns the embedding and probability of the image stored under
+        <key>, or None if it is not indexed.
+
+        :param key: Image store key.
+        :return: None or tuple(np.ndarray, float)
+        """
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return self.vectors[row], float(self.probs[row])
+
+    def add(self, ad_id: int, keys: List[str], vectors: np.ndarray,
+            probs: List[float]):
+        """
+        Adds the images <keys> of the ad <ad_id>, with their embeddings
+        <vectors> and probabilities <probs>. Images already indexed are
+        skipped.
+
+        :param ad_id: Unique numeric identifier of the ad.
+        :param keys: Image store keys.
+        :param vectors: Array of shape (len(keys), d) of embeddings.
+        :param probs: Probability of each image.
+        :return: None
+        """
+        new = [i for i, key in enumerate(keys) if key not in self.rows]
+        if not new:
+            return None
+        vectors = EmbeddingIndex.normalize(vectors)[new].astype(np.float16)
+        if len(self) == 0:
+            self.vectors = vectors
+        else:
+            self.vectors = np.concatenate([self.vectors, vectors])
+        self.ad_ids = np.concatenate([
+            self.ad_ids, np.full(len(new), ad_id, dtype=np.int64)
+            ])
+        self.probs = np.concatenate([
+            self.probs, np.asarray(probs, dtype=np.float32)[new]
+            ])
+        for i in new:
+            self.rows[keys[i]] = len(self.keys)
+            self.keys.append(keys[i])
+
+    def retain(self, keys):
+        """
+        Removes every image whose key is not in <keys>, e.g. the images
+        still in the image store after garbage collection, so the index does
+        not grow without bound nor match ads whose images were removed.
+        Returns the number of images removed.
+
+        :param keys: Container of the image store keys to keep.
+        :return: int
+        """
+        kept = [i for i, key in enumerate(self.keys) if key in keys]
+        removed = len(self) - len(kept)
+        if removed:
+            self.vectors = self.vectors[kept] if kept \
+                else np.empty((0, 0), dtype=np.float16)
+            self.ad_ids = self.ad_ids[kept]
+            self.probs = self.probs[kept]
+            self.keys = [self.keys[i] for i in kept]
+            self.rows = {key: i for i, key in enumerate(self.keys)}
+        return removed
+
+    def nearest(self, vectors: np.ndarray, chunk_size=65536, exclude=None):
+        """
+        Returns the ad id of the indexed image most similar to any of
+        <vectors>, and that cosine similarity, or (None, -1.0) if the index is
+        empty. Images of the ad <exclude> are skipped. The index is scanned in
+        chunks of <chunk_size> rows so only one chunk is converted to float32
+        at a time.
+
+        :param vectors: Array of shape (k, d) of query embeddings.
+        :param chunk_size: Number of rows compared at a time.
+        :param exclude: Id of an ad whose images are not compared, or None.
+        :return: tuple(int, float)
+        """
+        queries = EmbeddingIndex.normalize(vectors)
+        best_id, best_sim = None, -1.0
+        for start in range(0, len(self), chunk_size):
+            chunk = self.vectors[start:start + chunk_size].astype(np.float32)
+            sims = (queries @ chunk.T).max(axis=0)
+            if exclude is not None:
+                sims[self.ad_ids[start:start + chunk_size] == exclude] = -1.0
+            row = int(sims.argmax())
+            if sims[row] > best_sim:
+                best_id = int(self.ad_ids[start + row])
+                best_sim = float(sims[row])
+        return best_id, best_sim
+
+    def duplicate_of(self, vectors: np.ndarray, threshold=0.95,
+                     exclude=None):
+        """
+        Returns the id of a stored ad, other than <exclude>, with an image
+        whose cosine similarity to one of <vectors> is at least <threshold>,
+        or None.
+
+        :param vectors: Array of shape (k, d) of the embeddings of an ad.
+        :param threshold: Smallest similarity of a near-duplicate image.
+        :param exclude: Id of the ad itself, if it may already be indexed.
+        :return: None or int
+        """
+        ad_id, sim = self.nearest(vectors, exclude=exclude)
+        return ad_id if sim >= threshold else None
+
+    def save(self):
+        """
+        Saves the index to self.path, replacing the previous file
+        atomically.
+
+        :return: None
+        """
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        with open(self.path + ".tmp", "wb") as f:
+            np.savez(
+                f, vectors=self.vectors, ad_ids=self.ad_ids,
+                probs=self.probs, keys=np.array(self.keys, dtype=str)
+                )
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import chair_sqlite
+from datetime import datetime, timedelta
+from typing import Tuple
+
+
+class ImageStore:
+    """
+    Content-addressed store of downloaded ad images. Each image is saved once
+    under the SHA-256 hash of its bytes, in directories sharded by the first
+    two pairs of hex digits of the hash, e.g. <root>/ab/cd/abcd....png. The
+    path relative to <root> is what the database stores as the image
+    filename, so reposted ads with identical images share one file.
+
+    root - str: Path of the folder the images are stored in.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: Path of the folder the images are stored in.
+        """
+        self.root = root
+
+    @staticmethod
+    def key(data: bytes):
+        """
+        Returns the store path, relative to the store root, of an image with
+        bytes <data>.
+
+        :param data: Image bytes.
+        :return: str
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        return "{}/{}/{}.png".format(digest[:2], digest[2:4], digest)
+
+    def path(self, key: str):
+        """
+        Returns the full path of the image stored under <key>.
+
+        :param key: Path relative to the store root.
+        :return: str
+        """
+        return os.path.join(self.root, key)
+
+    def put(self, data: bytes):
+        """
+        Stores the image bytes <data>, unless an identical image is already
+        stored, and returns its key. The file is written to a temporary name
+        and renamed into place so a partially written image is never visible.
+
+        :param data: Image bytes.
+        :return: str
+        """
+        key = ImageStore.key(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return key
+
+    def get(self, key: str):
+        """
+        Returns the bytes of the image stored under <key>, or None if it is
+        not stored, e.g. because it was garbage collected.
+
+        :param key: Path relative to the store root.
+        :return: None or bytes
+        """
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def stored(self):
+        """
+        Returns a dictionary mapping the key of every stored image to its
+        size in bytes.
+
+        :return: dict[str, int]
+        """
+        sizes = {}
+        for dir_path, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(".png"):
+                    continue
+                path = os.path.join(dir_path, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                sizes[key] = os.path.getsize(path)
+        return sizes
+
+    def collect(self, db_conn: Tuple[sqlite3.Cursor, sqlite3.Connection],
+                max_bytes=None, max_age_days=None, positive_thresh=None,
+                table="chairs"):
+        """
+        Garbage collects the store against the image table <table> of the
+        database <db_conn> and returns the number of bytes freed. Files no
+        image row refers to are removed. Then the retention policy is applied
+        to the referenced images, for every limit that is not None:
+            - images last stored more than <max_age_days> ago are evicted
+            - images whose best probability is below <positive_thresh> are
+              evicted, keeping only positives
+            - while the store exceeds <max_bytes>, negatives and then the
+              least recently stored images are evicted
+        Rows of evicted images keep their data but have their filename set to
+        NULL.
+
+        :param db_conn: Cursor and connection to database.
+        :param max_bytes: Maximum total size of the store in bytes.
+        :param max_age_days: Maximum age of a stored image in days.
+        :param positive_thresh: Probability below which images are evicted.
+        :param table: Name of the per-image table.
+        :return: int
+        """
+        c, conn = db_conn
+        c.execute(
+            "SELECT filename, MAX(date), MAX(prob) FROM {} "
+            "WHERE filename IS NOT NULL GROUP BY filename"
+            .format(chair_sqlite.sqlfstr(table))
+            )
+        referenced = {name: (date, prob) for name, date, prob in c.fetchall()}
+        sizes = self.stored()
+        evict = set(sizes) - set(referenced)
+        keep = [key for key in sizes if key in referenced]
+        if max_age_days is not None:
+            cutoff = (datetime.now() - timedelta(days=max_age_days))\
+                .strftime("%Y-%m-%d %H:%M:%S")
+            evict.update(key for key in keep if referenced[key][0] < cutoff)
+        if positive_thresh is not None:
+            evict.update(
+                key for key in keep if referenced[key][1] < positive_thresh
+                )
+        keep = [key for key in keep if key not in evict]
+        if max_bytes is not None:
+            thresh = 0.5 if positive_thresh is None else positive_thresh
+            # negatives first, then oldest first
+            keep.sort(key=lambda k: (
+                referenced[k][1] >= thresh, referenced[k][0]
+                ))
+            total = sum(sizes[key] for key in keep)
+            for key in keep:
+                if total <= max_bytes:
+                    break
+                evict.add(key)
+                total -= sizes[key]
+        freed = 0
+        for key in evict:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                # removed concurrently or by an interrupted collect
+                continue
+            freed += sizes[key]
+        evicted = [(key,) for key in evict if key in referenced]
+        if evicted:
+            with conn:
+                c.executemany(
+                    "UPDATE {} SET filename = NULL WHERE filename = ?"
+                    .format(chair_sqlite.sqlfstr(table)), evicted
+                    )
+        self._remove_empty_dirs()
+        return freed
+
+    def _remove_empty_dirs(self):
+        """
+        Removes shard directories left empty by garbage collection.
+
+        :return: None
+        """
+        for dir_path, _, _ in os.walk(self.root, topdown=False):
+            if dir_path != self.root and not os.listdir(dir_path):
+                os.rmdir(dir_path)
@@ -1,7 +1,12 @@
 from datetime import datetime
 import classify
 import chair_sqlite
+import numpy as np
 from browserconn import BrowserConnection
+from embedding_index import EmbeddingIndex
+from image_store import ImageStore
+from scan_state import ScanState
+from tracing import Tracer, metric_rows
 import sqlite3
 from typing import List, Tuple
 
@@ -18,8 +23,8 @@ class KijijiAd:
             for sale. This attribute represents the probabilities of each image
             containing a particular item, which depends on the model used for
             classification.
-    names - list[str]: List of the downloaded global paths of each image in the
-            ad gallery.
+    names - list[str]: List of the image store keys of each image in the ad
+            gallery.
     price - float: The price of an ad.
     var_names - str: String of variable names used in the database containing
             downloaded ads. This string is formatted to make insertion into the
@@ -70,11 +75,11 @@ class KijijiAd:
         :param db_conn: Database object
         :return: None
         """
-        for i in range(len(self.names)):
-            item_dict = self.get_ith_value_dict(i)
-            chair_sqlite.insert(
-                db_conn, item_dict=item_dict, item_names=self.var_names
-                )
+        chair_sqlite.insert_many(
+            db_conn,
+            [self.get_ith_value_dict(i) for i in range(len(self.names))],
+            item_names=self.var_names
+            )
 
 
 class KijijiScraper:
@@ -87,15 +92,34 @@ class KijijiScraper:
             notifying a user about a potential ad.
     model - torch.Module: PyTorch Neural Net used for ad image classification.
     notifs - list[tuple(int, float)]: List of ads whose price is less than or
-            equal to max_price. Each element contains ad id and ad price.
+            equal to max_price and that have not been notified at this price
+            or lower before. Each element contains ad id and ad price.
             Originally empty, this list is filled by calling scrape_ads.
     num_ads - int (>0): The maximum number of ads to scrape.
     folder - str: Global path of folder to store downloaded images.
+    store - ImageStore: Content-addressed store of downloaded images, rooted
+            at folder.
     thresh - float (0 < threshold < 1): Probability threshold to
             classify an image as a particular item.
+    dispatcher - Dispatcher: Sends notifications for ads as soon as they are
+            appended to notifs, or None.
+    index - EmbeddingIndex: Embeddings of the images of stored ads, used to
+            recognize reposted ads, or None.
+    dup_thresh - float: Cosine similarity from which an image of a new ad is
+            considered a near-duplicate of an indexed image.
+    tracer - Tracer: Times the browser, classify and chair_sqlite calls of
+            each ad and counts ads, images and timeouts.
+    run - str: Date the scan started, identifying its rows in the metrics
+            table.
+    chair_sqlite - Traced: The chair_sqlite module, traced by tracer.
+    classify - Traced: The classify module, traced by tracer.
+    state - ScanState: Progress of the scan, saved to the database so an
+            interrupted scan resumes at the next unprocessed ad.
     """
     def __init__(self, db_name: str, model_path: str, max_price: float,
-                 folder: str, thresh: float, num_ads: int):
+                 folder: str, thresh: float, num_ads: int, dispatcher=None,
+                 index_path=None, dup_thresh=0.95, tracer=None,
+                 max_attempts=2):
         """
         :param db_name: Local path of database used to store scraped ad data.
         :param model_path: Global path of model used to classify ads.
@@ -105,46 +129,130 @@ class KijijiScraper:
         :param thresh: Probability threshold to
                 classify an image as a particular item.
         :param num_ads: The maximum number of ads to scrape.
+        :param dispatcher: Sends notifications for ads as soon as they are
+                found, or None.
+        :param index_path: Path of the embedding index file, or None to not
+                detect reposted ads.
+        :param dup_thresh: Cosine similarity from which images are
+                considered near-duplicates.
+        :param tracer: Tracer of the scan, or None for a new one.
+        :param max_attempts: Number of times an ad that fails is tried, over
+                this and resumed runs, before it is skipped.
         """
         assert num_ads < 47, "Currently the number of ads is capped at 46."
-        self.db = chair_sqlite.open_conn(db_name=db_name)
+        self.tracer = Tracer() if tracer is None else tracer
+        self.run = KijijiScraper.current_time()
+        self.chair_sqlite = self.tracer.wrap(chair_sqlite, "db")
+        self.classify = self.tracer.wrap(classify, "classify")
+        self.db = self.chair_sqlite.open_conn(db_name=db_name)
+        self.chair_sqlite.init_summary(self.db)
+        self.chair_sqlite.init_alerts(self.db)
+        self.chair_sqlite.init_metrics(self.db)
         self.max_price = max_price
-        self.model = classify.init_model(model_path)
+        self.model = self.classify.init_model(model_path)
         self.notifs = []
         self.num_ads = num_ads
         self.folder = folder
+        self.store = ImageStore(folder)
         self.thresh = thresh
+        self.dispatcher = dispatcher
+        self.index = None if index_path is None else EmbeddingIndex(index_path)
+        self.dup_thresh = dup_thresh
+        self.state = ScanState(self.db, max_attempts=max_attempts)
 
     @staticmethod
-    def init_browser_conn(driver_loc: str, timeout: int):
+    def init_browser_conn(driver_loc: str, timeout: int, tracer=None):
         """
         Initializes BrowserConnection object with the webdriver location.
 
         :param driver_loc: Path to webdriver.
         :param timeout: Maximum allotted time for Selenium methods before
                 raising TimeoutException.
+        :param tracer: Tracer of the scan, or None.
         :return: BrowserConnection
         """
-        return BrowserConnection(driver_loc, timeout)
+        return BrowserConnection(driver_loc, timeout, tracer=tracer)
 
     def new_id(self, ad_id: int):
         """
-        Returns True if <ad_id> is not in the database under the variable
-        "id", and False otherwise.
+        Returns True if <ad_id> is not in the per-ad summary table, and False
+        otherwise. The summary table's primary key makes this an indexed
+        lookup.
 
         :param ad_id: Unique numeric identifier of an ad.
         :return: bool
         """
-        return not chair_sqlite.is_in_db(self.db, ad_id, "id")
+        return not self.chair_sqlite.is_in_db(
+            self.db, ad_id, "id", table="ads"
+            )
 
     def insert_into_db(self, ad: KijijiAd):
         """
-        Inserts <ad> into database.
+        Inserts <ad> into database and updates its row in the per-ad summary
+        table.
 
         :param ad: Ad to be inserted into database.
         :return: None
         """
-        ad.insert_into_db(self.db)
+        with self.tracer.span("db.insert_ad"):
+            ad.insert_into_db(self.db)
+        self.chair_sqlite.update_summary(
+            self.db, ad.id, max(ad.probs), len(ad.names), ad.price, ad.time
+            )
+
+    def alert(self, ad_id: int, price: float, duplicate_of=None):
+        """
+        Appends the ad <ad_id> listed at <price> to self.notifs, and submits
+        it to self.dispatcher, unless a notification was already sent for it
+        in this or an earlier run at the same or a lower price. Without a
+        dispatcher the notification is recorded in the database right away;
+        with one it is only recorded once delivered, by the dispatcher's
+        on_delivered callback, so an undelivered ad is alerted again on the
+        next scan. A repost of the ad <duplicate_of> is only notified if the
+        original would be, and is otherwise recorded as notified through it.
+
+        :param ad_id: Unique numeric identifier of an ad.
+        :param price: Price of the ad.
+        :param duplicate_of: Id of the ad that <ad_id> reposts, or None.
+        :return: None
+        """
+        if not self.chair_sqlite.should_alert(self.db, ad_id, price):
+            return None
+        if duplicate_of is not None and not self.chair_sqlite.should_alert(
+                self.db, duplicate_of, price):
+            self.chair_sqlite.record_alert(
+                self.db, ad_id, price, KijijiScraper.current_time()
+                )
+            return None
+        self.notifs.append((ad_id, price))
+        if self.dispatcher is None:
+            self.chair_sqlite.record_alert(
+                self.db, ad_id, price, KijijiScraper.current_time()
+                )
+        else:
+            self.dispatcher.submit(ad_id, price)
+
+    def update_known_ad(self, conn: BrowserConnection, ad_id: int):
+        """
+        Given a BrowserConnection <conn> located at an ad, <ad_id>, that is
+        already stored, records its current price in the summary table and
+        alerts if the stored images pass self.thresh and the price has dropped
+        to at most self.max_price since the last notification.
+
+        :param conn: Web browser object that interacts with Kijiji
+                website using Selenium.
+        :param ad_id: Unique numeric identifier of the ad.
+        :return: None
+        """
+        summary = self.chair_sqlite.get_summary(self.db, ad_id)
+        price = conn.get_price()
+        if summary is None or price is None:
+            return None
+        self.chair_sqlite.update_summary(
+            self.db, ad_id, summary[1], 0, price, KijijiScraper.current_time()
+            )
+        if summary[1] >= self.thresh and price <= self.max_price:
+            self.alert(ad_id, price)
 
     def _close_db(self):
         """
@@ -152,43 +260,79 @@ class KijijiScraper:
 
         :return: None
         """
-        chair_sqlite.close_conn(self.db)
+        self.chair_sqlite.close_conn(self.db)
 
     @staticmethod
     def _quit_browser(conn: BrowserConnection):
         """
-        Quits the browser connection.
+        Quits the browser connection. Errors are ignored, as a crashed
+        browser cannot be quit cleanly.
 
         :param conn: Web browser object that interacts with Kijiji
                 website using Selenium.
         :return: None
         """
-        conn.quit_conn()
+        try:
+            conn.quit_conn()
+        except Exception as e:
+            print("Could not quit the browser: {!r}".format(e))
 
-    def scrape_images(self, conn: BrowserConnection, time: str):
+    def _open_browser(self, browser_dict: dict):
+        """
+        Returns a new browser connection, traced by self.tracer.
+
+        :param browser_dict: Dictionary of keys and values needed to initialize
+                a BrowserConnection.
+        :return: Traced
+        """
+        conn = KijijiScraper.init_browser_conn(
+            tracer=self.tracer, **browser_dict
+            )
+        return self.tracer.wrap(conn, "browser")
+
+    def scrape_images(self, conn: BrowserConnection, ad_id=None):
         """
         Given a BrowserConnection <conn> located at an ad image gallery,
-        download the images; including the <time> of download in their filename.
-        Return the names of downloaded images and their classification
-        probabilities.
+        download the images into self.store. Return the store keys of the
+        downloaded images, their classification probabilities and their
+        embeddings. Images whose bytes are already indexed in self.index reuse
+        the stored probability and embedding instead of running the model.
+        Each image of the ad <ad_id> is recorded in self.state once stored,
+        so images downloaded before the scan was interrupted are read back
+        from self.store instead of being downloaded again.
 
         :param conn: Web browser object that interacts with Kijiji
                 website using Selenium.
-        :param time: The date (Y/M/D and H/M/S) the ad was identified and added
-                to a local database.
-        :return: tuple[list[str], list[float]]
+        :param ad_id: Unique numeric identifier of the ad, or None to not
+                record the images.
+        :return: tuple[list[str], list[float], list[np.ndarray]]
         """
         images = conn.get_images()
-        names, predictions = [], []
-        for i, image in enumerate(images):
-            name = "{}_{}.png".format(time, str(i))
-            predictions.append(
-                classify.hm_prob(
-                    image, "{}/{}".format(self.folder, name), self.model
-                    )
-                )
-            names.append(name)
-        return names, predictions
+        done = {} if ad_id is None else self.state.images(ad_id)
+        names, predictions, embeddings = [], [], []
+        for image in images:
+            src = image.get_attribute("src")
+            data = None if src not in done else self.store.get(done[src])
+            if data is not None:
+                names.append(done[src])
+                self.tracer.count("images.resumed")
+            else:
+                data = self.classify.download_image(image)
+                with self.tracer.span("store.put"):
+                    names.append(self.store.put(data))
+                if ad_id is not None:
+                    self.state.record_image(ad_id, src, names[-1])
+            known = None
+            if self.index is not None:
+                known = self.index.lookup(names[-1])
+            if known is None:
+                known = self.classify.bytes_embedding_prob(data, self.model)
+                self.tracer.count("images.classified")
+            else:
+                self.tracer.count("images.reused")
+            embeddings.append(known[0])
+            predictions.append(known[1])
+        return names, predictions, embeddings
 
     def scrape_ad(self, conn: BrowserConnection):
         """
@@ -203,30 +347,96 @@ class KijijiScraper:
             - probabilities of images being a particular item
         Ads that contain an image whose probability is greater than or equal to
         self.thresh and price is less than or equal to self.max_price are
-        appended to self.notifs. Afterwards, the web browser goes back to the
-        previous page containing all ads.
+        passed to self.alert. A new ad whose images match those of a stored ad
+        in self.index is alerted as a repost of it. Ads already stored only
+        have their price checked for a drop. The ad's timings and outcome are
+        recorded in the metrics table.
 
         :param conn: Web browser object that interacts with Kijiji
                 website using Selenium.
         :return: None
         """
+        self.tracer.start_ad()
+        ad_id, outcome = None, "error"
+        try:
+            ad_id, outcome = self._scrape_ad(conn)
+        finally:
+            record = self.tracer.end_ad(ad_id, outcome)
+            self.chair_sqlite.record_metrics(
+                self.db, metric_rows(self.tracer, self.run, record)
+                )
+
+    def _scrape_ad(self, conn: BrowserConnection):
+        """
+        Does the work of scrape_ad and returns the ad id and what happened to
+        the ad: "no_id", "known", "no_price", "no_images" or "new".
+
+        :param conn: Web browser object that interacts with Kijiji
+                website using Selenium.
+        :return: tuple[int, str]
+        """
         ad_dict = {"id": conn.get_id()}
-        if ad_dict["id"] is None or not self.new_id(ad_dict["id"]):
-            conn.go_back_n_pages()
-            return None
+        if ad_dict["id"] is None:
+            return None, "no_id"
+        if not self.new_id(ad_dict["id"]):
+            self.update_known_ad(conn, ad_dict["id"])
+            return ad_dict["id"], "known"
         ad_dict["price"] = conn.get_price()
         if ad_dict["price"] is None:
-            conn.go_back_n_pages()
-            return None
+            return ad_dict["id"], "no_price"
         ad_dict["time"] = KijijiScraper.current_time()
-        names, probs = self.scrape_images(conn, ad_dict["time"])
-        if len(names) > 0:
-            ad_dict["names"], ad_dict["probs"] = names, probs
-            ad = KijijiAd(**ad_dict)
-            if ad.has_hm(self.thresh) and ad.price <= self.max_price:
-                self.notifs.append((ad.id, ad.price))
-            self.insert_into_db(ad)
-        conn.go_back_n_pages()
+        names, probs, embeddings = self.scrape_images(conn, ad_dict["id"])
+        if len(names) == 0:
+            return ad_dict["id"], "no_images"
+        ad_dict["names"], ad_dict["probs"] = names, probs
+        ad = KijijiAd(**ad_dict)
+        duplicate_of = None
+        if self.index is not None:
+            # indexed before the ad is stored, as a stored ad is only ever
+            # checked as known again; an earlier failed try may have indexed
+            # the ad already
+            duplicate_of = self.index.duplicate_of(
+                np.stack(embeddings), self.dup_thresh, exclude=ad.id
+                )
+            self.index.add(ad.id, names, np.stack(embeddings), probs)
+            if duplicate_of is not None:
+                self.tracer.count("ads.reposts")
+        self.insert_into_db(ad)
+        if ad.has_hm(self.thresh) and ad.price <= self.max_price:
+            self.alert(ad.id, ad.price, duplicate_of=duplicate_of)
+        return ad.id, "new"
+
+    def scrape_listed_ad(self, conn: BrowserConnection, position: int,
+                         ad_url: str, browser_dict: dict):
+        """
+        Visits the ad at <ad_url>, at <position> in the listing of the scan,
+        scrapes it with scrape_ad and records the outcome in self.state. Any
+        Exception raised by the ad is recorded and printed rather than raised,
+        so one ad cannot abort the scan, and if the browser crashed it is
+        replaced by a new one. Returns the browser connection to continue
+        with.
+
+        :param conn: Web browser object that interacts with Kijiji
+                website using Selenium.
+        :param position: Position of the ad in the listing.
+        :param ad_url: Url of the ad.
+        :param browser_dict: Dictionary of keys and values needed to initialize
+                a BrowserConnection.
+        :return: BrowserConnection
+        """
+        try:
+            conn.get_url(ad_url)
+            self.scrape_ad(conn)
+        except Exception as e:
+            print("Failed to scrape {}: {!r}".format(ad_url, e))
+            self.state.record_ad(position, "failed", error=repr(e))
+            if not conn.is_alive():
+                self.tracer.count("browser.restarts")
+                KijijiScraper._quit_browser(conn)
+                conn = self._open_browser(browser_dict)
+            return conn
+        self.state.record_ad(position, "done")
+        return conn
 
     def scrape_ads(self, url: str, browser_dict: dict):
         """
@@ -235,20 +445,57 @@ class KijijiScraper:
         prices are below or equal to self.max_price and have a probability
         greater than or equal to self.thresh of containing a particular item.
 
+        The urls of the ads listed at <url> are saved in self.state when the
+        scan starts, and each ad is recorded once processed. If an earlier
+        scan of <url> was interrupted, it is resumed instead, from its saved
+        listing, at the next unprocessed ad. Ads that fail are tried again,
+        after the others, up to self.state.max_attempts times. The browser is
+        quit and the database closed even if the scan fails.
+
         :param url: Url link to a Kijiji website page of ads to scrape.
         :param browser_dict: Dictionary of keys and values needed to initialize
                 a BrowserConnection.
         :return: List[tuple[int, float]]
         """
-        conn = KijijiScraper.init_browser_conn(**browser_dict)
-        conn.get_url(url)
-        for i in range(1, self.num_ads):
-            if conn.click_ad(conn.get_ith_ad(self.num_ads, i)):
-                self.scrape_ad(conn)
+        conn = None
+        try:
+            if self.state.resume(url):
+                print("Resuming scan {} of {}".format(self.state.scan, url))
             else:
-                break
-        KijijiScraper._quit_browser(conn)
-        self._close_db()
+                conn = self._open_browser(browser_dict)
+                conn.get_url(url)
+                listing = conn.get_ad_urls(self.num_ads)[1:]
+                missing = listing.count(None)
+                if missing:
+                    print("{} of {} listed ads have no url".format(
+                        missing, len(listing)
+                        ))
+                    self.tracer.count("ads.no_url", missing)
+                self.state.start(
+                    url, [ad_url for ad_url in listing if ad_url is not None],
+                    KijijiScraper.current_time()
+                    )
+            pending = self.state.pending()
+            while pending:
+                for position, ad_url in pending:
+                    if conn is None:
+                        conn = self._open_browser(browser_dict)
+                    conn = self.scrape_listed_ad(
+                        conn, position, ad_url, browser_dict
+                        )
+                pending = self.state.pending()
+            self.state.finish(KijijiScraper.current_time())
+        finally:
+            if conn is not None:
+                KijijiScraper._quit_browser(conn)
+            try:
+                if self.index is not None:
+                    self.index.save()
+                self.chair_sqlite.record_metrics(
+                    self.db, metric_rows(self.tracer, self.run)
+                    )
+            finally:
+                self._close_db()
         return self.notifs
 
     @staticmethod
@@ -1,6 +1,9 @@
-from pynotifier import Notification
 from kijiji_scraper import KijijiScraper
-import time
+from image_store import ImageStore
+from embedding_index import EmbeddingIndex
+from dispatcher import Dispatcher, DesktopBackend, WebhookBackend, SMTPBackend
+from tracing import Tracer, print_summary, write_prometheus
+import chair_sqlite
 
 
 URL = ("https://www.kijiji.ca/b-chair-recliner/city-of-toronto/c245l170"
@@ -14,35 +17,110 @@ MAX_PRICE = 500
 DRIVER_LOC = '/Users/nicholas/chromedriver'
 PROB_THRESH = 0.7
 TIMEOUT = 30  # seconds
+STORE_MAX_BYTES = 2 * 1024 ** 3  # None for no limit
+STORE_MAX_AGE_DAYS = 180  # None for no limit
+STORE_POSITIVE_THRESH = None  # PROB_THRESH to keep only positives
+DIGEST_WINDOW = 5  # seconds to wait for more hits before notifying
+WEBHOOK_URL = None  # e.g. a Slack or Discord incoming webhook url
+# e.g. {"host": ..., "port": 587, "sender": ..., "recipients": [...],
+#       "username": ..., "password": ..., "starttls": True}
+SMTP = None
+INDEX_PATH = "scanner/embeddings.npz"  # None to not detect reposted ads
+DUP_THRESH = 0.95  # cosine similarity of near-duplicate images
+MAX_ATTEMPTS = 2  # tries of an ad that fails, over resumed scans
+METRICS_PATH = "scanner/metrics.prom"  # None to not export scan metrics
 
 
 def notify():
     """
-    Calls the scrape_ads method from KijijiScraper. Desktop notifications are
-    sent for all Kijiji ads that satisfy the desired price and Herman Miller
-    probability thresholds declared in the file constants. i.e, ads whose
+    Calls the scrape_ads method from KijijiScraper. Notifications are sent,
+    while the scan continues, for all Kijiji ads that satisfy the desired
+    price and Herman Miller probability thresholds declared in the file
+    constants. i.e, ads whose
     probability of being a Herman Miller are greater than or equal to
     PROB_THRESH and whose listed price is less than or equal to MAX_PRICE.
+    The scan's timings are stored in the metrics table of DB_NAME, printed
+    and written to METRICS_PATH for a Prometheus textfile collector.
 
     :return: None
     """
     browser_dict = {"driver_loc": DRIVER_LOC, "timeout": TIMEOUT}
-    unique_ids = set()
+    dispatcher = Dispatcher(
+        get_backends(), window=DIGEST_WINDOW, on_delivered=record_delivered
+        )
+    tracer = Tracer()
     scraper = KijijiScraper(
-        DB_NAME, MODEL_PATH, MAX_PRICE, FOLDER, PROB_THRESH, NUM_ADS
+        DB_NAME, MODEL_PATH, MAX_PRICE, FOLDER, PROB_THRESH, NUM_ADS,
+        dispatcher=dispatcher, index_path=INDEX_PATH, dup_thresh=DUP_THRESH,
+        tracer=tracer, max_attempts=MAX_ATTEMPTS
     )
-    notifs = scraper.scrape_ads(URL, browser_dict)
-    for ad_id, ad_price in notifs:
-        if ad_id in unique_ids:
-            continue
-        unique_ids.add(ad_id)
-        Notification(
-            title=str(ad_id),
-            description=str(ad_price),
-            duration=300,
-            app_name="Herman Miller Detector"
-        ).send()
-        time.sleep(2)
+    try:
+        scraper.scrape_ads(URL, browser_dict)
+    finally:
+        dispatcher.close()
+        print_summary(tracer)
+        if METRICS_PATH is not None:
+            write_prometheus(tracer, METRICS_PATH)
+    collect_images()
+
+
+def get_backends():
+    """
+    Returns the notification backends configured in the file constants.
+    Desktop notifications are always sent.
+
+    :return: List[Backend]
+    """
+    backends = [DesktopBackend()]
+    if WEBHOOK_URL is not None:
+        backends.append(WebhookBackend(WEBHOOK_URL))
+    if SMTP is not None:
+        backends.append(SMTPBackend(**SMTP))
+    return backends
+
+
+def record_delivered(hits):
+    """
+    Records the delivered notifications <hits> in the alerts table of
+    DB_NAME, so they are not sent again unless the price drops. Called on the
+    dispatcher thread, so it uses its own database connection.
+
+    :param hits: List of (ad id, ad price) tuples.
+    :return: None
+    """
+    db_conn = chair_sqlite.open_conn(db_name=DB_NAME)
+    try:
+        for ad_id, price in hits:
+            chair_sqlite.record_alert(
+                db_conn, ad_id, price, KijijiScraper.current_time()
+                )
+    finally:
+        chair_sqlite.close_conn(db_conn)
+
+
+def collect_images():
+    """
+    Garbage collects the downloaded image store, applying the retention
+    limits declared in the file constants, and removes the collected images
+    from the embedding index at INDEX_PATH.
+
+    :return: None
+    """
+    store = ImageStore(FOLDER)
+    db_conn = chair_sqlite.open_conn(db_name=DB_NAME)
+    try:
+        store.collect(
+            db_conn,
+            max_bytes=STORE_MAX_BYTES,
+            max_age_days=STORE_MAX_AGE_DAYS,
+            positive_thresh=STORE_POSITIVE_THRESH
+            )
+    finally:
+        chair_sqlite.close_conn(db_conn)
+    if INDEX_PATH is not None:
+        index = EmbeddingIndex(INDEX_PATH)
+        if index.retain(store.stored()):
+            index.save()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+import argparse
+import chair_sqlite
+from typing import Tuple
+import sqlite3
+
+
+ORDERS = {
+    "price": "price ASC",
+    "prob": "max_prob DESC",
+    "recent": "last_seen DESC"
+    }
+
+
+def query_ads(db_conn: Tuple[sqlite3.Cursor, sqlite3.Connection],
+              max_price=None, min_prob=None, since=None, order="price",
+              limit=20, table="ads"):
+    """
+    Returns rows of the per-ad summary table <table> whose price is at most
+    <max_price>, whose best image probability is at least <min_prob> and
+    that were last seen on or after <since>, sorted by <order>. Filters that
+    are None are ignored.
+
+    :param db_conn: Cursor and connection to database.
+    :param max_price: Largest price included.
+    :param min_prob: Smallest best image probability included.
+    :param since: Earliest last seen date included, e.g. "2021-06-01".
+    :param order: One of the keys of ORDERS.
+    :param limit: Maximum number of rows returned.
+    :param table: Name of the summary table.
+    :return: List[tuple]
+    """
+    if order not in ORDERS:
+        raise ValueError(
+            "order must be one of: {}".format(", ".join(ORDERS))
+            )
+    filters = [
+        ("price <= ?", max_price),
+        ("max_prob >= ?", min_prob),
+        ("last_seen >= ?", since)
+        ]
+    where = [cond for cond, value in filters if value is not None]
+    params = [value for _, value in filters if value is not None]
+    query = ("SELECT id, max_prob, image_count, price, first_seen, last_seen "
+             "FROM {}").format(chair_sqlite.sqlfstr(table))
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY {} LIMIT ?".format(ORDERS[order])
+    c, _ = db_conn
+    c.execute(query, params + [limit])
+    return c.fetchall()
+
+
+def main():
+    """
+    Command line interface to query_ads. From the ChairDetector directory,
+    e.g. the cheapest likely Herman Miller ads seen this week:
+
+        python scanner/query_ads.py --min-prob 0.7 --since 2021-06-14
+
+    :return: None
+    """
+    parser = argparse.ArgumentParser(
+        description="Query the per-ad summary of scanned Kijiji ads."
+        )
+    parser.add_argument("--db", default="scanner/chairs.db")
+    parser.add_argument("--max-price", type=float)
+    parser.add_argument("--min-prob", type=float)
+    parser.add_argument("--since", help="Earliest last seen date.")
+    parser.add_argument("--order", choices=list(ORDERS), default="price")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    db_conn = chair_sqlite.open_conn(db_name=args.db)
+    try:
+        chair_sqlite.init_summary(db_conn)
+        rows = query_ads(
+            db_conn, args.max_price, args.min_prob, args.since, args.order,
+            args.limit
+            )
+    finally:
+        chair_sqlite.close_conn(db_conn)
+    print("{:>12} {:>8} {:>6} {:>9}  {:<19}  {:<19}".format(
+        "id", "max_prob", "images", "price", "first_seen", "last_seen"
+        ))
+    for ad_id, max_prob, count, price, first_seen, last_seen in rows:
+        print("{:>12} {:>8.2f} {:>6} {:>9.2f}  {:<19}  {:<19}".format(
+            ad_id, max_prob, count, price, first_seen, last_seen
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+
+class ScanState:
+    """
+    Progress of a scan, saved to the scanner database as it happens so that
+    a scan interrupted by a crash resumes where it stopped. A scan records
+    the snapshot of the ad urls listed when it started, the status of every
+    ad of the snapshot and the images already downloaded for each ad, so a
+    partially downloaded gallery is not downloaded again.
+
+    db - (sqlite3.Cursor, sqlite3.Connection): Database cursor and connection
+    max_attempts - int: Number of times an ad is tried before it is skipped.
+    max_age_hours - float: Age from which an unfinished scan is abandoned
+            rather than resumed, as its listing is out of date.
+    scan - int: Id of the current scan, or None before start or resume.
+    listing - list[str]: Url of each ad listed when the scan started.
+    """
+    def __init__(self, db_conn: Tuple[sqlite3.Cursor, sqlite3.Connection],
+                 max_attempts=2, max_age_hours=24):
+        """
+        :param db_conn: Cursor and connection to the scanner database.
+        :param max_attempts: Number of times an ad is tried.
+        :param max_age_hours: Age from which an unfinished scan is not
+                resumed.
+        """
+        self.db = db_conn
+        self.max_attempts = max_attempts
+        self.max_age_hours = max_age_hours
+        self.scan = None
+        self.listing = []
+        c, conn = self.db
+        with conn:
+            c.execute("""CREATE TABLE IF NOT EXISTS scans(
+                id integer PRIMARY KEY,
+                url text,
+                listing text,
+                started text,
+                finished text
+                )""")
+            c.execute("""CREATE TABLE IF NOT EXISTS scan_ads(
+                scan integer,
+                position integer,
+                status text,
+                attempts integer,
+                error text,
+                PRIMARY KEY (scan, position)
+                )""")
+            c.execute("""CREATE TABLE IF NOT EXISTS scan_images(
+                scan integer,
+                ad_id integer,
+                src text,
+                key text,
+                PRIMARY KEY (scan, ad_id, src)
+                )""")
+
+    def resume(self, url: str):
+        """
+        Resumes the latest unfinished scan of <url>, if it started less than
+        self.max_age_hours ago, and returns True. Returns False if there is
+        no such scan.
+
+        :param url: Url of the page of ads scanned.
+        :return: bool
+        """
+        since = datetime.now() - timedelta(hours=self.max_age_hours)
+        c, _ = self.db
+        c.execute(
+            "SELECT id, listing FROM scans WHERE url=? AND finished IS NULL "
+            "AND started>=? ORDER BY id DESC LIMIT 1",
+            (url, since.strftime("%Y-%m-%d %H:%M:%S"))
+            )
+        result = c.fetchone()
+        if result is None:
+            return False
+        self.scan, self.listing = result[0], json.loads(result[1])
+        return True
+
+    def start(self, url: str, listing: List[str], date: str):
+        """
+        Starts a new scan of <url> at <date> over the ad urls <listing>.
+
+        :param url: Url of the page of ads scanned.
+        :param listing: Url of each ad listed on the page.
+        :param date: Date the scan started.
+        :return: None
+        """
+        c, conn = self.db
+        with conn:
+            c.execute(
+                "INSERT INTO scans (url, listing, started) VALUES (?, ?, ?)",
+                (url, json.dumps(listing), date)
+                )
+        self.scan, self.listing = c.lastrowid, list(listing)
+
+    def pending(self):
+        """
+        Returns the position and url of every ad of the listing that is
+        neither done nor failed self.max_attempts times, in listing order.
+
+        :return: List[tuple[int, str]]
+        """
+        c, _ = self.db
+        c.execute(
+            "SELECT position FROM scan_ads WHERE scan=? AND "
+            "(status='done' OR attempts>=?)",
+            (self.scan, self.max_attempts)
+            )
+        processed = {row[0] for row in c.fetchall()}
+        return [(i, url) for i, url in enumerate(self.listing)
+                if i not in processed]
+
+    def record_ad(self, position: int, status: str, error=None):
+        """
+        Records an attempt at the ad at <position> of the listing, which
+        ended with <status>, "done" or "failed", and the <error> if any.
+
+        :param position: Position of the ad in the listing.
+        :param status: Outcome of the attempt.
+        :param error: Description of the error of a failed attempt, or None.
+        :return: None
+        """
+        c, conn = self.db
+        with conn:
+            c.execute(
+                "INSERT INTO scan_ads VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (scan, position) DO UPDATE SET "
+                "status=excluded.status, error=excluded.error, "
+                "attempts=attempts + 1",
+                (self.scan, position, status, error)
+                )
+
+    def images(self, ad_id: int):
+        """
+        Returns a dictionary mapping the source url of every image of the ad
+        <ad_id> already downloaded during this scan to its image store key.
+
+        :param ad_id: Unique numeric identifier of the ad.
+        :return: dict[str, str]
+        """
+        c, _ = self.db
+        c.execute(
+            "SELECT src, key FROM scan_images WHERE scan=? AND ad_id=?",
+            (self.scan, ad_id)
+            )
+        return dict(c.fetchall())
+
+    def record_image(self, ad_id: int, src: str, key: str):
+        """
+        Records that the image at <src> of the ad <ad_id> was downloaded to
+        the image store under <key>.
+
+        :param ad_id: Unique numeric identifier of the ad.
+        :param src: Source url of the image.
+        :param key: Image store key.
+        :return: None
+        """
+        c, conn = self.db
+        with conn:
+            c.execute(
+                "INSERT OR REPLACE INTO scan_images VALUES (?, ?, ?, ?)",
+                (self.scan, ad_id, src, key)
+                )
+
+    def finish(self, date: str):
+        """
+        Marks the scan as finished at <date>, so it is not resumed, and
+        forgets its downloaded images, which only served to resume it.
+
+        :param date: Date the scan finished.
+        :return: None
+        """
+        c, conn = self.db
+        with conn:
+            c.execute(
+                "UPDATE scans SET finished=? WHERE id=?", (date, self.scan)
+                )
+            c.execute("DELETE FROM scan_images WHERE scan=?", (self.scan,))
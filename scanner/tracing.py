@@ -0,0 +1,245 @@
+import inspect
+import os
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+    Lightweight tracer of a scan. A span times a block of code under a name,
+    and the time and number of calls of every name are accumulated over the
+    whole run and over the ad being scraped. Exceptions raised in a span are
+    counted by type, e.g. TimeoutException, and re-raised. Counters count
+    events such as new ads or classified images.
+
+    start - float: Time the run started.
+    spans - dict[str, list[float, int]]: Total seconds and calls of each span
+            over the run.
+    counters - dict[str, int]: Value of each counter over the run.
+    ads - list[dict]: Record of each ad scraped: its id, outcome, duration
+            and spans.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.spans = {}
+        self.counters = {}
+        self.ads = []
+        self._ad_spans = None
+        self._ad_start = None
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        Times the enclosed block under <name>.
+
+        :param name: Name of the span, e.g. "browser.get_url".
+        :return: context manager
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            # counted once, by the innermost span it passes through
+            if not getattr(e, "_traced", False):
+                self.count(type(e).__name__)
+                e._traced = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            for spans in (self.spans, self._ad_spans):
+                if spans is not None:
+                    total = spans.setdefault(name, [0.0, 0])
+                    total[0] += duration
+                    total[1] += 1
+
+    def count(self, name: str, n=1):
+        """
+        Adds <n> to the counter <name>.
+
+        :param name: Name of the counter.
+        :param n: Amount to add.
+        :return: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def wrap(self, target, prefix: str):
+        """
+        Returns a proxy of the object or module <target> whose method calls
+        are traced as spans named <prefix>.<method>.
+
+        :param target: Object or module to trace.
+        :param prefix: Prefix of the span names.
+        :return: Traced
+        """
+        return Traced(target, self, prefix)
+
+    def start_ad(self):
+        """
+        Starts the record of a new ad.
+
+        :return: None
+        """
+        self._ad_spans = {}
+        self._ad_start = time.perf_counter()
+
+    def end_ad(self, ad_id, outcome: str):
+        """
+        Ends the record of the current ad <ad_id>, which had the outcome
+        <outcome>, e.g. "new" or "known", counts the outcome and returns the
+        record.
+
+        :param ad_id: Unique numeric identifier of the ad, or None.
+        :param outcome: What happened to the ad.
+        :return: dict
+        """
+        record = {
+            "ad_id": ad_id,
+            "outcome": outcome,
+            "seconds": time.perf_counter() - self._ad_start,
+            "spans": self._ad_spans
+            }
+        self.ads.append(record)
+        self.count("ads." + outcome)
+        self._ad_spans = None
+        return record
+
+    def summary(self):
+        """
+        Returns the run's duration, spans, sorted by total time, and
+        counters.
+
+        :return: dict
+        """
+        return {
+            "seconds": time.time() - self.start,
+            "ads": len(self.ads),
+            "spans": dict(sorted(
+                self.spans.items(), key=lambda item: -item[1][0]
+                )),
+            "counters": dict(sorted(self.counters.items()))
+            }
+
+
+class Traced:
+    """
+    Proxy of an object or module whose callable attributes are traced by a
+    Tracer. Other attributes are returned unchanged. A generator returned by
+    a call, such as BrowserConnection.get_images, is consumed into a list
+    within the span, so the span times the work of the generator rather
+    than just its creation.
+
+    target - object: Object or module traced.
+    tracer - Tracer: Tracer recording the spans.
+    prefix - str: Prefix of the span names.
+    """
+    def __init__(self, target, tracer: Tracer, prefix: str):
+        self.target = target
+        self.tracer = tracer
+        self.prefix = prefix
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+        span_name = "{}.{}".format(self.prefix, name)
+
+        def traced(*args, **kwargs):
+            with self.tracer.span(span_name):
+                result = attr(*args, **kwargs)
+                if inspect.isgenerator(result):
+                    result = list(result)
+                return result
+        return traced
+
+
+def metric_rows(tracer: Tracer, run: str, record=None):
+    """
+    Returns the rows of the metrics table for the ad <record> of <tracer>,
+    or for the whole run if <record> is None. Each row is (run, ad_id, name,
+    seconds, count), with the calls of a span as its count; counters and the
+    run duration have no seconds or no count.
+
+    :param tracer: Tracer of the scan.
+    :param run: Identifier of the run, its start date.
+    :param record: Ad record returned by Tracer.end_ad, or None.
+    :return: List[tuple]
+    """
+    if record is not None:
+        rows = [(run, record["ad_id"], "ad." + record["outcome"],
+                 record["seconds"], 1)]
+        spans = record["spans"]
+    else:
+        summary = tracer.summary()
+        rows = [(run, None, "run", summary["seconds"], summary["ads"])]
+        rows += [(run, None, name, None, value)
+                 for name, value in summary["counters"].items()]
+        spans = summary["spans"]
+    rows += [(run, None if record is None else record["ad_id"], name,
+              seconds, calls) for name, (seconds, calls) in spans.items()]
+    return rows
+
+
+def write_prometheus(tracer: Tracer, path: str, prefix="chairdetector_scan"):
+    """
+    Writes the summary of the run traced by <tracer> to <path> in the
+    Prometheus text format, for the node exporter textfile collector. The
+    file is replaced atomically so it is never read half written. Span
+    times, call counts and event counts are totals of the traced run only,
+    restarting from zero with the Tracer of each scan, so like the duration
+    they are gauges describing the last run rather than counters.
+
+    :param tracer: Tracer of the scan.
+    :param path: Path of the .prom file.
+    :param prefix: Prefix of the metric names.
+    :return: None
+    """
+    summary = tracer.summary()
+    lines = [
+        "# HELP {}_duration_seconds Duration of the last scan.".format(prefix),
+        "# TYPE {}_duration_seconds gauge".format(prefix),
+        "{}_duration_seconds {}".format(prefix, summary["seconds"]),
+        "# HELP {}_last_run_timestamp_seconds Start of the last scan."
+        .format(prefix),
+        "# TYPE {}_last_run_timestamp_seconds gauge".format(prefix),
+        "{}_last_run_timestamp_seconds {}".format(prefix, tracer.start)
+        ]
+    spans = [
+        ("seconds", "Total time in each span during the last scan.", 0),
+        ("calls", "Number of calls of each span during the last scan.", 1)
+        ]
+    for unit, description, i in spans:
+        lines.append("# HELP {}_span_{} {}".format(prefix, unit, description))
+        lines.append("# TYPE {}_span_{} gauge".format(prefix, unit))
+        for name, values in summary["spans"].items():
+            lines.append('{}_span_{}{{span="{}"}} {}'.format(
+                prefix, unit, name, values[i]
+                ))
+    lines.append("# HELP {}_events Number of each event during the last "
+                 "scan.".format(prefix))
+    lines.append("# TYPE {}_events gauge".format(prefix))
+    for name, value in summary["counters"].items():
+        lines.append('{}_events{{event="{}"}} {}'.format(prefix, name, value))
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def print_summary(tracer: Tracer, top=10):
+    """
+    Prints the run's duration, the <top> spans with the most total time and
+    the counters.
+
+    :param tracer: Tracer of the scan.
+    :param top: Number of spans printed.
+    :return: None
+    """
+    summary = tracer.summary()
+    print("Scanned {} ads in {:0.1f}s".format(
+        summary["ads"], summary["seconds"]
+        ))
+    for name, (seconds, calls) in list(summary["spans"].items())[:top]:
+        print("{:<32} {:>8.2f}s {:>6} calls".format(name, seconds, calls))
+    for name, value in summary["counters"].items():
+        print("{:<32} {:>8}".format(name, value))
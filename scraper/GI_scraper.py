@@ -1,74 +1,274 @@
 from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import ElementNotInteractableException
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+import base64
+import csv
+import hashlib
+import logging
+import os
 import re
-from urllib.request import urlopen
-from time import sleep
+import urllib3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote_to_bytes
 
-def scroll_to_bottom(driver):
-    scroll_down(driver)
+OUTPUT_DIR = "detector/new_data"  # images are saved to OUTPUT_DIR/<folder>
+MANIFEST = "manifest.csv"
+SCROLL_TIMEOUT = 5  # seconds to wait for new results after a scroll
+RESULTS_XPATH = '//*[@id="islrg"]/div[1]/div'
+COUNT_JS = """
+return document.evaluate(
+    'count({})', document, null, XPathResult.NUMBER_TYPE, null
+).numberValue;
+""".format(RESULTS_XPATH)
+# (title, src) of the first arguments[0] results, with the same xpaths the
+# results were once looked up with one by one
+HARVEST_JS = """
+function first(xpath, node) {
+    return document.evaluate(
+        xpath, node, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+}
+var results = document.evaluate(
+    '%s', document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+);
+var pairs = [];
+for (var i = 0; i < Math.min(results.snapshotLength, arguments[0]); i++) {
+    var result = results.snapshotItem(i);
+    var title = first('./a[2]', result);
+    var img = first('./a[1]/div[1]/img', result);
+    pairs.push([
+        title ? title.getAttribute('title') : null,
+        img ? img.getAttribute('src') || img.getAttribute('data-src') : null
+    ]);
+}
+return pairs;
+""" % RESULTS_XPATH
+logger = logging.getLogger(__name__)
+
+def count_results(driver):
+    return driver.execute_script(COUNT_JS)
+
+def scroll_to_bottom(driver, n, timeout=SCROLL_TIMEOUT):
+    scroll_down(driver, n, timeout)
     more_imgs_xpath = '//*[@id="islmp"]/div/div/div/div/div[3]/div[2]/input'
-    driver.find_element_by_xpath(more_imgs_xpath).click()
-    scroll_down(driver)
-
-def scroll_down(driver):
-    # get scroll height
-    last_height = driver.execute_script("return document.body.scrollHeight")
-    wait = 3
-    while True:
-        # scroll down to bottom
+    if count_results(driver) < n:
+        try:
+            driver.find_element(By.XPATH, more_imgs_xpath).click()
+        except (NoSuchElementException, ElementNotInteractableException):
+            return None
+        scroll_down(driver, n, timeout)
+
+def scroll_down(driver, n, timeout=SCROLL_TIMEOUT):
+    """
+    Scrolls to the bottom of the results until there are at least <n>, or
+    until no new results appear within <timeout> seconds of a scroll. Each
+    scroll returns as soon as new results are loaded instead of sleeping.
+    """
+    count = count_results(driver)
+    while count < n:
         driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        sleep(wait)
-        # Calculate new scroll height and compare with last scroll height
-        new_height = driver.execute_script("return document.body.scrollHeight")
-        if new_height == last_height:
+        try:
+            WebDriverWait(driver, timeout, poll_frequency=0.2).until(
+                lambda d: count_results(d) > count
+                )
+        except TimeoutException:
             break
-        last_height = new_height
-
-def create_img_name(driver, index, start_index):
-    title_xpath = '//*[@id="islrg"]/div[1]/div[{}]/a[2]'.format(str(index))
-    label_index = str(index+start_index)
-    title = driver.find_element_by_xpath(
-        title_xpath
-        ).get_attribute("title")
-    if bool(re.search(r'(?i)herman miller', title)):
-        return "HM" + label_index
+        count = count_results(driver)
+
+def create_img_name(title):
+    """
+    Returns the label prefix of a result with the title <title>, "HM" if it
+    mentions Herman Miller and "NHM" otherwise.
+    """
+    if bool(re.search(r'(?i)herman miller', title or "")):
+        return "HM"
     else:
-        return "NHM" + label_index
+        return "NHM"
 
-def download_img(driver, index, folder, filename):
-    img_xpath = (
-        '//*[@id="islrg"]/div[1]/'
-        'div[{}]/a[1]/div[1]/img').format(str(index))
-    img = driver.find_element_by_xpath(img_xpath)
-    img_name = (
-        "/Users/nicholas/Documents/Experimentation"
-        "/chairDetector/new_data/{}/{}.png").format(folder, filename)
-    src = img.get_attribute('src')
-    conn = urlopen(src)
-    with open(img_name, "wb") as download:
-        download.write(conn.read())
+def harvest(driver, n):
+    """
+    Returns the (title, src) of the first <n> results on the page, read
+    with a single JavaScript call rather than two WebDriver lookups per
+    result. Results whose image has no src yet are left out.
+    """
+    return [
+        (title, src) for title, src in driver.execute_script(HARVEST_JS, n)
+        if src
+        ]
 
-def scrape_url(url, driver, n, folder, start_index = 0):
+def decode_data_url(url):
     """
-    For loop must start at 1 for Google Images indexing.
+    Returns the bytes of the inline data: url <url>, such as the base64
+    encoded thumbnails Google Images embeds in the page.
     """
-    driver.get(url)
-    scroll_to_bottom(driver)
+    header, _, payload = url.partition(",")
+    if header.endswith(";base64"):
+        return base64.b64decode(payload, validate=True)
+    return unquote_to_bytes(payload)
+
+def manifest_key(url):
+    """
+    Returns the key of <url> in the manifest: the url itself, or the hash
+    of an inline data: url so that the manifest does not hold its content.
+    """
+    if url.startswith("data:"):
+        return "data:sha256," + hashlib.sha256(url.encode()).hexdigest()
+    return url
+
+def read_manifest(out_dir):
+    """
+    Returns the urls already downloaded to <out_dir> and a dictionary
+    mapping the SHA-256 of each stored image to its path, relative to
+    <out_dir>, from the manifest written by download_all.
+    """
+    path = os.path.join(out_dir, MANIFEST)
+    done, files = set(), {}
+    if os.path.exists(path):
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                done.add(row["url"])
+                files[row["sha256"]] = row["path"]
+    return done, files
+
+class HTTPStatusError(Exception):
+    def __init__(self, status):
+        super(HTTPStatusError, self).__init__("HTTP status {}".format(status))
+        self.status = status
+
+def failure_category(exc):
+    if isinstance(exc, urllib3.exceptions.MaxRetryError):
+        exc = exc.reason or exc
+    if isinstance(exc, HTTPStatusError):
+        return "http {}".format(exc.status)
+    if isinstance(exc, urllib3.exceptions.LocationValueError):
+        return "unsupported url"
+    if isinstance(exc, urllib3.exceptions.NewConnectionError):
+        return "connection"
+    if isinstance(exc, urllib3.exceptions.TimeoutError):
+        return "timeout"
+    if isinstance(exc, urllib3.exceptions.HTTPError):
+        return "connection"
+    if isinstance(exc, ValueError):
+        return "bad data url"
+    if isinstance(exc, OSError):
+        return "io"
+    return "other"
+
+def fetch(pool, url, timeout):
+    if url.startswith("data:"):
+        return decode_data_url(url)
+    response = pool.request(
+        "GET", url, timeout=timeout, retries=urllib3.Retry(2, redirect=3)
+        )
+    if response.status != 200:
+        raise HTTPStatusError(response.status)
+    return response.data
+
+def save_image(out_dir, folder, label, data):
+    """
+    Saves the image bytes <data> as <out_dir>/<folder>/<label><hash>.png,
+    named by the start of their SHA-256 so reruns write the same names, and
+    returns the path relative to <out_dir>.
+    """
+    rel_path = os.path.join(folder, "{}{}.png".format(
+        label, hashlib.sha256(data).hexdigest()[:16]
+        ))
+    path = os.path.join(out_dir, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return rel_path
+
+def download_all(items, out_dir=OUTPUT_DIR, workers=16, timeout=10):
+    """
+    Downloads the (url, folder, label) <items> into <out_dir> with a pool of
+    <workers> threads sharing keep-alive connections. Inline data: urls are
+    decoded without any network request. Every stored image is
+    appended to the manifest <out_dir>/manifest.csv as soon as it is saved,
+    so an interrupted run resumes where it stopped: urls in the manifest are
+    skipped, and an image whose bytes are already stored is recorded
+    against the existing file rather than saved again. Failures are logged
+    and counted by category. Returns the number of images downloaded and
+    the failure counts.
+    """
+    done, files = read_manifest(out_dir)
+    todo = list({url: (url, folder, label) for url, folder, label in items
+                 if manifest_key(url) not in done}.values())
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    new_manifest = not os.path.exists(manifest_path)
+    failures = Counter()
     total = 0
-    for i in range(1, n+1):
-        try:
-            filename = create_img_name(driver, i, start_index)
-            download_img(driver, i, folder, filename)
-            total += 1
-        except:
-            pass
-    return total
+    pool = urllib3.PoolManager(num_pools=4, maxsize=workers, block=True)
+    with open(manifest_path, "a", newline="") as f, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=["url", "sha256", "path"])
+        if new_manifest:
+            writer.writeheader()
+        futures = {
+            executor.submit(fetch, pool, url, timeout): (url, folder, label)
+            for url, folder, label in todo
+            }
+        for future in as_completed(futures):
+            url, folder, label = futures[future]
+            try:
+                data = future.result()
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in files:
+                    files[digest] = save_image(out_dir, folder, label, data)
+                    total += 1
+            except Exception as exc:
+                category = failure_category(exc)
+                failures[category] += 1
+                logger.warning("%s: %s (%s)", category, url[:100], exc)
+                continue
+            writer.writerow(
+                {
+                    "url": manifest_key(url), "sha256": digest,
+                    "path": files[digest]
+                    }
+                )
+            f.flush()
+    pool.clear()
+    return total, failures
 
-def scrape_data(n, url_folder_dict):
-    driver = webdriver.Chrome('~/chromedriver')
-    start_index = 0
-    for url, folder in url_folder_dict.items():
-        start_index += scrape_url(url, driver, n, folder, start_index)
-    driver.close()
+def scrape_url(url, driver, n, folder):
+    """
+    Returns the (src, folder, label) of the first <n> results of the Google
+    Images search <url>.
+    """
+    driver.get(url)
+    scroll_to_bottom(driver, n)
+    items = [
+        (src, folder, create_img_name(title))
+        for title, src in harvest(driver, n)
+        ]
+    if len(items) < n:
+        logger.warning("only %d of %d results found for %s", len(items), n,
+                       folder)
+    return items
+
+def scrape_data(n, url_folder_dict, out_dir=OUTPUT_DIR, workers=16):
+    driver = webdriver.Chrome(
+        service=Service(os.path.expanduser('~/chromedriver'))
+        )
+    items = []
+    try:
+        for url, folder in url_folder_dict.items():
+            items += scrape_url(url, driver, n, folder)
+    finally:
+        driver.close()
+    total, failures = download_all(items, out_dir, workers)
+    print("Downloaded {} new images to {}".format(total, out_dir))
+    for category, count in failures.most_common():
+        print("Failed ({}): {}".format(category, count))
+    return total
 
 def rename_files(folder, suffix = 'x'):
     import os
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+import pytest
+# scanner modules import their siblings by name, as when notifier.py runs
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scanner"
+    ))
+import chair_sqlite
+from db_writer import DBWriter
+
+VAR_NAMES = "(:id, :date, :prob, :price, :filename)"
+
+
+def row(i: int):
+    return {
+        "id": i, "date": "test", "prob": 0.0, "price": 0.0,
+        "filename": "{}.png".format(i)
+        }
+
+
+def count(writer: DBWriter, table="chairs"):
+    c, conn = writer.open_reader()
+    try:
+        return c.execute(
+            'SELECT COUNT(*) FROM "{}"'.format(table)
+            ).fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    path = str(tmp_path / "chairs.db")
+    chair_sqlite.init_db(db=path)
+    return path
+
+
+def test_concurrent_producers_and_readers(db_name):
+    producers, rows, readers = 8, 200, 2
+    writer = DBWriter(db_name)
+    errors = []
+    writing = threading.Event()
+
+    def produce(p: int):
+        try:
+            for i in range(rows):
+                writer.insert(row(p * rows + i), VAR_NAMES)
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        rc, rconn = writer.open_reader()
+        try:
+            while writing.is_set():
+                rc.execute("SELECT COUNT(*) FROM chairs").fetchone()
+        except sqlite3.Error as e:
+            errors.append(e)
+        finally:
+            rconn.close()
+
+    writing.set()
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    threads += [
+        threading.Thread(target=produce, args=(p,)) for p in range(producers)
+        ]
+    for t in threads[readers:] + threads[:readers]:
+        t.start()
+    for t in threads[readers:]:
+        t.join()
+    writer.close()
+    writing.clear()
+    for t in threads[:readers]:
+        t.join()
+    assert errors == []
+    assert count(writer) == producers * rows
+    assert writer.rows_written == producers * rows
+
+
+def test_locked_database_loses_nothing(db_name):
+    lock = sqlite3.connect(db_name, isolation_level=None)
+    writer = DBWriter(db_name, flush_interval=0.1)
+    lock.execute("BEGIN EXCLUSIVE")
+    for i in range(4):
+        writer.insert(row(i), VAR_NAMES)
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    writer.insert(row(4), VAR_NAMES)
+    lock.execute("COMMIT")
+    lock.close()
+    writer.close()
+    assert count(writer) == 5 and writer.unwritten == []
+
+
+@pytest.mark.parametrize("table, error", [
+    ("unique_ids", sqlite3.IntegrityError),
+    (None, AttributeError)
+    ])
+def test_permanent_failure_is_given_up(db_name, table, error):
+    c, conn = chair_sqlite.open_conn(db_name=db_name)
+    c.execute("CREATE TABLE unique_ids(id integer PRIMARY KEY)")
+    c.execute("INSERT INTO unique_ids VALUES (1)")
+    conn.commit()
+    conn.close()
+    writer = DBWriter(db_name, flush_interval=0.1)
+    writer.insert({"id": 1}, "(:id)", table=table)
+    writer.insert(row(1), VAR_NAMES)
+    for _ in range(DBWriter.MAX_TRIES):
+        with pytest.raises(error):
+            writer.flush()
+    writer.insert(row(2), VAR_NAMES)
+    writer.close()
+    assert count(writer) == 2
+    assert [op[1] for op in writer.unwritten] == [table]
+
+
+def test_flush_waits_for_commit(db_name):
+    writer = DBWriter(db_name, flush_interval=60.0)
+    writer.insert(row(1), VAR_NAMES)
+    start = time.monotonic()
+    writer.flush()
+    assert time.monotonic() - start < 5.0
+    assert count(writer) == 1
+    writer.close()
@@ -0,0 +1,163 @@
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+# scanner modules import their siblings by name, as when notifier.py runs
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scanner"
+    ))
+from dispatcher import Dispatcher, SMTPBackend, WebhookBackend
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in webhook that records every JSON body it receives and answers
+    with the next status of server.statuses, then 200 once they run out.
+    """
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.bodies.append(json.loads(body))
+        time.sleep(self.server.delay)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Stand-in SMTP server that accepts every message and records its bytes.
+    """
+    def reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        self.reply("220 localhost")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250 localhost")
+            elif command == b"DATA":
+                self.reply("354 end with .")
+                data = b""
+                for line in iter(self.rfile.readline, b".\r\n"):
+                    data += line
+                self.server.messages.append(message_from_bytes(data))
+                self.reply("250 queued")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def webhook():
+    server = HTTPServer(("127.0.0.1", 0), WebhookHandler)
+    server.bodies, server.statuses, server.delay = [], [], 0.0
+    server.url = "http://127.0.0.1:{}/".format(server.server_port)
+    yield serve(server)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def smtp():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    yield serve(server)
+    server.shutdown()
+    server.server_close()
+
+
+def smtp_backend(server):
+    return SMTPBackend("127.0.0.1", server.server_address[1],
+                       "scanner@localhost", ["me@localhost"], timeout=5)
+
+
+def test_digest_batches_hits_in_window(webhook, smtp):
+    delivered = []
+    dispatcher = Dispatcher(
+        [WebhookBackend(webhook.url), smtp_backend(smtp)], window=0.5,
+        on_delivered=delivered.append
+        )
+    for ad_id, price in ((1, 300.0), (2, 100.0), (3, 200.0)):
+        dispatcher.submit(ad_id, price)
+    dispatcher.submit(1, 300.0)
+    dispatcher.close(timeout=10)
+    assert len(webhook.bodies) == 1
+    assert webhook.bodies[0]["title"] == "3 Herman Miller ads found"
+    lines = webhook.bodies[0]["text"].splitlines()
+    assert [line.split()[0] for line in lines] == [
+        "$100.00", "$200.00", "$300.00"
+        ]
+    assert len(smtp.messages) == 1
+    assert smtp.messages[0]["Subject"] == "3 Herman Miller ads found"
+    assert dispatcher.sent == 1 and dispatcher.failures == []
+    assert delivered == [[(1, 300.0), (2, 100.0), (3, 200.0)]]
+
+
+def test_hits_outside_window_are_separate_digests(webhook):
+    dispatcher = Dispatcher([WebhookBackend(webhook.url)], window=0.1)
+    dispatcher.submit(1, 300.0)
+    time.sleep(0.5)
+    dispatcher.submit(2, 100.0)
+    dispatcher.close(timeout=10)
+    assert [body["title"] for body in webhook.bodies] == ["1", "2"]
+
+
+def test_retries_after_http_500(webhook):
+    webhook.statuses = [500]
+    dispatcher = Dispatcher(
+        [WebhookBackend(webhook.url)], window=0.0, backoff=0.01
+        )
+    dispatcher.submit(1, 300.0)
+    dispatcher.close(timeout=10)
+    assert len(webhook.bodies) == 2
+    assert dispatcher.sent == 1 and dispatcher.failures == []
+
+
+def test_failure_recorded_after_all_retries(webhook):
+    webhook.statuses = [500] * 10
+    delivered = []
+    dispatcher = Dispatcher(
+        [WebhookBackend(webhook.url)], window=0.0, retries=2, backoff=0.01,
+        on_delivered=delivered.append
+        )
+    dispatcher.submit(1, 300.0)
+    dispatcher.close(timeout=10)
+    assert len(webhook.bodies) == 3
+    assert dispatcher.sent == 0 and delivered == []
+    assert [name for name, _ in dispatcher.failures] == ["webhook"]
+
+
+def test_submit_never_blocks(webhook):
+    webhook.delay = 1.0
+    webhook.statuses = [500]
+    dispatcher = Dispatcher(
+        [WebhookBackend(webhook.url)], window=0.0, backoff=0.01
+        )
+    start = time.perf_counter()
+    for ad_id in range(5):
+        dispatcher.submit(ad_id, 100.0)
+        time.sleep(0.01)
+    assert time.perf_counter() - start < 0.2
+    dispatcher.close(timeout=30)
+    assert dispatcher.failures == []